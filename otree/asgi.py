@@ -4,7 +4,11 @@ from starlette.responses import HTMLResponse
 from starlette.routing import NoMatchFound
 
 from otree import errorpage
-from otree.database import save_sqlite_db
+from otree.channels.monitor import monitor_publisher
+from otree.channels.utils import channel_layer
+from otree.common2 import flush_page_completion_buffer, static_files_app
+from otree.database import save_sqlite_db, start_sqlite_checkpoints
+from otree.tasks import timeout_worker
 from . import middleware
 from . import settings
 from .errorpage import OTreeServerErrorMiddleware
@@ -53,7 +57,15 @@ app = OTreeStarlette(
     debug=settings.DEBUG,
     routes=routes,
     exception_handlers={ERR_500: server_error},
-    on_shutdown=[save_sqlite_db],
+    on_startup=[
+        channel_layer.start,
+        timeout_worker.start,
+        monitor_publisher.start,
+        start_sqlite_checkpoints,
+        static_files_app.start,
+    ],
+    # flush before saving, since the in-memory DB is what gets saved.
+    on_shutdown=[flush_page_completion_buffer, save_sqlite_db],
 )
 
 # alias like django reverse()
@@ -0,0 +1,18 @@
+'''
+Benchmarks run with "otree bench <name>".
+Each module defines add_arguments(parser) and run(**options).
+'''
+
+
+def percentile(sorted_values, pct):
+    '''nearest-rank percentile; sorted_values must be sorted and non-empty'''
+    idx = round(pct / 100 * (len(sorted_values) - 1))
+    return sorted_values[idx]
+
+
+def print_table(header, rows):
+    widths = [
+        max(len(str(row[i])) for row in [header] + rows) for i in range(len(header))
+    ]
+    for row in [header] + rows:
+        print('  '.join(str(v).rjust(w) for v, w in zip(row, widths)))
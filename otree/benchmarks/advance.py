@@ -0,0 +1,76 @@
+'''
+Time of the "advance slowest participants" button in the session monitor.
+
+Creates a session with --participants participants, lets the button advance all of them
+at once (rather than ADVANCE_SLOWEST_BATCH_SIZE), and clicks it --clicks times.
+Reports the time and number of queries of each click, and the page the participants
+are on afterwards.
+'''
+import time
+
+import otree.constants
+from otree.benchmarks import print_table
+from otree.database import count_queries, db, session_scope
+from otree.lookup import get_page_lookup
+from otree.models import Session
+from otree.session import SESSION_CONFIGS_DICT, create_session
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--session-config',
+        help='Name of a session config (default: the first one in settings.py)',
+    )
+    parser.add_argument('--participants', type=int, nargs='+', default=[60, 480])
+    parser.add_argument('--clicks', type=int, default=6)
+
+
+def page_names(session):
+    names = set()
+    for p in session.get_participants():
+        if 1 <= p._index_in_pages <= p._max_page_index:
+            lookup = get_page_lookup(session.code, p._index_in_pages)
+            names.add(lookup.page_class.__name__)
+    return ', '.join(sorted(names))
+
+
+def run(*, session_config, participants, clicks):
+    # sets up the page classes, as on server startup
+    from otree.urls import get_urlpatterns
+
+    get_urlpatterns()
+
+    session_config_name = session_config or next(iter(SESSION_CONFIGS_DICT))
+    original_batch_size = otree.constants.ADVANCE_SLOWEST_BATCH_SIZE
+    rows = []
+    try:
+        for num_participants in participants:
+            otree.constants.ADVANCE_SLOWEST_BATCH_SIZE = num_participants
+            with session_scope():
+                session = create_session(
+                    session_config_name, num_participants=num_participants
+                )
+                session_code = session.code
+            for click in range(1, clicks + 1):
+                with session_scope():
+                    session = Session.objects_get(code=session_code)
+                    with count_queries() as counter:
+                        start = time.perf_counter()
+                        session.advance_last_place_participants()
+                        # include the commit
+                        db.commit()
+                        elapsed = time.perf_counter() - start
+                    rows.append(
+                        [
+                            num_participants,
+                            click,
+                            '{:.3f}'.format(elapsed),
+                            counter.count,
+                            page_names(session),
+                        ]
+                    )
+            with session_scope():
+                db.delete(Session.objects_get(code=session_code))
+    finally:
+        otree.constants.ADVANCE_SLOWEST_BATCH_SIZE = original_batch_size
+    print_table(['participants', 'click', 'seconds', 'queries', 'now on'], rows)
@@ -0,0 +1,93 @@
+'''
+Throughput of attribute access on Player/Group/Subsession instances.
+
+Loads a player from a new session and times reading a field, looking up a method,
+following a relationship, and setting a field, with the tracking of recently accessed
+attributes (used for __repr__ on the debug error page) on and off.
+It's on in debug mode and off in production mode.
+'''
+import time
+
+import otree.database
+from otree.benchmarks import print_table
+from otree.database import db, session_scope
+from otree.models import Participant
+from otree.session import SESSION_CONFIGS_DICT, create_session
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--session-config',
+        help='Name of a session config (default: the first one in settings.py)',
+    )
+    parser.add_argument('--repeat', type=int, default=1_000_000)
+
+
+def read_field(player, repeat):
+    for _ in range(repeat):
+        player.round_number
+
+
+def look_up_method(player, repeat):
+    for _ in range(repeat):
+        player.in_round
+
+
+def follow_relationship(player, repeat):
+    for _ in range(repeat):
+        player.participant
+
+
+def set_field(player, repeat):
+    for _ in range(repeat):
+        player.round_number = 1
+
+
+CASES = [
+    ('read field', read_field),
+    ('method', look_up_method),
+    ('relationship', follow_relationship),
+    ('set field', set_field),
+]
+
+
+def time_case(func, player, repeat):
+    start = time.perf_counter()
+    func(player, repeat)
+    return time.perf_counter() - start
+
+
+def run(*, session_config, repeat):
+    session_config_name = session_config or next(iter(SESSION_CONFIGS_DICT))
+    num_participants = SESSION_CONFIGS_DICT[session_config_name]['num_demo_participants']
+    original_setting = otree.database.TRACK_RECENT_ATTRIBUTES
+    rows = []
+    with session_scope():
+        session = create_session(session_config_name, num_participants=num_participants)
+        participant_id = session.get_participants()[0].id
+    try:
+        with session_scope():
+            player = Participant.objects_get(id=participant_id).get_players()[0]
+            # so the relationship is loaded before timing
+            player.participant
+            for name, func in CASES:
+                times = []
+                for tracking in [True, False]:
+                    otree.database.TRACK_RECENT_ATTRIBUTES = tracking
+                    times.append(time_case(func, player, repeat))
+                with_tracking, without_tracking = times
+                rows.append(
+                    [
+                        name,
+                        '{:.2f}'.format(repeat / with_tracking / 1e6),
+                        '{:.2f}'.format(repeat / without_tracking / 1e6),
+                        '{:.1f}x'.format(with_tracking / without_tracking),
+                    ]
+                )
+            # the set_field case modified it
+            db.rollback()
+        with session_scope():
+            db.delete(Participant.objects_get(id=participant_id).session)
+    finally:
+        otree.database.TRACK_RECENT_ATTRIBUTES = original_setting
+    print_table(['access', 'M/s tracking', 'M/s no tracking', 'speedup'], rows)
@@ -0,0 +1,114 @@
+'''
+Pages per second of CLI bots, with TestClient vs. the direct ASGI client.
+
+Runs the bots of a session config --repeat times with each HTTP client,
+with and without checking the HTML of each page (BOTS_CHECK_HTML).
+A page is one GET or POST, including redirects and wait page refreshes.
+TestClient needs the requests package; if it's not installed, it's skipped.
+'''
+import logging
+import time
+
+from otree import settings
+from otree.benchmarks import print_table
+from otree.bots.runner import SessionBotRunner, make_bots
+from otree.database import db
+from otree.session import SESSION_CONFIGS_DICT, create_session
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--session-config',
+        help='Name of a session config (default: the first one in settings.py)',
+    )
+    parser.add_argument(
+        '--participants',
+        type=int,
+        help='Number of participants (default: num_demo_participants)',
+    )
+    parser.add_argument('--repeat', type=int, default=3)
+
+
+class CountingClient:
+    def __init__(self, client, counter):
+        self._client = client
+        self._counter = counter
+
+    def get(self, url, **kwargs):
+        self._counter[0] += 1
+        return self._client.get(url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        self._counter[0] += 1
+        return self._client.post(url, data, **kwargs)
+
+
+def get_client_classes():
+    from otree.bots.client import AsgiBotClient
+
+    classes = {}
+    try:
+        import requests  # noqa
+    except ModuleNotFoundError:
+        print('requests is not installed, so TestClient is skipped')
+    else:
+        from starlette.testclient import TestClient
+
+        classes['TestClient'] = TestClient
+    classes['AsgiBotClient'] = AsgiBotClient
+    return classes
+
+
+def play_session(session_config_name, num_participants, ClientClass) -> tuple:
+    '''returns the number of pages and the seconds'''
+    from otree.asgi import app
+
+    session = create_session(session_config_name, num_participants=num_participants)
+    bots = make_bots(session_pk=session.id, case_number=None, use_browser_bots=False)
+    if session.get_room() is None:
+        session.mock_exogenous_data()
+    db.commit()
+    counter = [0]
+    for bot in bots:
+        bot._client = CountingClient(ClientClass(app), counter)
+    start = time.perf_counter()
+    SessionBotRunner(bots=bots).play()
+    return counter[0], time.perf_counter() - start
+
+
+def run(*, session_config, participants, repeat):
+    # the log line for each submit would dominate the output
+    logging.getLogger('otree.bots').setLevel(logging.WARNING)
+
+    session_config_name = session_config or next(iter(SESSION_CONFIGS_DICT))
+    num_participants = (
+        participants or SESSION_CONFIGS_DICT[session_config_name]['num_demo_participants']
+    )
+    original_check_html = settings.BOTS_CHECK_HTML
+    rows = []
+    try:
+        for check_html in [True, False]:
+            # Submission reads it when the bot yields
+            settings.BOTS_CHECK_HTML = check_html
+            for client_name, ClientClass in get_client_classes().items():
+                total_pages = 0
+                total_seconds = 0
+                for _ in range(repeat):
+                    pages, seconds = play_session(
+                        session_config_name, num_participants, ClientClass
+                    )
+                    total_pages += pages
+                    total_seconds += seconds
+                rows.append(
+                    [
+                        client_name,
+                        check_html,
+                        total_pages,
+                        '{:.2f}'.format(total_seconds),
+                        '{:.0f}'.format(total_pages / total_seconds),
+                    ]
+                )
+    finally:
+        settings.BOTS_CHECK_HTML = original_check_html
+    print(f'{session_config_name}, {num_participants} participants x {repeat}')
+    print_table(['client', 'check_html', 'pages', 'seconds', 'pages/s'], rows)
@@ -0,0 +1,119 @@
+'''
+Fan-out latency of channel layer group sends.
+
+Measures the time from group_send until the last of N fake sockets has
+received the message. The fake sockets don't do network I/O, so this measures
+serialization, fan-out, and (for cross-process backends) the transport.
+For 'unix', a broker runs in a thread, and the sockets are split between
+2 channel layers, like 2 worker processes.
+'postgres' is only run if DATABASE_URL is a Postgres database.
+'''
+import asyncio
+import os
+import tempfile
+import time
+
+from otree.benchmarks import percentile, print_table
+from otree.channels.layers import (
+    ChannelBroker,
+    InMemoryChannelLayer,
+    PostgresChannelLayer,
+    UnixSocketChannelLayer,
+)
+from otree.database import engine
+
+GROUP = 'bench-group'
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--sockets', type=int, nargs='+', default=[10, 100, 1000],
+    )
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument(
+        '--payload-bytes', type=int, default=200, help='Approximate message size'
+    )
+
+
+class FakeSocket:
+    def __init__(self, counter):
+        self.counter = counter
+
+    async def send_text(self, text):
+        self.counter.received()
+
+
+class DeliveryCounter:
+    def __init__(self, expected):
+        self.expected = expected
+        self.num_received = 0
+        self.done = None
+
+    def reset(self):
+        self.num_received = 0
+        self.done = asyncio.get_event_loop().create_future()
+
+    def received(self):
+        self.num_received += 1
+        if self.num_received == self.expected:
+            self.done.set_result(None)
+
+
+async def make_layers(backend, tmpdir):
+    if backend == 'memory':
+        layer = InMemoryChannelLayer()
+        return [layer]
+    if backend == 'unix':
+        path = os.path.join(tmpdir, f'channels-{time.time_ns()}.sock')
+        ChannelBroker(path).start_in_thread()
+        layers = [UnixSocketChannelLayer(path), UnixSocketChannelLayer(path)]
+    else:
+        layers = [PostgresChannelLayer(), PostgresChannelLayer()]
+    for layer in layers:
+        await layer.start()
+    return layers
+
+
+async def measure(backend, num_sockets, messages, payload_bytes, tmpdir):
+    layers = await make_layers(backend, tmpdir)
+    counter = DeliveryCounter(expected=num_sockets)
+    for i in range(num_sockets):
+        layers[i % len(layers)].add(GROUP, FakeSocket(counter))
+    data = dict(type='bench', text='x' * payload_bytes)
+
+    latencies = []
+    for _ in range(messages):
+        counter.reset()
+        start = time.perf_counter()
+        await layers[0].send(GROUP, data)
+        await counter.done
+        latencies.append(time.perf_counter() - start)
+    return sorted(latencies)
+
+
+def run(*, sockets, messages, payload_bytes):
+    backends = ['memory', 'unix']
+    if engine.name == 'postgresql':
+        backends.append('postgres')
+    rows = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for backend in backends:
+            for num_sockets in sockets:
+                latencies = asyncio.run(
+                    measure(backend, num_sockets, messages, payload_bytes, tmpdir)
+                )
+                rows.append(
+                    [
+                        backend,
+                        num_sockets,
+                        *[
+                            '{:.2f}'.format(v * 1000)
+                            for v in [
+                                percentile(latencies, 50),
+                                percentile(latencies, 99),
+                                latencies[-1],
+                            ]
+                        ],
+                    ]
+                )
+    print_table(['backend', 'sockets', 'p50 ms', 'p99 ms', 'max ms'], rows)
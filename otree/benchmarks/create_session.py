@@ -0,0 +1,85 @@
+'''
+Time and peak memory of creating a session.
+
+Runs create_session() (including creating_session) for each combination of
+number of participants and number of rounds.
+The number of rounds of every app in the session config is temporarily set to --rounds.
+Peak memory is measured with tracemalloc in a separate run, since tracing slows it down.
+'''
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from otree.benchmarks import print_table
+from otree.common import get_constants
+from otree.database import db, session_scope
+from otree.session import SESSION_CONFIGS_DICT, create_session
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--session-config',
+        help='Name of a session config (default: the first one in settings.py)',
+    )
+    parser.add_argument('--participants', type=int, nargs='+', default=[120, 1200])
+    parser.add_argument('--rounds', type=int, nargs='+', default=[1, 10, 50])
+
+
+@contextmanager
+def num_rounds_set_to(app_sequence, num_rounds):
+    originals = []
+    for app_name in app_sequence:
+        Constants = get_constants(app_name)
+        attr = 'NUM_ROUNDS' if Constants.__name__ == 'C' else 'num_rounds'
+        originals.append((Constants, attr, getattr(Constants, attr)))
+        # bypass the read-only check of BaseConstantsMeta
+        type.__setattr__(Constants, attr, num_rounds)
+    try:
+        yield
+    finally:
+        for Constants, attr, value in originals:
+            type.__setattr__(Constants, attr, value)
+
+
+def create_and_delete(session_config_name, num_participants):
+    with session_scope():
+        start = time.perf_counter()
+        session = create_session(
+            session_config_name, num_participants=num_participants
+        )
+        elapsed = time.perf_counter() - start
+        db.delete(session)
+    return elapsed
+
+
+def measure_peak_memory(session_config_name, num_participants):
+    tracemalloc.start()
+    try:
+        create_and_delete(session_config_name, num_participants)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def run(*, session_config, participants, rounds):
+    session_config_name = session_config or next(iter(SESSION_CONFIGS_DICT))
+    app_sequence = SESSION_CONFIGS_DICT[session_config_name]['app_sequence']
+    rows = []
+    for num_participants in participants:
+        for num_rounds in rounds:
+            with num_rounds_set_to(app_sequence, num_rounds):
+                elapsed = create_and_delete(session_config_name, num_participants)
+                peak = measure_peak_memory(session_config_name, num_participants)
+            rows.append(
+                [
+                    num_participants,
+                    num_rounds,
+                    num_participants * num_rounds * len(app_sequence),
+                    '{:.2f}'.format(elapsed),
+                    '{:.1f}'.format(peak / 1e6),
+                ]
+            )
+    print_table(
+        ['participants', 'rounds', 'players', 'seconds', 'peak MB'], rows,
+    )
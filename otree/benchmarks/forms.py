@@ -0,0 +1,92 @@
+'''
+Construction time of page forms, with and without the cached form classes.
+
+Creates a session and, for each page in its apps that has form_fields
+(e.g. a questionnaire page with 30 fields), builds the page's form
+--repeat times: once rebuilding the form class each time (as if the cache were empty),
+and once reusing the cached form class, where only the fields
+with *_choices/*_min/*_max methods are built again.
+Pages with get_form_fields are skipped, since their fields depend on the player.
+'''
+import time
+
+import otree.forms.forms
+from otree.benchmarks import percentile, print_table
+from otree.common import get_models_module, get_pages_module
+from otree.database import session_scope
+from otree.forms.forms import get_form
+from otree.session import SESSION_CONFIGS_DICT, create_session
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--session-config',
+        help='Name of a session config (default: the first one in settings.py)',
+    )
+    parser.add_argument('--repeat', type=int, default=500)
+
+
+def get_form_pages(app_sequence):
+    for app_name in app_sequence:
+        models_module = get_models_module(app_name)
+        for PageClass in get_pages_module(app_name).page_sequence:
+            if getattr(PageClass, 'form_fields', None) and not hasattr(
+                PageClass, 'get_form_fields'
+            ):
+                yield models_module, PageClass
+
+
+def get_instance(models_module, PageClass, session):
+    Player = models_module.Player
+    player = Player.objects_filter(session=session).order_by('id').first()
+    form_model = PageClass.form_model
+    if form_model in ['player', Player]:
+        return player
+    if form_model in ['group', models_module.Group]:
+        return player.group
+
+
+def time_get_form(instance, field_names, repeat, clear_cache):
+    durations = []
+    for _ in range(repeat):
+        if clear_cache:
+            otree.forms.forms._form_classes.clear()
+        start = time.perf_counter()
+        get_form(instance, field_names=field_names, view=None, formdata=None)
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    return durations
+
+
+def run(*, session_config, repeat):
+    # sets up the page classes, as on server startup
+    from otree.urls import get_urlpatterns
+
+    get_urlpatterns()
+
+    session_config_name = session_config or next(iter(SESSION_CONFIGS_DICT))
+    app_sequence = SESSION_CONFIGS_DICT[session_config_name]['app_sequence']
+    rows = []
+    with session_scope():
+        session = create_session(
+            session_config_name,
+            num_participants=SESSION_CONFIGS_DICT[session_config_name][
+                'num_demo_participants'
+            ],
+        )
+        for models_module, PageClass in get_form_pages(app_sequence):
+            instance = get_instance(models_module, PageClass, session)
+            if instance is None:
+                continue
+            field_names = list(PageClass.form_fields)
+            for label, clear_cache in [['uncached', True], ['cached', False]]:
+                durations = time_get_form(instance, field_names, repeat, clear_cache)
+                rows.append(
+                    [PageClass.__name__, len(field_names), label]
+                    + [
+                        '{:.3f}'.format(percentile(durations, pct) * 1000)
+                        for pct in [50, 99]
+                    ]
+                )
+        otree.forms.forms._form_classes.clear()
+    print_table(['page', 'fields', 'form class', 'p50 ms', 'p99 ms'], rows)
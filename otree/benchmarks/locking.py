@@ -0,0 +1,120 @@
+'''
+Request latency under global vs. granular locking.
+
+Simulated participants send requests at random intervals.
+Each request holds its lock while doing blocking work in the threadpool
+(standing in for DB queries and user code such as vars_for_template),
+the same way a page request does. Every few requests is a wait page,
+which also takes the group's lock.
+The work is simulated because SQLite can't run concurrent transactions,
+so this measures the locking scheme itself rather than a particular DB.
+'''
+import asyncio
+import random
+import time
+
+from starlette.concurrency import run_in_threadpool
+
+from otree.benchmarks import percentile, print_table
+from otree.locks import RequestLocks, KeyedThreadLock, participant_lock_key
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--participants',
+        type=int,
+        nargs='+',
+        default=[100, 500, 1000],
+        help='Number of simulated participants (can give several)',
+    )
+    parser.add_argument('--requests', type=int, default=5, help='Per participant')
+    parser.add_argument(
+        '--think',
+        type=float,
+        default=1.0,
+        help='Mean seconds between a participant\'s requests',
+    )
+    parser.add_argument(
+        '--work', type=float, default=2.0, help='Milliseconds of work per request'
+    )
+    parser.add_argument('--players-per-group', type=int, default=3)
+    parser.add_argument(
+        '--wait-page-every',
+        type=int,
+        default=3,
+        help='Every Nth request of a participant is a wait page',
+    )
+    parser.add_argument('--seed', type=int, default=0)
+
+
+async def simulate(
+    *,
+    granular,
+    num_participants,
+    requests,
+    think,
+    work,
+    players_per_group,
+    wait_page_every,
+    seed,
+):
+    request_locks = RequestLocks(granular=granular, global_lock=asyncio.Lock())
+    group_locks = KeyedThreadLock()
+    rng = random.Random(seed)
+    work_seconds = work / 1000
+    latencies = []
+
+    def do_work(group_key):
+        if group_key is None:
+            time.sleep(work_seconds)
+        else:
+            with group_locks.hold(group_key):
+                time.sleep(work_seconds)
+
+    async def participant(id_in_session):
+        code = f'p{id_in_session}'
+        group_key = ('wait_page', id_in_session // players_per_group)
+        delays = [rng.expovariate(1 / think) for _ in range(requests)]
+        for i, delay in enumerate(delays, start=1):
+            await asyncio.sleep(delay)
+            is_wait_page = i % wait_page_every == 0
+            start = time.perf_counter()
+            async with request_locks.hold(participant_lock_key(code)):
+                await run_in_threadpool(do_work, group_key if is_wait_page else None)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[participant(i) for i in range(num_participants)])
+    elapsed = time.perf_counter() - start
+    return sorted(latencies), elapsed
+
+
+def run(*, participants, **options):
+    rows = []
+    for num_participants in participants:
+        for granular in [False, True]:
+            latencies, elapsed = asyncio.run(
+                simulate(
+                    granular=granular, num_participants=num_participants, **options
+                )
+            )
+            rows.append(
+                [
+                    num_participants,
+                    'granular' if granular else 'global',
+                    len(latencies),
+                    round(len(latencies) / elapsed),
+                    *[
+                        '{:.1f}'.format(v * 1000)
+                        for v in [
+                            percentile(latencies, 50),
+                            percentile(latencies, 99),
+                            latencies[-1],
+                        ]
+                    ],
+                ]
+            )
+    print_table(
+        ['participants', 'locking', 'requests', 'req/s', 'p50 ms', 'p99 ms', 'max ms'],
+        rows,
+    )
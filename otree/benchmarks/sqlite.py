@@ -0,0 +1,103 @@
+'''
+Commits per second on a SQLite file, with each OTREE_SQLITE_PROFILE.
+
+Creates a session, copies it to a new SQLite file for each profile,
+and has the participants take turns going through --pages pages.
+Each page is 2 requests, each with its own commit, like in prodserver:
+loading the page (which updates the participant's current page and timestamp)
+and submitting it (which updates a player field and the participant's page index).
+"otree bench" uses an in-memory DB, so the file is a temporary copy, not db.sqlite3.
+'''
+import os
+import sqlite3
+import tempfile
+import time
+
+import sqlalchemy.pool
+from sqlalchemy import create_engine, event
+
+from otree.benchmarks import print_table
+from otree.common import get_models_module
+from otree.database import (
+    SQLITE_PROFILES,
+    db,
+    session_scope,
+    set_sqlite_pragmas,
+    sqlite_mem_conn,
+)
+from otree.models import Participant
+from otree.session import SESSION_CONFIGS_DICT, create_session
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--session-config',
+        help='Name of a session config (default: the first one in settings.py)',
+    )
+    parser.add_argument('--participants', type=int, default=30)
+    parser.add_argument('--pages', type=int, default=20, help='Pages per participant')
+
+
+def make_engine(path, profile):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    # same as otree.database.get_engine
+    engine = create_engine(
+        'sqlite://', creator=lambda: conn, poolclass=sqlalchemy.pool.StaticPool
+    )
+    event.listen(engine, 'connect', lambda c, _: set_sqlite_pragmas(c, profile))
+    return engine
+
+
+def load_page(engine, code):
+    with db.private_session(bind=engine):
+        participant = Participant.objects_get(code=code)
+        participant._current_page_name = 'Page'
+        participant._last_request_timestamp = int(time.time())
+
+
+def submit_page(engine, code, Player, round_number):
+    with db.private_session(bind=engine):
+        participant = Participant.objects_get(code=code)
+        player = Player.objects_get(participant=participant, round_number=round_number)
+        player.payoff += 1
+        participant._index_in_pages += 1
+        participant._last_page_timestamp = int(time.time())
+
+
+def run(*, session_config, participants, pages):
+    session_config_name = session_config or next(iter(SESSION_CONFIGS_DICT))
+    app_name = SESSION_CONFIGS_DICT[session_config_name]['app_sequence'][0]
+    Player = get_models_module(app_name).Player
+    with session_scope():
+        session = create_session(session_config_name, num_participants=participants)
+        codes = [p.code for p in session.get_participants()]
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for profile in SQLITE_PROFILES:
+            path = os.path.join(tmpdir, f'{profile}.sqlite3')
+            disk_conn = sqlite3.connect(path)
+            sqlite_mem_conn.backup(disk_conn)
+            disk_conn.close()
+            engine = make_engine(path, profile)
+            num_commits = 0
+            start = time.perf_counter()
+            for _ in range(pages):
+                for code in codes:
+                    load_page(engine, code)
+                    submit_page(engine, code, Player, round_number=1)
+                    num_commits += 2
+            elapsed = time.perf_counter() - start
+            journal_mode = engine.execute('PRAGMA journal_mode').scalar()
+            engine.dispose()
+            rows.append(
+                [
+                    profile,
+                    journal_mode,
+                    num_commits,
+                    '{:.2f}'.format(elapsed),
+                    '{:.0f}'.format(num_commits / elapsed),
+                ]
+            )
+    print(f'{session_config_name}, {participants} participants x {pages} pages')
+    print_table(['profile', 'journal', 'commits', 'seconds', 'commits/s'], rows)
@@ -0,0 +1,171 @@
+'''
+Render time of templates: node tree vs. compiled Python code.
+
+Renders each template in otree/templates, plus a page with a big {% for %} loop.
+The bundled templates are rendered with placeholder values for all variables,
+and templates that can't be rendered that way (e.g. because they need a form) are skipped.
+Also checks that both ways of rendering give identical output.
+'''
+import logging
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import otree
+from otree.benchmarks import print_table
+from otree.currency import Currency
+from otree.templating import context as template_context
+from otree.templating import ibis_loader
+from otree.templating import template as template_module
+from otree.templating.errors import TemplateError
+from otree.templating.template import Template
+
+
+class Placeholder:
+    '''stands in for any variable, attribute or item'''
+
+    num_items = 3
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return Placeholder()
+
+    def __getitem__(self, key):
+        return Placeholder()
+
+    def __iter__(self):
+        return iter([Placeholder() for _ in range(self.num_items)])
+
+    def __call__(self, *args):
+        return None
+
+    def __len__(self):
+        return self.num_items
+
+    def __str__(self):
+        return 'x'
+
+
+class PlaceholderDict(dict):
+    # so that these are still found in the lower levels of the context
+    builtin_names = {'context', 'is_defined', *template_context.builtins}
+
+    def __contains__(self, key):
+        return super().__contains__(key) or key not in self.builtin_names
+
+    def __missing__(self, key):
+        return Placeholder()
+
+
+LOOP_TEMPLATE = '''
+{% block content %}
+<table class="table">
+    {% for p in players %}
+    <tr>
+        <td>{{ forloop.counter }}</td>
+        <td>{{ p.id_in_group }}</td>
+        <td>{{ p.participant.label or p.participant.code }}</td>
+        <td>{{ p.contribution }}</td>
+        <td>{{ p.payoff|to2 }}</td>
+        <td>{% if p.id_in_group == my_id %}You{% elif p.payoff > 50 %}High{% else %}-{% endif %}</td>
+    </tr>
+    {% endfor %}
+</table>
+{% endblock %}
+'''
+
+
+def add_arguments(parser):
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument(
+        '--players', type=int, default=500, help='Number of rows in the loop template'
+    )
+
+
+def get_bundled_templates():
+    root = Path(otree.__file__).parent.joinpath('templates')
+    return sorted(path.relative_to(root).as_posix() for path in root.rglob('*.html'))
+
+
+def make_players(num_players):
+    return [
+        SimpleNamespace(
+            id_in_group=i,
+            participant=SimpleNamespace(label=None, code=f'code{i}'),
+            contribution=Currency(i % 100),
+            payoff=Currency(i % 100 + 0.5),
+        )
+        for i in range(1, num_players + 1)
+    ]
+
+
+def render(template, data, compiled):
+    template_module.COMPILE_TEMPLATES = compiled
+    return template.render(data)
+
+
+def time_render(template, data, compiled, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        render(template, data, compiled)
+    return (time.perf_counter() - start) / repeat
+
+
+def run(*, repeat, players):
+    cases = []
+    for name in get_bundled_templates():
+        data = PlaceholderDict(js_vars=None)
+        cases.append((name, lambda name=name: ibis_loader.load(name), data))
+    loop_data = PlaceholderDict(js_vars=None, players=make_players(players), my_id=1)
+    cases.append(
+        (
+            f'{players}-row loop page',
+            lambda: Template(LOOP_TEMPLATE, 'loop.html', template_type='Page'),
+            loop_data,
+        )
+    )
+
+    rows = []
+    skipped = []
+    total_tree = total_compiled = 0
+    original_setting = template_module.COMPILE_TEMPLATES
+    # errors in {% if %} conditions are logged, but here they just mean a template is skipped.
+    logging.getLogger('otree.templating.nodes').disabled = True
+    try:
+        for name, load, data in cases:
+            try:
+                template = load()
+                expected = render(template, data, compiled=False)
+            except TemplateError:
+                skipped.append(name)
+                continue
+            # this also compiles it, so that compiling is not included in the time
+            output = render(template, data, compiled=True)
+            tree = time_render(template, data, False, repeat)
+            compiled = time_render(template, data, True, repeat)
+            total_tree += tree
+            total_compiled += compiled
+            rows.append(
+                [
+                    name,
+                    '{:.3f}'.format(tree * 1000),
+                    '{:.3f}'.format(compiled * 1000),
+                    '{:.1f}x'.format(tree / compiled),
+                    'yes' if output == expected else 'NO',
+                ]
+            )
+    finally:
+        template_module.COMPILE_TEMPLATES = original_setting
+    rows.append(
+        [
+            'total',
+            '{:.3f}'.format(total_tree * 1000),
+            '{:.3f}'.format(total_compiled * 1000),
+            '{:.1f}x'.format(total_tree / total_compiled),
+            '',
+        ]
+    )
+    print_table(['template', 'tree ms', 'compiled ms', 'speedup', 'identical'], rows)
+    if skipped:
+        print(f'Skipped {len(skipped)} templates that need real data:', ', '.join(skipped))
@@ -0,0 +1,94 @@
+'''
+How late page timeouts fire: in-process scheduler vs. polling.
+
+Timers are set to expire at random times over a few seconds,
+with some expiring at the same moment (like a group that started a page together).
+'scheduler' is the heap-based Scheduler that the server uses.
+'poll' checks for due timers every --poll-interval seconds,
+like the old timeout worker process did.
+This measures scheduling only; running the actual tasks is not included.
+'''
+import asyncio
+import random
+import time
+
+from otree.benchmarks import percentile, print_table
+from otree.tasks import Scheduler
+
+
+def add_arguments(parser):
+    parser.add_argument('--timers', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument(
+        '--spread', type=float, default=5.0, help='Seconds over which timers expire'
+    )
+    parser.add_argument(
+        '--per-instant',
+        type=int,
+        default=3,
+        help='Number of timers that expire at the same moment',
+    )
+    parser.add_argument('--poll-interval', type=float, default=3.0)
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def make_due_times(num_timers, spread, per_instant, seed):
+    rng = random.Random(seed)
+    start = time.time() + 0.1
+    due_times = []
+    while len(due_times) < num_timers:
+        due_times.extend([start + rng.uniform(0, spread)] * per_instant)
+    return sorted(due_times[:num_timers])
+
+
+async def run_scheduler(due_times, poll_interval):
+    lateness = []
+    done = asyncio.get_event_loop().create_future()
+
+    def callback(fired):
+        now = time.time()
+        for epoch_time in fired:
+            # the scheduler dedupes equal times, so count each timer
+            lateness.extend([now - epoch_time] * due_times.count(epoch_time))
+        if len(lateness) == len(due_times):
+            done.set_result(None)
+
+    scheduler = Scheduler(callback)
+    scheduler.start()
+    for epoch_time in due_times:
+        scheduler.schedule(epoch_time)
+    await done
+    return lateness
+
+
+async def run_poll(due_times, poll_interval):
+    lateness = []
+    pending = list(due_times)
+    while pending:
+        await asyncio.sleep(poll_interval)
+        now = time.time()
+        lateness.extend(now - t for t in pending if t <= now)
+        pending = [t for t in pending if t > now]
+    return lateness
+
+
+def run(*, timers, spread, per_instant, poll_interval, seed):
+    rows = []
+    for num_timers in timers:
+        for name, func in [('scheduler', run_scheduler), ('poll', run_poll)]:
+            due_times = make_due_times(num_timers, spread, per_instant, seed)
+            lateness = sorted(asyncio.run(func(due_times, poll_interval)))
+            rows.append(
+                [
+                    num_timers,
+                    name,
+                    *[
+                        '{:.1f}'.format(v * 1000)
+                        for v in [
+                            percentile(lateness, 50),
+                            percentile(lateness, 99),
+                            lateness[-1],
+                        ]
+                    ],
+                ]
+            )
+    print_table(['timers', 'method', 'p50 ms', 'p99 ms', 'max ms'], rows)
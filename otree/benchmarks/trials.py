@@ -0,0 +1,173 @@
+'''
+Round-trip time of trial messages (otree.trial), from the message to the reply.
+
+Creates a session with --participants participants, puts them on the first page
+that has a trial_model, and has them take turns responding to their current trial
+until all trials are done, as if each participant had a trial socket open.
+With trial_response_fields, a response has a made-up value for each field;
+with evaluate_trial, it's --response.
+Reports the time of page loads and responses, and checks that all responses
+were saved to the DB.
+'''
+import asyncio
+import json
+import time
+
+import otree.trial
+from otree.common import get_models_module, get_pages_module
+from otree.benchmarks import percentile, print_table
+from otree.database import db, session_scope
+from otree.locks import participant_lock_key, request_locks
+from otree.lookup import page_index_cache
+from otree.models import Session
+from otree.session import SESSION_CONFIGS_DICT, create_session
+
+PLACEHOLDER_VALUES = {int: 1, float: 0.5, str: 'x', bool: True}
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--session-config',
+        help='Name of a session config (default: the first one that has a trial page)',
+    )
+    parser.add_argument('--participants', type=int, default=10)
+    parser.add_argument(
+        '--response',
+        type=json.loads,
+        default={},
+        help='JSON response to send to evaluate_trial',
+    )
+
+
+def find_trial_page(session):
+    index = page_index_cache.get(session.code)
+    for idx in range(1, index.size + 1):
+        lookup = index[idx]
+        if getattr(lookup.page_class, 'trial_model', None):
+            return idx, lookup
+
+
+def make_response(PageClass):
+    columns = PageClass.trial_model.__table__.columns
+    return {
+        name: PLACEHOLDER_VALUES.get(columns[name].type.python_type)
+        for name in PageClass.trial_response_fields
+    }
+
+
+def has_trial_page(config_name):
+    # the session configs don't say which pages have trials,
+    # so we have to look at the page classes.
+    for app_name in SESSION_CONFIGS_DICT[config_name]['app_sequence']:
+        for PageClass in get_pages_module(app_name).page_sequence:
+            if getattr(PageClass, 'trial_model', None):
+                return True
+    return False
+
+
+async def send(participant_code, page_name, msg, replies, durations):
+    start = time.perf_counter()
+    # same as TrialConsumer
+    async with request_locks.hold(participant_lock_key(participant_code)) as connection:
+        with session_scope(bind=connection):
+            await otree.trial.trial_payload_function(participant_code, page_name, msg)
+    durations.append(time.perf_counter() - start)
+    return replies.pop(participant_code)
+
+
+async def run_participants(participant_codes, PageClass, response):
+    replies = {}
+
+    async def capture_reply(pcode, page_index, resp):
+        replies[pcode] = resp
+
+    original_send_back = otree.trial._send_back
+    otree.trial._send_back = capture_reply
+    page_name = PageClass.__name__
+    load_durations = []
+    response_durations = []
+    try:
+        current_trials = {}
+        for code in participant_codes:
+            reply = await send(
+                code, page_name, dict(type='load'), replies, load_durations
+            )
+            current_trials[code] = reply['trial']
+        start = time.perf_counter()
+        while current_trials:
+            for code, trial in list(current_trials.items()):
+                if not trial:
+                    del current_trials[code]
+                    continue
+                msg = dict(type='response', trial_id=trial['id'], response=response)
+                reply = await send(
+                    code, page_name, msg, replies, response_durations
+                )
+                current_trials[code] = reply['trial']
+        total_time = time.perf_counter() - start
+        # let any delayed writes finish
+        await asyncio.sleep(otree.trial.WRITE_DELAY + 0.1)
+    finally:
+        otree.trial._send_back = original_send_back
+    return load_durations, response_durations, total_time
+
+
+def run(*, session_config, participants, response):
+    # sets up the page classes, as on server startup
+    from otree.urls import get_urlpatterns
+
+    get_urlpatterns()
+
+    session_config_name = session_config or next(
+        name for name in SESSION_CONFIGS_DICT if has_trial_page(name)
+    )
+    with session_scope():
+        session = create_session(session_config_name, num_participants=participants)
+        session_code = session.code
+        page_index, lookup = find_trial_page(session)
+        PageClass = lookup.page_class
+        Player = get_models_module(lookup.app_name).Player
+        player_ids = [
+            p.id
+            for p in Player.objects_filter(
+                session=session, round_number=lookup.round_number
+            )
+        ]
+        participant_codes = []
+        for p in session.get_participants():
+            p._index_in_pages = page_index
+            participant_codes.append(p.code)
+    if not hasattr(PageClass, 'evaluate_trial'):
+        response = make_response(PageClass)
+
+    load_durations, response_durations, total_time = asyncio.run(
+        run_participants(participant_codes, PageClass, response)
+    )
+
+    Trial = PageClass.trial_model
+    with session_scope():
+        remaining = Trial.objects_filter(
+            Trial.queue_position != None, Trial.player_id.in_(player_ids)
+        ).count()
+        db.delete(Session.objects_get(code=session_code))
+
+    rows = []
+    for msg_type, durations in [
+        ['load', load_durations],
+        ['response', response_durations],
+    ]:
+        durations.sort()
+        rows.append(
+            [msg_type, len(durations)]
+            + [
+                '{:.2f}'.format(percentile(durations, pct) * 1000)
+                for pct in [50, 99, 100]
+            ]
+        )
+    print(f'{PageClass.__name__}, {participants} participants')
+    print_table(['message', 'count', 'p50 ms', 'p99 ms', 'max ms'], rows)
+    print(
+        'responses per second: {:.0f}'.format(len(response_durations) / total_time)
+    )
+    if remaining:
+        print(f'ERROR: {remaining} trials were not saved as completed')
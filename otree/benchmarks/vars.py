@@ -0,0 +1,100 @@
+'''
+Commit cost of requests that use a large participant.vars.
+
+Creates a session, fills each participant's vars with --keys entries,
+then runs requests that load a participant and either only read vars,
+modify a nested value in place, or set a top-level key, and commit.
+Reports the time per request, the number of UPDATEs of the participant table,
+and the size of the stored vars.
+'''
+import time
+
+from sqlalchemy import event
+
+from otree.benchmarks import print_table
+from otree.database import db, engine, session_scope, _dump_vars
+from otree.models import Participant
+from otree.session import SESSION_CONFIGS_DICT, create_session
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--session-config',
+        help='Name of a session config (default: the first one in settings.py)',
+    )
+    parser.add_argument('--participants', type=int, default=30)
+    parser.add_argument(
+        '--keys', type=int, nargs='+', default=[10, 1000, 10000], help='Size of vars'
+    )
+    parser.add_argument('--requests', type=int, default=200)
+
+
+def make_vars(num_keys):
+    return {
+        f'item{i}': dict(choices=[i, i * 2, i * 3], label=f'Item {i}', done=False)
+        for i in range(num_keys)
+    }
+
+
+def read_only(participant, i):
+    participant.vars.get('item0')
+
+
+def modify_nested(participant, i):
+    participant.vars['item0']['choices'].append(i)
+
+
+def set_key(participant, i):
+    participant.vars['last_request'] = i
+
+
+ACTIONS = [('read only', read_only), ('modify nested', modify_nested), ('set key', set_key)]
+
+
+def time_requests(participant_ids, action, num_requests):
+    start = time.perf_counter()
+    for i in range(num_requests):
+        with session_scope():
+            participant = Participant.objects_get(id=participant_ids[i % len(participant_ids)])
+            action(participant, i)
+    return (time.perf_counter() - start) / num_requests
+
+
+def run(*, session_config, participants, keys, requests):
+    session_config_name = session_config or next(iter(SESSION_CONFIGS_DICT))
+    num_updates = 0
+
+    def count_updates(conn, cursor, statement, *args):
+        nonlocal num_updates
+        if statement.startswith('UPDATE otree_participant'):
+            num_updates += 1
+
+    event.listen(engine, 'before_cursor_execute', count_updates)
+    rows = []
+    try:
+        for num_keys in keys:
+            with session_scope():
+                session = create_session(
+                    session_config_name, num_participants=participants
+                )
+                for p in session.get_participants():
+                    p.vars.update(make_vars(num_keys))
+                participant_ids = [p.id for p in session.get_participants()]
+            size = len(_dump_vars(make_vars(num_keys)))
+            for name, action in ACTIONS:
+                num_updates = 0
+                elapsed = time_requests(participant_ids, action, requests)
+                rows.append(
+                    [
+                        num_keys,
+                        '{:.0f}'.format(size / 1000),
+                        name,
+                        '{:.2f}'.format(elapsed * 1000),
+                        num_updates,
+                    ]
+                )
+            with session_scope():
+                db.delete(Participant.objects_get(id=participant_ids[0]).session)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_updates)
+    print_table(['keys', 'KB', 'request', 'ms/request', 'UPDATEs'], rows)
@@ -1,4 +1,3 @@
-import sys
 from typing import List, Set, Tuple
 import re
 import decimal
@@ -214,20 +213,13 @@ class ParticipantBot:
         return self._client
 
     def load_client(self):
-        # expensive since it requires requests import and dependency.
-        # i think this is only needed for CLI bots
-        # eventually they will move to httpx which is a bit smaller
-        try:
-            import requests
-        except ModuleNotFoundError:
-            sys.exit(
-                'You need to install requests to run bots ("pip3 install requests")'
-            )
-
-        from starlette.testclient import TestClient
+        # only needed for CLI bots.
+        # this calls the app directly, rather than going through requests
+        # like starlette's TestClient.
         from otree.asgi import app
+        from otree.bots.client import AsgiBotClient
 
-        self._client: TestClient = TestClient(app)
+        self._client = AsgiBotClient(app)
 
     def open_start_url(self):
         start_url = common.participant_start_url(self.participant_code)
@@ -354,10 +346,16 @@ class ParticipantBot:
         self.path = urlsplit(self.url).path
 
         self._response = response
-        self.html = response.content.decode('utf-8')
+        # normalized lazily, since most responses are never inspected
+        # (e.g. wait pages, or if check_html is off)
+        self._html = None
 
     @property
     def html(self):
+        if self._html is None:
+            self._html = HtmlString(
+                normalize_html_whitespace(self._response.content.decode('utf-8'))
+            )
         return self._html
 
     @html.setter
@@ -0,0 +1,135 @@
+"""
+A minimal HTTP client for CLI bots, that calls the ASGI app directly.
+It has the subset of the TestClient API that bots use,
+but doesn't go through requests (prepared requests, transport adapters,
+urllib3 response objects), so CLI bots don't need the requests package.
+"""
+import asyncio
+from http.cookies import SimpleCookie
+from urllib.parse import unquote, urlencode, urljoin, urlsplit
+
+from starlette.datastructures import Headers
+
+BASE_URL = 'http://testserver'
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+
+
+class BotResponse:
+    def __init__(self, *, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        # case-insensitive, like requests
+        self.headers: Headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+
+class AsgiBotClient:
+    def __init__(self, app):
+        self.app = app
+        self.cookies = {}
+
+    def get(self, url, allow_redirects=True):
+        return self.request('GET', url, allow_redirects=allow_redirects)
+
+    def post(self, url, data=None, allow_redirects=True):
+        return self.request('POST', url, data=data, allow_redirects=allow_redirects)
+
+    def request(self, method, url, *, data=None, allow_redirects=True):
+        url = urljoin(BASE_URL, url)
+        body = b''
+        if data:
+            # like requests, skip None values and repeat keys for lists
+            pairs = []
+            for key, values in data.items():
+                if isinstance(values, (str, bytes)) or not hasattr(values, '__iter__'):
+                    values = [values]
+                pairs.extend((key, v) for v in values if v is not None)
+            body = urlencode(pairs).encode()
+        response = self._send(method, url, body)
+        while allow_redirects and response.status_code in REDIRECT_STATUSES:
+            url = urljoin(url, response.headers['location'])
+            if response.status_code in (307, 308):
+                response = self._send(method, url, body)
+            else:
+                response = self._send('GET', url, b'')
+        return response
+
+    def _send(self, method, url, body: bytes) -> BotResponse:
+        parts = urlsplit(url)
+        headers = [(b'host', b'testserver'), (b'user-agent', b'testclient')]
+        if body:
+            headers += [
+                (b'content-type', b'application/x-www-form-urlencoded'),
+                (b'content-length', str(len(body)).encode()),
+            ]
+        if self.cookies:
+            cookie = '; '.join(f'{k}={v}' for k, v in self.cookies.items())
+            headers.append((b'cookie', cookie.encode()))
+        scope = {
+            'type': 'http',
+            'http_version': '1.1',
+            'method': method,
+            'path': unquote(parts.path),
+            'root_path': '',
+            'scheme': 'http',
+            'query_string': parts.query.encode(),
+            'headers': headers,
+            'client': ['testclient', 50000],
+            'server': ['testserver', 80],
+        }
+        status_code = None
+        raw_headers = []
+        chunks = []
+        response_complete = asyncio.Event()
+        request_sent = False
+
+        async def receive():
+            nonlocal request_sent
+            if request_sent:
+                await response_complete.wait()
+                return {'type': 'http.disconnect'}
+            request_sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                raw_headers.extend(message['headers'])
+            elif message['type'] == 'http.response.body':
+                chunks.append(message.get('body', b''))
+                if not message.get('more_body', False):
+                    response_complete.set()
+
+        get_event_loop().run_until_complete(self.app(scope, receive, send))
+        assert status_code is not None, 'The app did not send a response.'
+        response_headers = Headers(raw=raw_headers)
+        for value in response_headers.getlist('set-cookie'):
+            self._set_cookie(value)
+        return BotResponse(
+            url=url,
+            status_code=status_code,
+            headers=response_headers,
+            content=b''.join(chunks),
+        )
+
+    def _set_cookie(self, header_value):
+        for name, morsel in SimpleCookie(header_value).items():
+            if morsel['max-age'] == '0':
+                self.cookies.pop(name, None)
+            else:
+                self.cookies[name] = morsel.value
+
+
+def get_event_loop():
+    # same loop as TestClient, so that both can be used in the same process
+    try:
+        return asyncio.get_event_loop()
+    except RuntimeError:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        return loop
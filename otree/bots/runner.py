@@ -1,6 +1,9 @@
+import csv
 import datetime
 import logging
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import List
 
@@ -125,16 +128,125 @@ def run_bots(session_id, case_number=None):
     runner.play()
 
 
-def run_all_bots_for_session_config(session_config_name, num_participants, export_path):
+def run_bot_case(config_name, case_number, num_participants):
+    logger.info("Creating '{}' session (test case {})".format(config_name, case_number))
+
+    session = otree.session.create_session(
+        session_config_name=config_name, num_participants=num_participants
+    )
+    session_code = session.code
+
+    run_bots(session.id, case_number=case_number)
+
+    logger.info('Bots completed session')
+    return session_code
+
+
+def get_export_tables(session_code=None) -> dict:
+    '''CSV file name -> rows'''
+    tables = {}
+    for app in settings.OTREE_APPS:
+        Player = otree.common.get_models_module(app).Player
+        players = Player.objects_filter()
+        if session_code:
+            players = players.join(Session).filter(Session.code == session_code)
+        if players.first():
+            tables[f'{app}.csv'] = list(
+                otree.export.get_rows_for_csv(app, session_code=session_code)
+            )
+    tables['all_apps_wide.csv'] = list(
+        otree.export.get_rows_for_wide_csv(session_code=session_code)
+    )
+    return tables
+
+
+def merge_tables(tables: list) -> list:
+    '''
+    combine CSV tables (lists of rows, where the first row is the header)
+    by column name, since tables from different DBs may have different columns,
+    e.g. a different number of rounds in all_apps_wide.csv.
+    '''
+    header = []
+    for rows in tables:
+        if rows and rows[0]:
+            header.extend(col for col in rows[0] if col not in header)
+    if not header:
+        # same as an export with no data
+        return [[]]
+    merged = [header]
+    for rows in tables:
+        if not (rows and rows[0]):
+            continue
+        for row in rows[1:]:
+            values = dict(zip(rows[0], row))
+            merged.append([values.get(col, '') for col in header])
+    return merged
+
+
+def _init_worker():
+    from otree.main import setup
+
+    setup()
+
+
+def _run_bot_case_in_worker(config_name, case_number, num_participants, export):
+    '''
+    each worker has its own in-memory DB,
+    so the exports are collected here and merged by the parent process.
+    '''
+    session_code = run_bot_case(config_name, case_number, num_participants)
+    if export:
+        return get_export_tables(session_code)
+
+
+def run_bot_cases_in_processes(cases, *, jobs, export):
+    '''
+    cases is a list of (config_name, case_number, num_participants).
+    Returns the export tables of all cases, merged.
+    '''
+    # spawn rather than fork, because a forked process would share
+    # the parent's SQLite connection.
+    mp_context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(
+        max_workers=jobs, mp_context=mp_context, initializer=_init_worker
+    ) as executor:
+        futures = [
+            executor.submit(_run_bot_case_in_worker, *case, export) for case in cases
+        ]
+        results = []
+        try:
+            # in order, so that the export has the same order as with 1 process
+            for future in futures:
+                results.append(future.result())
+        except:
+            # as with 1 process, if 1 case fails, the rest don't get run.
+            for future in futures:
+                future.cancel()
+            raise
+    if not export:
+        return None
+    tables = {}
+    for result in results:
+        for file_name, rows in result.items():
+            tables.setdefault(file_name, []).append(rows)
+    return {file_name: merge_tables(rows) for file_name, rows in tables.items()}
+
+
+def run_all_bots_for_session_config(
+    session_config_name, num_participants, export_path, jobs=1
+):
     """
     this means all test cases are in 1 big test case.
     so if 1 fails, the others will not get run.
+    With jobs > 1, the cases run in that many processes,
+    each with its own in-memory DB.
     """
     if session_config_name:
         session_config_names = [session_config_name]
     else:
         session_config_names = SESSION_CONFIGS_DICT.keys()
 
+    cases = []
     for config_name in session_config_names:
         try:
             config = SESSION_CONFIGS_DICT[config_name]
@@ -145,19 +257,22 @@ def run_all_bots_for_session_config(session_config_name, num_participants, expor
 
         num_bot_cases = config.get_num_bot_cases()
         for case_number in range(num_bot_cases):
-            logger.info(
-                "Creating '{}' session (test case {})".format(config_name, case_number)
-            )
-
-            session = otree.session.create_session(
-                session_config_name=config_name,
-                num_participants=(num_participants or config['num_demo_participants']),
+            cases.append(
+                (
+                    config_name,
+                    case_number,
+                    num_participants or config['num_demo_participants'],
+                )
             )
-            session_id = session.id
 
-            run_bots(session_id, case_number=case_number)
-
-            logger.info('Bots completed session')
+    tables = None
+    if jobs > 1 and len(cases) > 1:
+        tables = run_bot_cases_in_processes(
+            cases, jobs=min(jobs, len(cases)), export=bool(export_path)
+        )
+    else:
+        for case in cases:
+            run_bot_case(*case)
     if export_path:
 
         now = datetime.datetime.now()
@@ -168,15 +283,12 @@ def run_all_bots_for_session_config(session_config_name, num_participants, expor
 
         os.makedirs(export_path, exist_ok=True)
 
-        for app in settings.OTREE_APPS:
-            model_module = otree.common.get_models_module(app)
-            if model_module.Player.objects_exists():
-                fpath = Path(export_path, "{}.csv".format(app))
-                with fpath.open("w", newline='', encoding="utf8") as fp:
-                    otree.export.export_app(app, fp)
-        fpath = Path(export_path, "all_apps_wide.csv")
-        with fpath.open("w", encoding="utf8") as fp:
-            otree.export.export_wide(fp)
+        if tables is None:
+            tables = get_export_tables()
+        for file_name, rows in tables.items():
+            fpath = Path(export_path, file_name)
+            with fpath.open("w", newline='', encoding="utf8") as fp:
+                csv.writer(fp).writerows(rows)
 
         logger.info('Exported CSV to folder "{}"'.format(export_path))
     else:
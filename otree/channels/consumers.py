@@ -1,17 +1,25 @@
+import base64
+import codecs
 import datetime
+import functools
 import datetime
-import io
 import logging
+import queue
+import threading
 import time
 import traceback
 import urllib.parse
+from starlette.concurrency import run_in_threadpool
 from starlette.endpoints import WebSocketEndpoint
 from starlette.websockets import WebSocket
 from starlette.datastructures import FormData
 import otree.bots.browser
+import otree.export_formats as export_formats
 import otree.channels.utils as channel_utils
 import otree.session
+import otree.wait_page_arrivals as wait_page_arrivals
 from otree import settings
+from otree.channels.monitor import monitor_publisher
 from otree.channels.utils import get_chat_group, channel_layer
 from otree.common import (
     get_models_module,
@@ -21,10 +29,17 @@ from otree.common import (
 from otree.currency import json_dumps
 from otree.database import NoResultFound
 from otree.database import db, session_scope
+from otree.database import close_snapshot_bind, get_snapshot_bind
 from otree.database import dbq
-from otree.export import export_wide, export_app, custom_export_app, BOM
-from otree.live import live_payload_function
-from otree.trial import trial_payload_function
+from otree.export import BOM
+from otree.live import (
+    get_live_connection_info,
+    live_dispatcher,
+    live_payload_function,
+    live_queue_key,
+)
+from otree.lookup import page_index_cache
+from otree.trial import forget_cursor, trial_payload_function
 from otree.models import Participant, Session
 from otree.models_concrete import (
     CompletedGroupWaitPage,
@@ -36,7 +51,7 @@ from otree.room import ROOM_DICT, LabelRoom, NoLabelRoom
 from otree.session import SESSION_CONFIGS_DICT
 from otree.views.admin import CreateSessionForm
 from otree.common import CSRF_TOKEN_NAME, AUTH_COOKIE_NAME, AUTH_COOKIE_VALUE
-from otree.middleware import lock2
+from otree.locks import request_locks, participant_lock_key, EXCLUSIVE
 import asyncio
 
 # lock2 = asyncio.Lock()
@@ -82,6 +97,17 @@ class _OTreeAsyncJsonWebsocketConsumer(WebSocketEndpoint):
     def _is_unauthorized(self):
         return
 
+    def lock_key(self, **kwargs):
+        '''
+        Only used with granular locking (see otree.locks).
+        Receives the same kwargs as group_name().
+        By default, the consumer waits until no other request is running.
+        '''
+        return EXCLUSIVE
+
+    def _hold_lock(self):
+        return request_locks.hold(self.lock_key(**self.cleaned_kwargs))
+
     async def on_connect(self, websocket: WebSocket) -> None:
         # patch the instance
         websocket.send = channel_utils.wrap_websocket_send(websocket.send)
@@ -101,8 +127,8 @@ class _OTreeAsyncJsonWebsocketConsumer(WebSocketEndpoint):
             return
 
         self.websocket = websocket
-        async with lock2:
-            with session_scope():
+        async with self._hold_lock() as connection:
+            with session_scope(bind=connection):
                 await self.post_connect(**self.cleaned_kwargs)
         for group in self.groups:
             channel_layer.add(group, websocket)
@@ -111,8 +137,8 @@ class _OTreeAsyncJsonWebsocketConsumer(WebSocketEndpoint):
         pass
 
     async def on_disconnect(self, websocket: WebSocket, close_code: int):
-        async with lock2:
-            with session_scope():
+        async with self._hold_lock() as connection:
+            with session_scope(bind=connection):
                 await self.pre_disconnect(**self.cleaned_kwargs)
         for group in self.groups:
             channel_layer.discard(group, websocket)
@@ -121,8 +147,8 @@ class _OTreeAsyncJsonWebsocketConsumer(WebSocketEndpoint):
         pass
 
     async def on_receive(self, websocket: WebSocket, data):
-        async with lock2:
-            with session_scope():
+        async with self._hold_lock() as connection:
+            with session_scope(bind=connection):
                 await self.post_receive_json(data, **self.cleaned_kwargs)
 
     async def post_receive_json(self, content, **kwargs):
@@ -142,6 +168,10 @@ class BaseWaitPage(_OTreeAsyncJsonWebsocketConsumer):
             kwargs[k] = int(d[k])
         return kwargs
 
+    def lock_key(self, participant_id, **kwargs):
+        # only reads whether the wait page is complete
+        return ('participant_id', participant_id)
+
 
 class WSSubsessionWaitPage(BaseWaitPage):
 
@@ -176,19 +206,37 @@ class WSGroupWaitPage(BaseWaitPage):
 
 
 class LiveConsumer(_OTreeAsyncJsonWebsocketConsumer):
+    # set in post_connect
+    _group_id = None
+    _is_browser_bot = False
+
     def group_name(self, session_code, page_index, participant_code, **kwargs):
         return channel_utils.live_group(session_code, page_index, participant_code)
 
+    def lock_key(self, session_code, page_index, **kwargs):
+        # live methods often modify other players in the group,
+        # so lock the group.
+        return live_queue_key(session_code, page_index, self._group_id)
+
     def clean_kwargs(self):
         return parse_querystring(self.scope['query_string'])
 
-    def browser_bot_exists(self, participant_code):
-        # for browser bots, block liveSend calls that get triggered on page load.
-        # instead, everything must happen through call_live_method in a controlled way.
-        return Participant.objects_exists(code=participant_code, is_browser_bot=True)
+    async def post_connect(self, session_code, page_index, participant_code, **kwargs):
+        info = get_live_connection_info(participant_code, session_code, int(page_index))
+        if info:
+            self._group_id, self._is_browser_bot = info
+
+    async def on_receive(self, websocket: WebSocket, data):
+        # so that the socket can keep receiving messages while the live_method runs.
+        live_dispatcher.enqueue(
+            self.lock_key(**self.cleaned_kwargs),
+            functools.partial(super().on_receive, websocket, data),
+        )
 
     async def post_receive_json(self, content, participant_code, page_name, **kwargs):
-        if self.browser_bot_exists(participant_code):
+        # for browser bots, block liveSend calls that get triggered on page load.
+        # instead, everything must happen through call_live_method in a controlled way.
+        if self._is_browser_bot:
             return
         await live_payload_function(
             participant_code=participant_code, page_name=page_name, payload=content
@@ -203,16 +251,24 @@ class TrialConsumer(_OTreeAsyncJsonWebsocketConsumer):
     def group_name(self, participant_code, page_index, **kwargs):
         return channel_utils.trial_group(participant_code, page_index)
 
+    def lock_key(self, participant_code, **kwargs):
+        return participant_lock_key(participant_code)
+
     def clean_kwargs(self):
         return parse_querystring(self.scope['query_string'])
 
-    def browser_bot_exists(self, participant_code):
-        # for browser bots, block liveSend calls that get triggered on page load.
-        # instead, everything must happen through call_live_method in a controlled way.
-        return Participant.objects_exists(code=participant_code, is_browser_bot=True)
+    async def post_connect(self, participant_code, **kwargs):
+        # checked once here rather than on every message.
+        # for browser bots, block messages that get triggered on page load.
+        self._is_browser_bot = Participant.objects_exists(
+            code=participant_code, is_browser_bot=True
+        )
+
+    async def pre_disconnect(self, participant_code, **kwargs):
+        forget_cursor(participant_code)
 
     async def post_receive_json(self, content, participant_code, page_name, **kwargs):
-        if self.browser_bot_exists(participant_code):
+        if self._is_browser_bot:
             return
         await trial_payload_function(
             participant_code=participant_code, page_name=page_name, msg=content
@@ -242,6 +298,10 @@ class WSGroupByArrivalTime(_OTreeAsyncJsonWebsocketConsumer):
         gn = channel_utils.gbat_group_name(session_pk, page_index)
         return gn
 
+    def lock_key(self, participant_id, **kwargs):
+        # only updates this participant's connected/tab_hidden status
+        return ('participant_id', participant_id)
+
     def is_ready(self, *, app_name, player_id, page_index, session_pk):
         models_module = get_models_module(app_name)
         Player = models_module.Player
@@ -318,6 +378,9 @@ class DetectAutoAdvance(_OTreeAsyncJsonWebsocketConsumer):
     def group_name(self, page_index, participant_code):
         return channel_utils.auto_advance_group(participant_code)
 
+    def lock_key(self, participant_code, **kwargs):
+        return participant_lock_key(participant_code)
+
     def page_should_be_on(self, participant_code):
         try:
             [res] = (
@@ -515,6 +578,9 @@ class WSSessionMonitor(_OTreeAsyncJsonWebsocketConsumer):
         return otree.export.get_rows_for_monitor(participants)
 
     async def post_connect(self, code):
+        # the initial data has the latest values,
+        # so the next update should have full rows.
+        monitor_publisher.forget(code)
         initial_data = self.get_initial_data(code=code)
         await self.send_json(dict(rows=initial_data))
 
@@ -599,6 +665,9 @@ class WSChat(_OTreeAsyncJsonWebsocketConsumer):
     def group_name(self, channel, participant_id):
         return get_chat_group(channel)
 
+    def lock_key(self, channel, participant_id):
+        return ('chat', channel)
+
     def _get_history(self, channel):
         fields = ['nickname', 'body', 'participant_id']
         rows = list(
@@ -644,6 +713,9 @@ class WSDeleteSessions(_OTreeAsyncJsonWebsocketConsumer):
         Session.objects_filter(Session.code.in_(content)).delete(
             synchronize_session=False
         )
+        for code in content:
+            page_index_cache.invalidate(code)
+            wait_page_arrivals.registry.discard(code)
         await self.send_json('ok')
 
     def group_name(self, **kwargs):
@@ -656,9 +728,23 @@ class WSExportData(_OTreeAsyncJsonWebsocketConsumer):
     I load tested this locally with sqlite and:
     - large files up to 22MB (by putting long text in LongStringFields)
     - thousands of participants/rounds, 111000 rows and 20 cols in excel file.
+
+    The file is generated in a background thread with its own DB session,
+    and sent in chunks, so that a big export doesn't hold the lock
+    (blocking all participants) or need to fit in a single websocket message.
+    Messages (all with the link_id from the request):
+    - start: file_name, mime_type, encoding
+    - chunk: seq (0, 1, 2, ...), data, progress (number of bytes so far)
+    - done: num_chunks, num_bytes
+    - error: error
     '''
 
-    async def post_receive_json(self, content: dict):
+    # bytes of the file per chunk (before base64 encoding)
+    chunk_size = 256 * 1024
+    # how many chunks the thread can get ahead of the websocket
+    max_queued_chunks = 8
+
+    async def on_receive(self, websocket: WebSocket, content: dict):
         '''
         if an app name is given, export the app.
         otherwise, export all the data (wide).
@@ -667,35 +753,123 @@ class WSExportData(_OTreeAsyncJsonWebsocketConsumer):
 
         app_name = content.get('app_name')
         is_custom = content.get('is_custom')
+        link_id = content.get('link_id')
 
         iso_date = datetime.date.today().isoformat()
         try:
-            with io.StringIO() as fp:
-                # Excel requires BOM; otherwise non-english characters are garbled
-                if content.get('for_excel'):
-                    fp.write(BOM)
-                if app_name:
-                    if is_custom:
-                        fxn = custom_export_app
-                    else:
-                        fxn = export_app
-                    fxn(app_name, fp)
-                    file_name_prefix = app_name
-                else:
-                    export_wide(fp)
-                    file_name_prefix = 'all_apps_wide'
-                data = fp.getvalue()
-        except Exception:
-            content.update(
-                error="Error exporting data. Check the server logs for details."
-            )
+            fmt = export_formats.resolve_format(content.get('format') or 'csv')
+        except export_formats.ExportFormatError as exc:
+            content.update(type='error', error=str(exc))
             await self.send_json(content)
-            raise
+            return
+        # Excel requires BOM; otherwise non-english characters are garbled
+        prefix = BOM if content.get('for_excel') else ''
+        if app_name:
+            if is_custom:
+                fxn = export_formats.iter_custom_export
+            else:
+                fxn = export_formats.iter_app
+            make_chunks = functools.partial(fxn, fmt, app_name, prefix=prefix)
+            file_name_prefix = app_name
         else:
-            file_name = f'{file_name_prefix}_{iso_date}.csv'
-            content.update(file_name=file_name, data=data, mime_type='text/csv')
-            # note, this doesn't go through channel layer currently
-            await self.send_json(content)
+            make_chunks = functools.partial(export_formats.iter_wide, fmt, prefix=prefix)
+            file_name_prefix = 'all_apps_wide'
+
+        # the lock is only held while we get a consistent view of the DB.
+        async with self._hold_lock():
+            bind = await run_in_threadpool(get_snapshot_bind)
+
+        chunks = queue.Queue(maxsize=self.max_queued_chunks)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._produce_chunks,
+            args=(make_chunks, bind, fmt, chunks, stop),
+            daemon=True,
+        )
+        thread.start()
+        try:
+            await self.send_json(
+                dict(
+                    type='start',
+                    link_id=link_id,
+                    file_name=f'{file_name_prefix}_{iso_date}.{fmt}',
+                    mime_type=export_formats.MIME_TYPES[fmt],
+                    # binary files can't go in JSON directly
+                    encoding='text' if fmt == 'csv' else 'base64',
+                )
+            )
+            seq = 0
+            num_bytes = 0
+            while True:
+                item = await run_in_threadpool(chunks.get)
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    await self.send_json(
+                        dict(
+                            type='error',
+                            link_id=link_id,
+                            error="Error exporting data. Check the server logs for details.",
+                        )
+                    )
+                    raise item
+                data, size = item
+                num_bytes += size
+                # note, this doesn't go through channel layer currently
+                await self.send_json(
+                    dict(
+                        type='chunk',
+                        link_id=link_id,
+                        seq=seq,
+                        data=data,
+                        progress=num_bytes,
+                    )
+                )
+                seq += 1
+            await self.send_json(
+                dict(type='done', link_id=link_id, num_chunks=seq, num_bytes=num_bytes)
+            )
+        finally:
+            # e.g. if the browser disconnected
+            stop.set()
+
+    def _produce_chunks(self, make_chunks, bind, fmt, chunks: queue.Queue, stop):
+        '''runs in the background thread'''
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        if fmt == 'csv':
+            # a chunk boundary can be in the middle of a multi-byte character
+            decode = codecs.getincrementaldecoder('utf8')().decode
+        else:
+            # each chunk is encoded on its own, and the browser joins the decoded bytes.
+            def decode(data, final=False):
+                return base64.b64encode(data).decode('ascii')
+
+        try:
+            with db.private_session(bind=bind):
+                buf = bytearray()
+                for chunk in make_chunks():
+                    buf += chunk
+                    while len(buf) >= self.chunk_size:
+                        data = bytes(buf[: self.chunk_size])
+                        del buf[: self.chunk_size]
+                        if not put((decode(data), len(data))):
+                            return
+                if not put((decode(bytes(buf), final=True), len(buf))):
+                    return
+            put(None)
+        except Exception as exc:
+            put(exc)
+        finally:
+            close_snapshot_bind(bind)
 
     def group_name(self, **kwargs):
         return None
@@ -0,0 +1,488 @@
+"""
+A channel layer delivers messages to groups of websockets
+(wait pages, live pages, the session monitor, etc).
+
+With a single server process, everything happens in memory.
+With several worker processes (prodserver --workers), a websocket may be connected
+to a different process than the one sending the message.
+So the message is published to a transport that all processes subscribe to,
+and each process delivers it to its own sockets:
+- 'unix': a broker on a Unix socket, run by the prodserver parent process
+- 'postgres': Postgres LISTEN/NOTIFY
+
+Messages are serialized once per send (not once per socket),
+and sent to a group's sockets concurrently.
+send_soon() doesn't wait for delivery. Each socket gets the messages that were
+sent to it during an iteration of the event loop from a single task, in order.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import sys
+import threading
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import DefaultDict, Dict
+
+from starlette.websockets import WebSocket
+
+from otree.currency import json_dumps
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ['memory', 'unix', 'postgres']
+
+
+def get_backend_name():
+    '''prodserver sets OTREE_CHANNEL_LAYER when running several worker processes'''
+    return os.getenv('OTREE_CHANNEL_LAYER') or 'memory'
+
+
+def get_multiprocess_backend_name():
+    backend = os.getenv('OTREE_CHANNEL_LAYER')
+    if backend and backend != 'memory':
+        return backend
+    if hasattr(socket, 'AF_UNIX'):
+        return 'unix'
+    return 'postgres'
+
+
+def get_channel_layer(backend):
+    if backend == 'memory':
+        return InMemoryChannelLayer()
+    if backend == 'unix':
+        # set by prodserver when it starts the broker
+        return UnixSocketChannelLayer(os.environ['OTREE_CHANNEL_SOCKET'])
+    if backend == 'postgres':
+        return PostgresChannelLayer()
+    sys.exit(f'OTREE_CHANNEL_LAYER should be one of {BACKENDS}, not "{backend}"')
+
+
+class BaseChannelLayer:
+    _subs: DefaultDict[str, Dict[int, WebSocket]]
+
+    def __init__(self):
+        self._subs = defaultdict(dict)
+        # id(websocket) -> texts waiting to be sent by _drain()
+        self._outboxes = {}
+
+    def add(self, group: str, websocket: WebSocket):
+        self._subs[group][id(websocket)] = websocket
+
+    def discard(self, group, websocket):
+        group_dict = self._subs[group]
+        group_dict.pop(id(websocket), None)
+        # prune it so this global var doesn't grow indefinitely
+        if not group_dict:
+            del self._subs[group]
+
+    def has_subscribers(self, group):
+        return group in self._subs
+
+    def may_have_subscribers(self, group):
+        '''
+        whether a message sent to this group might be delivered to anyone.
+        by default we can't tell, because the sockets may be connected to another process.
+        '''
+        return True
+
+    async def _deliver(self, group, text):
+        '''send an already serialized message to this process's sockets'''
+        group_dict = self._subs.get(group)
+        if not group_dict:
+            return
+        sockets = list(group_dict.values())
+        if len(sockets) == 1:
+            await sockets[0].send_text(text)
+        else:
+            await asyncio.gather(*[socket.send_text(text) for socket in sockets])
+
+    def _deliver_soon(self, group, text):
+        for socket in self._subs.get(group, {}).values():
+            outbox = self._outboxes.get(id(socket))
+            if outbox is None:
+                outbox = self._outboxes[id(socket)] = deque()
+                # the task starts in the next iteration of the event loop,
+                # so anything else sent to this socket until then goes in the same outbox.
+                asyncio.ensure_future(self._drain(socket, outbox))
+            outbox.append(text)
+
+    async def _drain(self, socket, outbox):
+        try:
+            while outbox:
+                await socket.send_text(outbox.popleft())
+        except Exception:
+            logger.exception('Error while sending to websocket')
+        finally:
+            del self._outboxes[id(socket)]
+
+    async def send(self, group, data):
+        raise NotImplementedError
+
+    def send_soon(self, group, data):
+        '''like send(), but doesn't wait until the message is delivered'''
+        raise NotImplementedError
+
+    def sync_send(self, group, data):
+        raise NotImplementedError
+
+    def sync_send_many(self, messages):
+        '''messages is a list of (group, data) pairs'''
+        for group, data in messages:
+            self.sync_send(group, data)
+
+    async def start(self):
+        '''called on server startup'''
+
+
+class InMemoryChannelLayer(BaseChannelLayer):
+    def may_have_subscribers(self, group):
+        return self.has_subscribers(group)
+
+    async def send(self, group, data):
+        if self.has_subscribers(group):
+            await self._deliver(group, json_dumps(data))
+
+    def sync_send(self, group, data):
+        asyncio.run(self.send(group, data))
+
+    def send_soon(self, group, data):
+        if self.has_subscribers(group):
+            self._deliver_soon(group, json_dumps(data))
+
+    def sync_send_many(self, messages):
+        # just 1 event loop for all of them
+        async def send_all():
+            for group, data in messages:
+                await self.send(group, data)
+
+        asyncio.run(send_all())
+
+
+class BrokeredChannelLayer(BaseChannelLayer):
+    """
+    Messages are published to a transport shared by all processes,
+    and come back to every process (including the sender) to be delivered.
+    Messages sent during the same iteration of the event loop
+    are published together as one batch.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._loop = None
+        self._outbox = []
+
+    async def start(self):
+        self._loop = asyncio.get_event_loop()
+
+    async def send(self, group, data):
+        self._enqueue(group, json_dumps(data))
+
+    def send_soon(self, group, data):
+        self._enqueue(group, json_dumps(data))
+
+    def sync_send(self, group, data):
+        # called from a thread in the threadpool
+        self._check_started()
+        self._loop.call_soon_threadsafe(self._enqueue, group, json_dumps(data))
+
+    def _check_started(self):
+        if self._loop is None:
+            raise RuntimeError(
+                f'{type(self).__name__} can only send messages after start() '
+                '(which runs on server startup)'
+            )
+
+    def _enqueue(self, group, text):
+        self._check_started()
+        if not self._outbox:
+            self._loop.call_soon(self._flush)
+        self._outbox.append([group, text])
+
+    def _flush(self):
+        messages = self._outbox
+        self._outbox = []
+        self._publish(messages)
+
+    def _publish(self, messages):
+        raise NotImplementedError
+
+    def _on_batch(self, messages):
+        for group, text in messages:
+            self._deliver_soon(group, text)
+
+
+# each frame is a 4-byte length followed by a JSON list of [group, text] pairs
+FRAME_HEADER = struct.Struct('>I')
+
+
+async def read_frame(reader: asyncio.StreamReader) -> bytes:
+    header = await reader.readexactly(FRAME_HEADER.size)
+    [length] = FRAME_HEADER.unpack(header)
+    return header + await reader.readexactly(length)
+
+
+def encode_frame(messages) -> bytes:
+    payload = json.dumps(messages).encode('utf8')
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class ChannelBroker:
+    """
+    Runs in the prodserver parent process, and forwards each frame
+    to all connected worker processes. It doesn't need to parse the frames.
+    We don't wait for each worker to read its frames, since one slow worker
+    would then hold up all the others. Instead, a worker that falls too far behind
+    is disconnected (and then reconnects, see UnixSocketChannelLayer).
+    """
+
+    # bytes that a worker hasn't read yet
+    MAX_BUFFER_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._writers = set()
+
+    async def _handle_connection(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                frame = await read_frame(reader)
+                for other_writer in list(self._writers):
+                    if (
+                        other_writer.transport.get_write_buffer_size()
+                        > self.MAX_BUFFER_SIZE
+                    ):
+                        logger.warning(
+                            'Disconnecting a worker process that is not reading '
+                            'its channel messages'
+                        )
+                        self._writers.discard(other_writer)
+                        other_writer.close()
+                        continue
+                    other_writer.write(frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def serve(self, ready: threading.Event = None):
+        server = await asyncio.start_unix_server(
+            self._handle_connection, path=self.path
+        )
+        if ready:
+            ready.set()
+        async with server:
+            await server.serve_forever()
+
+    def start_in_thread(self):
+        ready = threading.Event()
+        thread = threading.Thread(
+            target=asyncio.run, args=(self.serve(ready),), daemon=True
+        )
+        thread.start()
+        ready.wait()
+
+
+class UnixSocketChannelLayer(BrokeredChannelLayer):
+    # frames published while reconnecting to the broker are sent once it's back.
+    # beyond this, the oldest ones are dropped.
+    MAX_PENDING_FRAMES = 1000
+    MAX_RECONNECT_DELAY = 5
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._writer = None
+        self._pending = deque(maxlen=self.MAX_PENDING_FRAMES)
+
+    async def start(self):
+        await super().start()
+        reader = await self._connect()
+        asyncio.ensure_future(self._read_frames(reader))
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        while self._pending:
+            writer.write(self._pending.popleft())
+        self._writer = writer
+        return reader
+
+    async def _read_frames(self, reader):
+        while True:
+            try:
+                while True:
+                    frame = await read_frame(reader)
+                    self._on_batch(json.loads(frame[FRAME_HEADER.size :]))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                logger.error('Lost connection to the channel broker. Reconnecting...')
+            self._writer.close()
+            self._writer = None
+            reader = await self._reconnect()
+
+    async def _reconnect(self):
+        delay = 0.1
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                reader = await self._connect()
+            except OSError:
+                delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+                continue
+            logger.info('Reconnected to the channel broker')
+            return reader
+
+    def _publish(self, messages):
+        frame = encode_frame(messages)
+        if self._writer is None:
+            if len(self._pending) == self._pending.maxlen:
+                logger.warning(
+                    'Dropping a channel message because the broker is unreachable'
+                )
+            self._pending.append(frame)
+        else:
+            self._writer.write(frame)
+
+
+class PostgresChannelLayer(BrokeredChannelLayer):
+    PG_CHANNEL = 'otree_channel_layer'
+    # NOTIFY payloads must be under 8000 bytes.
+    # the payload is ASCII because json.dumps escapes non-ASCII characters.
+    CHUNK_SIZE = 7900
+    HEALTH_CHECK_INTERVAL = 30
+    MAX_RECONNECT_DELAY = 5
+
+    def __init__(self):
+        super().__init__()
+        self._listen_conn = None
+        self._listen_fd = None
+        # message_id -> list of chunks
+        self._partial_messages = {}
+        # a single thread, so that batches are published in order
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def start(self):
+        await super().start()
+        self._listen(self._connect())
+        asyncio.ensure_future(self._check_listen_connection())
+
+    def _connect(self):
+        from otree.database import engine
+
+        dialect = engine.dialect
+        cargs, cparams = dialect.create_connect_args(engine.url)
+        # a dedicated connection rather than one from the pool,
+        # since it stays open as long as the server runs.
+        conn = dialect.connect(*cargs, **cparams)
+        conn.autocommit = True
+        conn.cursor().execute(f'LISTEN {self.PG_CHANNEL}')
+        return conn
+
+    def _listen(self, conn):
+        # a broken connection's fileno() raises, so store it for remove_reader()
+        self._listen_fd = conn.fileno()
+        self._loop.add_reader(self._listen_fd, self._on_notify)
+        self._listen_conn = conn
+
+    def _on_notify(self):
+        try:
+            self._listen_conn.poll()
+        except Exception:
+            self._on_listen_error()
+            return
+        self._handle_notifies()
+
+    async def _check_listen_connection(self):
+        '''
+        if the DB server restarts or the network drops the connection,
+        the socket doesn't necessarily become readable, so we check it regularly.
+        '''
+        while True:
+            await asyncio.sleep(self.HEALTH_CHECK_INTERVAL)
+            if self._listen_conn is None:
+                # already reconnecting
+                continue
+            try:
+                self._listen_conn.cursor().execute('SELECT 1')
+            except Exception:
+                self._on_listen_error()
+            else:
+                self._handle_notifies()
+
+    def _on_listen_error(self):
+        logger.exception('Lost the channel layer\'s LISTEN connection. Reconnecting...')
+        conn = self._listen_conn
+        self._listen_conn = None
+        self._loop.remove_reader(self._listen_fd)
+        try:
+            conn.close()
+        except Exception:
+            pass
+        # the rest of a message whose first chunks arrived won't come anymore
+        self._partial_messages.clear()
+        asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self):
+        delay = 0.1
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                conn = await self._loop.run_in_executor(None, self._connect)
+            except Exception:
+                delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+                continue
+            self._listen(conn)
+            logger.info('Reconnected the channel layer\'s LISTEN connection')
+            return
+
+    def _handle_notifies(self):
+        conn = self._listen_conn
+        while conn.notifies:
+            notify = conn.notifies.pop(0)
+            messages = self._add_chunk(notify.payload)
+            if messages:
+                self._on_batch(messages)
+
+    def _add_chunk(self, payload):
+        message_id, index, num_chunks, chunk = payload.split(':', 3)
+        chunks = self._partial_messages.setdefault(message_id, [])
+        chunks.append(chunk)
+        if int(index) + 1 < int(num_chunks):
+            return None
+        del self._partial_messages[message_id]
+        return json.loads(''.join(chunks))
+
+    def _publish(self, messages):
+        future = self._loop.run_in_executor(self._executor, self._notify, messages)
+        future.add_done_callback(self._on_notify_done)
+
+    def _on_notify_done(self, future):
+        exc = future.exception()
+        if exc:
+            logger.error('Error while publishing channel messages', exc_info=exc)
+
+    def _notify(self, messages):
+        from otree.database import engine
+        import sqlalchemy
+
+        payload = json.dumps(messages)
+        chunks = [
+            payload[i : i + self.CHUNK_SIZE]
+            for i in range(0, len(payload), self.CHUNK_SIZE)
+        ]
+        message_id = uuid.uuid4().hex
+        query = sqlalchemy.text('SELECT pg_notify(:channel, :payload)')
+        with engine.connect() as connection:
+            # same transaction, so the chunks are delivered in order
+            with connection.begin():
+                for i, chunk in enumerate(chunks):
+                    connection.execute(
+                        query,
+                        channel=self.PG_CHANNEL,
+                        payload=f'{message_id}:{i}:{len(chunks)}:{chunk}',
+                    )
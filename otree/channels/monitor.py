@@ -0,0 +1,134 @@
+"""
+Updates for the session monitor (the Monitor tab of the admin).
+
+During a lab session, participants advance pages at almost the same time,
+so rather than sending a message to the monitor for each page advance,
+the changes are buffered and sent once every MONITOR_INTERVAL seconds,
+as one message per session. For participants whose row was already sent,
+only the columns that changed are sent.
+If nobody has the session's monitor open, nothing is computed or buffered.
+"""
+import asyncio
+import os
+import threading
+from collections import defaultdict
+from logging import getLogger
+
+from otree.channels.utils import channel_layer, session_monitor_group_name
+
+MONITOR_INTERVAL = float(os.getenv('OTREE_MONITOR_INTERVAL', 0.25))
+
+NOTE_ONLY_KEYS = {'id_in_session', '_monitor_note'}
+
+logger = getLogger(__name__)
+
+
+class MonitorPublisher:
+    def __init__(self, interval):
+        self.interval = interval
+        # {session_code: {id_in_session: {field_name: value}}}
+        self._pending = defaultdict(dict)
+        # the rows as they were last sent, so we can send only what changed.
+        self._sent = defaultdict(dict)
+        # requests add changes from several threads
+        self._lock = threading.Lock()
+        self._started = False
+
+    async def start(self):
+        '''called on server startup'''
+        self._started = True
+        asyncio.ensure_future(self._run())
+
+    def is_watched(self, session_code):
+        return channel_layer.may_have_subscribers(
+            session_monitor_group_name(session_code)
+        )
+
+    def update_rows(self, session_code, get_rows):
+        """
+        get_rows returns rows like get_rows_for_monitor.
+        It's only called if someone may be watching the monitor.
+        """
+        if not self.is_watched(session_code):
+            self.forget(session_code)
+            return
+        rows = get_rows()
+        if not self._started:
+            # e.g. in 'otree test', where the server's startup hooks don't run
+            self._send_now(session_code, dict(rows=rows))
+            return
+        with self._lock:
+            pending = self._pending[session_code]
+            for row in rows:
+                pending.setdefault(row['id_in_session'], {}).update(row)
+
+    def update_notes(self, session_code, ids, note):
+        if not self.is_watched(session_code):
+            return
+        if not self._started:
+            self._send_now(session_code, dict(ids=ids, note=note, type='update_notes'))
+            return
+        with self._lock:
+            pending = self._pending[session_code]
+            for id_in_session in ids:
+                row = pending.setdefault(id_in_session, {'id_in_session': id_in_session})
+                row['_monitor_note'] = note
+
+    def forget(self, session_code):
+        """
+        e.g. when a monitor connects. It loads the rows from the DB,
+        which may differ from what was last sent,
+        so the next message should not leave out any columns.
+        """
+        with self._lock:
+            self._sent.pop(session_code, None)
+
+    def _send_now(self, session_code, data):
+        channel_layer.sync_send(session_monitor_group_name(session_code), data)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                for session_code, data in self.get_messages():
+                    await channel_layer.send(
+                        session_monitor_group_name(session_code), data
+                    )
+            except Exception:
+                logger.exception('Error while sending monitor updates')
+
+    def get_messages(self):
+        """
+        returns a (session_code, data) pair for each session with changes.
+        data['rows'] has full rows, for participants the monitor may not have a row for.
+        data['diffs'] has only the columns that changed.
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = defaultdict(dict)
+            messages = []
+            for session_code, changes in pending.items():
+                sent = self._sent[session_code]
+                rows = []
+                diffs = []
+                for id_in_session, row in changes.items():
+                    sent_row = sent.get(id_in_session)
+                    if sent_row is not None:
+                        diff = {k: v for k, v in row.items() if sent_row.get(k) != v}
+                        if diff:
+                            sent_row.update(diff)
+                            diff['id_in_session'] = id_in_session
+                            diffs.append(diff)
+                    elif row.keys() == NOTE_ONLY_KEYS:
+                        # the monitor ignores this if it doesn't have the participant's row,
+                        # which means they haven't visited yet.
+                        diffs.append(row)
+                    else:
+                        rows.append(row)
+                        sent[id_in_session] = dict(row)
+                if rows or diffs:
+                    messages.append((session_code, dict(rows=rows, diffs=diffs)))
+            return messages
+
+
+monitor_publisher = MonitorPublisher(MONITOR_INTERVAL)
@@ -1,13 +1,8 @@
-from otree.common import signer_sign
-import asyncio
-from collections import defaultdict
-from typing import DefaultDict, Dict
 from urllib.parse import urlencode
 import websockets.exceptions
-from starlette.websockets import WebSocket
 
+from otree.channels.layers import get_backend_name, get_channel_layer
 from otree.common import signer_sign
-from otree.currency import json_dumps
 
 
 def wrap_websocket_send(original_send):
@@ -22,45 +17,27 @@ def wrap_websocket_send(original_send):
     return send
 
 
-class ChannelLayer:
-    _subs: DefaultDict[str, Dict[int, WebSocket]]
-
-    def _get_sockets(self, group):
-        for socket in self._subs[group].values():
-            yield socket
-
-    def __init__(self):
-        self._subs = defaultdict(dict)
-
-    def add(self, group: str, websocket: WebSocket):
-        self._subs[group][id(websocket)] = websocket
-
-    def discard(self, group, websocket):
-        group_dict = self._subs[group]
-        group_dict.pop(id(websocket), None)
-        # prune it so this global var doesn't grow indefinitely
-        if not group_dict:
-            del self._subs[group]
-
-    async def send(self, group, data):
-        for socket in self._get_sockets(group):
-            await socket.send_text(json_dumps(data))
-
-    def sync_send(self, group, data):
-        asyncio.run(self.send(group, data))
-
-
-channel_layer = ChannelLayer()
+channel_layer = get_channel_layer(get_backend_name())
 
 
 async def group_send(*, group: str, data: dict):
     await channel_layer.send(group, data)
 
 
+def group_send_soon(*, group: str, data: dict):
+    '''doesn't wait until the message is delivered'''
+    channel_layer.send_soon(group, data)
+
+
 def sync_group_send(*, group: str, data: dict):
     channel_layer.sync_send(group=group, data=data)
 
 
+def sync_group_send_many(messages):
+    '''messages is a list of (group, data) pairs'''
+    channel_layer.sync_send_many(messages)
+
+
 def group_wait_page_name(session_id, page_index, group_id):
 
     return 'wait-page-{}-page{}-{}'.format(session_id, page_index, group_id)
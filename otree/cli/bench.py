@@ -0,0 +1,34 @@
+from importlib import import_module
+
+from .base import BaseCommand
+
+BENCHMARKS = [
+    'locking',
+    'channels',
+    'timeouts',
+    'create_session',
+    'templates',
+    'vars',
+    'attributes',
+    'advance',
+    'trials',
+    'bots',
+    'forms',
+    'sqlite',
+]
+
+
+class Command(BaseCommand):
+    help = 'Run a performance benchmark.'
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='benchmark', metavar='benchmark')
+        subparsers.required = True
+        for name in BENCHMARKS:
+            module = import_module(f'otree.benchmarks.{name}')
+            summary = module.__doc__.strip().splitlines()[0]
+            subparser = subparsers.add_parser(name, help=summary)
+            module.add_arguments(subparser)
+
+    def handle(self, *, benchmark, **options):
+        import_module(f'otree.benchmarks.{benchmark}').run(**options)
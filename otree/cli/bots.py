@@ -48,11 +48,23 @@ class Command(BaseCommand):
             dest='export_path',
             help=('Alias for --export.'),
         )
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            default=1,
+            help=(
+                'Number of processes to run the sessions in. '
+                'Each session config and bot case runs in one process.'
+            ),
+        )
 
-    def handle(self, *, session_config_name, num_participants, export_path, **options):
+    def handle(
+        self, *, session_config_name, num_participants, export_path, jobs, **options
+    ):
 
         run_all_bots_for_session_config(
             session_config_name=session_config_name,
             num_participants=num_participants,
             export_path=export_path,
+            jobs=jobs,
         )
@@ -1,12 +1,12 @@
 from otree.checks import run_checks
 from .base import BaseCommand
 from .prodserver1of2 import get_addr_port, run_asgi_server
-from ..database import save_sqlite_db, DB_FILE
+from ..database import save_sqlite_db, DB_FILES
 
 print_function = print
 
 
-ADVICE_DELETE_DB = f'ADVICE: Delete your database ({DB_FILE}).'
+ADVICE_DELETE_DB = f'ADVICE: Delete your database ({", ".join(DB_FILES)}).'
 
 
 class Command(BaseCommand):
@@ -1,6 +1,8 @@
+import functools
 import logging
 import os
-import subprocess
+import sys
+import tempfile
 
 from .base import BaseCommand
 
@@ -9,12 +11,19 @@ logger = logging.getLogger(__name__)
 print_function = print
 
 
-def run_asgi_server(addr, port, *, is_devserver=False):
-    run_uvicorn(addr, port, is_devserver=is_devserver)
+MSG_WORKERS_REQUIRE_POSTGRES = (
+    'Running more than 1 worker requires a Postgres database (DATABASE_URL) '
+    'and the environment variable OTREE_LOCKING=granular.'
+)
 
 
-def run_uvicorn(addr, port, *, is_devserver):
+def run_asgi_server(addr, port, *, is_devserver=False, workers=1):
+    run_uvicorn(addr, port, is_devserver=is_devserver, workers=workers)
+
+
+def run_uvicorn(addr, port, *, is_devserver, workers=1):
     from uvicorn.main import Config, Server
+    from uvicorn.supervisors import Multiprocess
 
     config = Config(
         'otree.asgi:app',
@@ -23,14 +32,44 @@ def run_uvicorn(addr, port, *, is_devserver):
         log_level='warning' if is_devserver else "info",
         log_config=None,  # oTree has its own logger
         # i suspect it was defaulting to something else
-        workers=1,
+        workers=workers,
         # websockets library handles disconnects & ping automatically,
         # so we can simplify code and also avoid H15 errors on heroku.
         ws='websockets',
         # ws='wsproto',
     )
-    server = Server(config=config)
-    server.run()
+    if workers > 1:
+        sock = config.bind_socket()
+        target = functools.partial(run_worker_process, config)
+        Multiprocess(config, target=target, sockets=[sock]).run()
+    else:
+        server = Server(config=config)
+        server.run()
+
+
+def run_worker_process(config, sockets):
+    # the worker is a new (spawned) process, so it needs to load the project
+    # just like the main process did.
+    from otree.main import setup
+    from uvicorn.main import Server
+
+    setup()
+    Server(config=config).run(sockets=sockets)
+
+
+def setup_multiprocess_channel_layer():
+    """
+    The worker processes inherit these env vars,
+    so they know which channel layer to use.
+    """
+    from otree.channels.layers import get_multiprocess_backend_name, ChannelBroker
+
+    backend = get_multiprocess_backend_name()
+    os.environ['OTREE_CHANNEL_LAYER'] = backend
+    if backend == 'unix':
+        path = os.path.join(tempfile.mkdtemp(prefix='otree-'), 'channels.sock')
+        os.environ['OTREE_CHANNEL_SOCKET'] = path
+        ChannelBroker(path).start_in_thread()
 
 
 def get_addr_port(cli_addrport, is_devserver=False):
@@ -49,11 +88,20 @@ class Command(BaseCommand):
         parser.add_argument(
             'addrport', nargs='?', help='Optional port number, or ipaddr:port'
         )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=int(os.getenv('OTREE_WORKERS') or 1),
+            help='Number of server processes (requires Postgres and granular locking)',
+        )
+
+    def handle(self, *args, addrport=None, verbosity=1, workers, **kwargs):
+        if workers > 1:
+            from otree.locks import USE_ADVISORY_LOCKS
 
-    def handle(self, *args, addrport=None, verbosity=1, **kwargs):
+            if not USE_ADVISORY_LOCKS:
+                sys.exit(MSG_WORKERS_REQUIRE_POSTGRES)
+            setup_multiprocess_channel_layer()
         addr, port = get_addr_port(addrport)
-        subprocess.Popen(
-            ['otree', 'timeoutsubprocess', str(port)], env=os.environ.copy()
-        )
         print_function('Running prodserver')
-        run_asgi_server(addr, port)
+        run_asgi_server(addr, port, workers=workers)
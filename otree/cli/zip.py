@@ -22,7 +22,7 @@ PROJECT_PATH = Path('.').resolve()
 # https://git-scm.com/docs/gitignore#_pattern_format
 
 # TODO: maybe some of these extensions like .env, staticfiles could legitimately exist in subfolders.
-EXCLUDED_PATH_ENDINGS = '~ .git db.sqlite3 .pyo .pyc .pyd .idea .DS_Store .otreezip venv _static_root staticfiles __pycache__ .env'.split()
+EXCLUDED_PATH_ENDINGS = '~ .git db.sqlite3 db.sqlite3-wal db.sqlite3-shm .pyo .pyc .pyd .idea .DS_Store .otreezip venv _static_root staticfiles __pycache__ .env'.split()
 
 OVERWRITE_TOKEN = 'oTree-may-overwrite-this-file'
 DONT_OVERWRITE_TOKEN = 'oTree-may-not-overwrite-this-file'
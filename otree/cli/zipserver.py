@@ -155,7 +155,8 @@ class Project:
         os.kill(child_pid, 9)
 
     def take_db_from_previous(self, other_tmpdir: str):
-        for item in ['db.sqlite3']:
+        # with the WAL files too, otherwise the latest changes would be lost
+        for item in ['db.sqlite3', 'db.sqlite3-wal', 'db.sqlite3-shm']:
             item_path = Path(other_tmpdir) / item
             if item_path.exists():
                 shutil.move(str(item_path), self.tmpdir.name)
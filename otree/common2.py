@@ -1,14 +1,23 @@
 # like common, but can import models
+import asyncio
+import gzip
+import hashlib
 import importlib.util
 import os
+import stat
+import threading
 import time
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, field
+from mimetypes import guess_type
 from pathlib import Path
 
-from starlette.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, QueryParams
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
 
 from otree import settings
-from otree.database import db
+from otree.database import db, session_scope
 from otree.models_concrete import PageTimeBatch
 
 
@@ -26,8 +35,12 @@ class TimeSpentRow:
     is_wait_page: int
 
 
+# each worker process has its own buffer. that's fine because it gets written
+# to the DB, and the export reads all PageTimeBatch rows.
 page_completion_buffer = []
 page_completion_last_write = 0
+# with granular locking, requests add rows from several threads
+page_completion_buffer_lock = threading.Lock()
 
 BUFFER_SIZE = 50
 
@@ -36,7 +49,8 @@ def write_row_to_page_buffer(row: TimeSpentRow):
     d = asdict(row)
     row = ','.join(map(str, d.values())) + '\n'
 
-    page_completion_buffer.append(row)
+    with page_completion_buffer_lock:
+        page_completion_buffer.append(row)
     if (
         len(page_completion_buffer) > BUFFER_SIZE
         or time.time() - page_completion_last_write > 60 * 2
@@ -71,12 +85,110 @@ def make_page_completion_row(
 
 def write_page_completion_buffer():
     global page_completion_last_write
-    db.add(PageTimeBatch(text=''.join(page_completion_buffer)))
-    page_completion_last_write = time.time()
-    page_completion_buffer.clear()
+    with page_completion_buffer_lock:
+        text = ''.join(page_completion_buffer)
+        page_completion_buffer.clear()
+        page_completion_last_write = time.time()
+    if text:
+        db.add(PageTimeBatch(text=text))
+
+
+def flush_page_completion_buffer():
+    """on server shutdown, so that the rows don't get lost"""
+    if page_completion_buffer:
+        with session_scope():
+            write_page_completion_buffer()
+
+
+# text files are worth compressing. images, fonts, etc. are already compressed.
+COMPRESSIBLE_SUFFIXES = {'.js', '.css', '.map', '.svg', '.json', '.txt', '.html'}
+# bigger files are served uncompressed rather than kept in memory
+MAX_COMPRESSED_FILE_SIZE = 5 * 1024 * 1024
+# for URLs with the file's current fingerprint (?v=...), which change when the file changes.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def get_brotli():
+    try:
+        import brotli
+    except ModuleNotFoundError:
+        return None
+    return brotli
+
+
+@dataclass
+class StaticFileInfo:
+    # to check that the file hasn't changed since
+    mtime: float
+    size: int
+    # for ETags and URLs
+    fingerprint: str
+    # content-encoding (e.g. 'gzip') -> compressed contents
+    encodings: dict = field(default_factory=dict)
+
+
+def load_static_file_info(full_path, stat_result) -> StaticFileInfo:
+    info = StaticFileInfo(
+        mtime=stat_result.st_mtime, size=stat_result.st_size, fingerprint=''
+    )
+    compress = (
+        Path(full_path).suffix in COMPRESSIBLE_SUFFIXES
+        and stat_result.st_size <= MAX_COMPRESSED_FILE_SIZE
+    )
+    if not compress:
+        # could be a big video, so rather than hashing the contents,
+        # which could block the event loop the first time a template refers to it,
+        # we use the size and modification time, which change when the file changes.
+        key = f'{stat_result.st_mtime_ns}-{stat_result.st_size}'
+        info.fingerprint = hashlib.sha256(key.encode()).hexdigest()[:12]
+        return info
+    with open(full_path, 'rb') as f:
+        content = f.read()
+    info.fingerprint = hashlib.sha256(content).hexdigest()[:12]
+    encodings = {'gzip': gzip.compress(content, compresslevel=9, mtime=0)}
+    brotli = get_brotli()
+    if brotli:
+        encodings['br'] = brotli.compress(content, quality=9)
+    for encoding, data in encodings.items():
+        # e.g. an already minified tiny file
+        if len(data) < len(content):
+            info.encodings[encoding] = data
+    return info
+
+
+def get_accepted_encodings(request_headers: Headers) -> set:
+    '''e.g. "gzip, deflate, br;q=1.0, *;q=0.5" -> {'gzip', 'deflate', 'br', '*'}'''
+    encodings = set()
+    for item in request_headers.get('accept-encoding', '').split(','):
+        name, _, params = item.partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        encodings.add(name.strip())
+    return encodings
 
 
 class OTreeStaticFiles(StaticFiles):
+    """
+    - URLs from url_of_static_file and {% static %} have a fingerprint of the file
+      (e.g. /static/otree/js/jquery.min.js?v=1a2b3c4d5e6f),
+      so they are served with a long-lived immutable Cache-Control.
+      The fingerprint is in the query string rather than the file name,
+      so that relative URLs inside CSS files still work.
+    - Text files are compressed once (gzip, and brotli if it's installed)
+      rather than sent uncompressed with every request,
+      e.g. when a whole lab loads the same JS at the same moment.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # full path -> StaticFileInfo
+        self._file_infos = {}
+
     # copied from starlette, just to change 'statics' to 'static',
     # and to fail silently if the dir does not exist.
     def get_directories(self, directory, packages):
@@ -106,6 +218,92 @@ class OTreeStaticFiles(StaticFiles):
                 return
         raise FileNotFoundError(path)
 
+    def get_file_info(self, full_path, stat_result=None) -> StaticFileInfo:
+        if stat_result is None:
+            stat_result = os.stat(full_path)
+        info = self._file_infos.get(full_path)
+        if (
+            info is None
+            or info.mtime != stat_result.st_mtime
+            or info.size != stat_result.st_size
+        ):
+            old_info = info
+            info = load_static_file_info(full_path, stat_result)
+            self._file_infos[full_path] = info
+            if old_info and old_info.fingerprint != info.fingerprint:
+                # cached page output has URLs with the old fingerprint
+                from otree.templating.cache import render_cache
+
+                render_cache.invalidate()
+        return info
+
+    def fingerprint(self, path) -> str:
+        for _dir in self.all_directories:
+            full_path = os.path.realpath(os.path.join(_dir, path))
+            if os.path.isfile(full_path):
+                return self.get_file_info(full_path).fingerprint
+        raise FileNotFoundError(path)
+
+    async def start(self):
+        '''called on server startup'''
+        asyncio.ensure_future(run_in_threadpool(self.precompress))
+
+    def precompress(self):
+        '''
+        so that the first browsers to load a file don't have to wait for it to be compressed,
+        and rendering a template doesn't have to read the files it refers to.
+        '''
+        for root in self.all_directories:
+            for dirpath, _, filenames in os.walk(root):
+                for filename in filenames:
+                    full_path = os.path.realpath(os.path.join(dirpath, filename))
+                    # e.g. a broken symlink
+                    if os.path.isfile(full_path):
+                        self.get_file_info(full_path)
+
+    async def lookup_path(self, path):
+        full_path, stat_result = await super().lookup_path(path)
+        if stat_result and stat.S_ISREG(stat_result.st_mode):
+            # reading and compressing the file could be slow,
+            # so don't do it in the event loop.
+            await run_in_threadpool(self.get_file_info, full_path, stat_result)
+        return full_path, stat_result
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        info = self._file_infos.get(full_path)
+        if info is None or status_code != 200:
+            return super().file_response(full_path, stat_result, scope, status_code)
+        request_headers = Headers(scope=scope)
+        headers = {}
+        if QueryParams(scope['query_string']).get('v') == info.fingerprint:
+            headers['cache-control'] = IMMUTABLE_CACHE_CONTROL
+        encoding = None
+        if info.encodings:
+            headers['vary'] = 'Accept-Encoding'
+            # a HEAD response has no body, so it doesn't matter
+            if scope['method'] == 'GET':
+                accepted = get_accepted_encodings(request_headers)
+                encoding = next(
+                    (e for e in ['br', 'gzip'] if e in accepted and e in info.encodings),
+                    None,
+                )
+        if encoding:
+            headers['etag'] = f'"{info.fingerprint}-{encoding}"'
+        else:
+            headers['etag'] = f'"{info.fingerprint}"'
+        if request_headers.get('if-none-match') == headers['etag']:
+            return NotModifiedResponse(Headers(headers=headers))
+        if encoding:
+            headers['content-encoding'] = encoding
+            return Response(
+                info.encodings[encoding],
+                media_type=guess_type(full_path)[0] or 'text/plain',
+                headers=headers,
+            )
+        return FileResponse(
+            full_path, stat_result=stat_result, method=scope['method'], headers=headers
+        )
+
     def urls_of_static_files(self, dirpath, extension):
         from otree.asgi import app
 
@@ -117,7 +315,8 @@ class OTreeStaticFiles(StaticFiles):
             if _dir.is_dir():
                 for _file in _dir.glob(f'*.{extension}'):
                     relpath = _file.relative_to(root)
-                    yield app.router.url_path_for('static', path=relpath)
+                    url = app.router.url_path_for('static', path=relpath.as_posix())
+                    yield f'{url}?v={self.get_file_info(str(_file.resolve())).fingerprint}'
 
 
 existing_filenames_cache = set()
@@ -146,14 +345,15 @@ def url_of_static_file(path):
     from otree.asgi import app
 
     static_files_app.assert_file_exists(path)
-    return app.router.url_path_for('static', path=path)
+    url = app.router.url_path_for('static', path=path)
+    return f'{url}?v={static_files_app.fingerprint(path)}'
 
 
 def urls_of_static_files(dir, extension):
     """
     e.g.:
     >>> urls_of_static_files('emojis', 'png')
-    ['/static/emojis/1.png', '/static/emojis/2.png']
+    ['/static/emojis/1.png?v=...', '/static/emojis/2.png?v=...']
 
     I don't know how useful this would be because usually people have (a) some metadata about the file,
     such as what it contains. also for DB storage & record-keeping,
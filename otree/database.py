@@ -1,11 +1,14 @@
+import asyncio
 import binascii
 import logging
 import os
 import pickle
 import sqlite3
 import sys
+import threading
 from collections import defaultdict
 from contextlib import contextmanager
+from contextvars import ContextVar
 from decimal import Decimal
 from pathlib import Path
 
@@ -22,10 +25,13 @@ from sqlalchemy.orm import (
     mapper,
     relationship,
 )
+from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.orm.session import object_session
 from sqlalchemy.sql.functions import func
 from sqlalchemy.orm import sessionmaker, configure_mappers
 from sqlalchemy.orm.exc import NoResultFound  # noqa
 from sqlalchemy.sql import sqltypes as st
+from starlette.concurrency import run_in_threadpool
 from starlette.exceptions import HTTPException
 
 from otree import __version__
@@ -36,6 +42,10 @@ from otree.currency import Currency, RealWorldCurrency
 
 logger = logging.getLogger(__name__)
 DB_FILE = 'db.sqlite3'
+# in WAL mode (OTREE_SQLITE_PROFILE=performance), SQLite also keeps these next to DB_FILE.
+DB_FILES = [DB_FILE, f'{DB_FILE}-wal', f'{DB_FILE}-shm']
+
+TRANSACTION_CACHE_KEY = 'otree_transaction_cache'
 
 
 # DB_FILE_PATH = Path(DB_FILE)
@@ -80,6 +90,17 @@ sqlite_disk_conn = get_disk_conn()
 
 _dumped = False
 
+# With OTREE_IN_MEMORY, the devserver saves a checkpoint of the DB to DB_FILE
+# every CHECKPOINT_INTERVAL seconds (if anything changed),
+# so that less data is lost if it crashes. 0 means only save when the server stops.
+# Larger values mean less time spent copying the DB.
+CHECKPOINT_INTERVAL = float(os.getenv('OTREE_CHECKPOINT_INTERVAL', 30))
+# number of pages that each step of a checkpoint writes to disk. -1 means all at once.
+CHECKPOINT_PAGES = int(os.getenv('OTREE_CHECKPOINT_PAGES', 1000))
+
+# a checkpoint and the final save could otherwise write to the disk DB at the same time
+_disk_write_lock = threading.Lock()
+
 
 class OTreeColumn(sqlalchemy.Column):
     form_props: dict
@@ -99,7 +120,9 @@ def load_in_memory_db():
     # (1) performance refresh
     # (2) don't have to worry about old references to things that were removed from otree-core.
     if prev_version != version_for_pragma() and not os.getenv('OTREE_CORE_DEV'):
-        sys.exit(f'oTree has been updated. Please delete your database ({DB_FILE})')
+        sys.exit(
+            f'oTree has been updated. Please delete your database ({", ".join(DB_FILES)})'
+        )
 
     for tblname in new_schema:
         if tblname in old_schema:
@@ -114,17 +137,27 @@ def load_in_memory_db():
                 f'INSERT INTO {tblname}({common_cols_joined}) VALUES ({question_marks})'
             )
             disk_cur.execute(select_cmd)
-            rows = disk_cur.fetchall()
             try:
-                mem_cur.executemany(insert_cmd, rows)
+                # executemany consumes the cursor row by row,
+                # so we don't load the whole table into a list first.
+                mem_cur.executemany(insert_cmd, disk_cur)
             except sqlite3.IntegrityError as exc:
                 # for example if you change a StringField to a BooleanField
-                sys.exit(f'An error occurred. Please delete your database ({DB_FILE}).')
+                sys.exit(
+                    'An error occurred. '
+                    f'Please delete your database ({", ".join(DB_FILES)}).'
+                )
     sqlite_mem_conn.commit()
 
 
 @contextmanager
-def session_scope():
+def session_scope(bind=None):
+    if GRANULAR_LOCKING:
+        # other tasks/threads are using the DB concurrently,
+        # so we can't replace the global session.
+        with db.private_session(bind=bind):
+            yield
+        return
     if NEW_IDMAP_EACH_REQUEST:
         db.new_session()
     try:
@@ -145,16 +178,67 @@ def save_sqlite_db():
         # real database.
         return
     global _dumped
-    if _dumped:
-        return
-    sqlite_mem_conn.cursor().execute(f"PRAGMA user_version = {version_for_pragma()}")
-    sqlite_mem_conn.backup(sqlite_disk_conn)
-    _dumped = True
+    with _disk_write_lock:
+        if _dumped:
+            return
+        sqlite_mem_conn.cursor().execute(
+            f"PRAGMA user_version = {version_for_pragma()}"
+        )
+        sqlite_mem_conn.backup(sqlite_disk_conn)
+        _dumped = True
+
+
+async def start_sqlite_checkpoints():
+    '''called on server startup'''
+    if IN_MEMORY and CHECKPOINT_INTERVAL > 0:
+        asyncio.ensure_future(_run_sqlite_checkpoints())
+
+
+async def _run_sqlite_checkpoints():
+    from otree.locks import EXCLUSIVE, request_locks
+
+    # changes from loading the DB on startup are already on disk
+    saved_changes = sqlite_mem_conn.total_changes
+    while True:
+        await asyncio.sleep(CHECKPOINT_INTERVAL)
+        try:
+            if sqlite_mem_conn.total_changes == saved_changes:
+                continue
+            # copying memory to memory is fast, so the lock is only held briefly.
+            # writing to disk is done afterwards, in a thread.
+            async with request_locks.hold(EXCLUSIVE):
+                changes = sqlite_mem_conn.total_changes
+                snapshot = _copy_to_memory(sqlite_mem_conn)
+            await run_in_threadpool(_write_checkpoint, snapshot)
+            # only now, so that if the write failed, we try again next time
+            # even if nothing else changed.
+            saved_changes = changes
+        except Exception:
+            logger.exception('Error while saving a checkpoint of the database')
+
+
+def _write_checkpoint(snapshot: sqlite3.Connection):
+    try:
+        with _disk_write_lock:
+            if _dumped:
+                # the server is stopping and already saved the latest data
+                return
+            snapshot.execute(f"PRAGMA user_version = {version_for_pragma()}")
+            # the destination is only modified in a single transaction,
+            # so if we crash in the middle, the previous checkpoint is kept.
+            snapshot.backup(sqlite_disk_conn, pages=CHECKPOINT_PAGES)
+    finally:
+        snapshot.close()
 
 
 DeclarativeBase = declarative_base()
 
 
+# in granular locking mode, each request gets its own session,
+# because several requests can be running at the same time.
+_private_db = ContextVar('_private_db', default=None)
+
+
 class DBWrapper:
     """
     1. this way we can defer definining the ._db attribute
@@ -162,7 +246,18 @@ class DBWrapper:
     2. we can add helper methods
     """
 
-    _db: sqlalchemy.orm.Session = None
+    _global_db: sqlalchemy.orm.Session = None
+
+    @property
+    def _db(self) -> sqlalchemy.orm.Session:
+        private_db = _private_db.get()
+        if private_db is None:
+            return self._global_db
+        return private_db
+
+    @_db.setter
+    def _db(self, value):
+        self._global_db = value
 
     def query(self, *args, **kwargs):
         return self._db.query(*args, **kwargs)
@@ -176,6 +271,14 @@ class DBWrapper:
     def delete(self, obj):
         return self._db.delete(obj)
 
+    def get(self, Model, pk):
+        '''doesn't query the DB if the object is already in the identity map'''
+        return self._db.query(Model).get(pk)
+
+    def transaction_cache(self) -> dict:
+        '''for memoizing objects until the transaction ends'''
+        return self._db.info.setdefault(TRANSACTION_CACHE_KEY, {})
+
     def get_or_404(self, Model, msg='Not found', **kwargs):
         try:
             return self.query(Model).filter_by(**kwargs).one()
@@ -205,6 +308,61 @@ class DBWrapper:
     def expire_all(self):
         self._db.expire_all()
 
+    def bulk_insert(self, Model, rows: list):
+        '''
+        insert rows (dicts with the same keys) in a single executemany,
+        without creating ORM objects. Column defaults are still applied.
+        '''
+        if rows:
+            self._db.execute(Model.__table__.insert(), rows)
+
+    def bulk_update(self, Model, rows: list):
+        '''
+        update rows (dicts that include the primary key) without loading ORM objects.
+        '''
+        if rows:
+            self._db.bulk_update_mappings(Model, rows)
+
+    def reserve_ids(self, Model, num_ids) -> list:
+        '''
+        get the primary keys for rows that are about to be inserted,
+        so that FKs can be set without re-querying the rows.
+        '''
+        table = Model.__table__
+        if engine.name == 'postgresql':
+            sequence = func.pg_get_serial_sequence(table.name, 'id')
+            query = sqlalchemy.select([func.nextval(sequence)]).select_from(
+                func.generate_series(1, num_ids)
+            )
+            return [row[0] for row in self._db.execute(query)]
+        # without a sequence, we count on nobody else inserting rows
+        # into this table in the meantime. this is safe because session creation
+        # has the server to itself (see otree.locks),
+        # and multiple worker processes require Postgres.
+        max_id = self._db.query(func.max(table.c.id)).scalar() or 0
+        return list(range(max_id + 1, max_id + 1 + num_ids))
+
+    @contextmanager
+    def private_session(self, bind=None):
+        """
+        Use a session that is only visible in the current context
+        (the current asyncio task, and any threads it runs code in via run_in_threadpool).
+        Commits if the block exits without an exception.
+        bind can be a Connection that is already checked out
+        (e.g. one that holds advisory locks for this request).
+        """
+        session = DBSession(bind=bind) if bind else DBSession()
+        token = _private_db.set(session)
+        try:
+            yield
+            self.commit()
+        except:
+            self.rollback()
+            raise
+        finally:
+            self.close()
+            _private_db.reset(token)
+
 
 db = DBWrapper()
 dbq = db.query
@@ -218,6 +376,71 @@ dbq = db.query
 IN_MEMORY = bool(os.getenv('OTREE_IN_MEMORY'))
 
 
+LOCKING_MODE = os.getenv('OTREE_LOCKING') or 'global'
+if LOCKING_MODE not in ['global', 'granular']:
+    sys.exit(
+        f'OTREE_LOCKING should be either "global" or "granular", not "{LOCKING_MODE}"'
+    )
+
+# pragmas set on each new SQLite connection.
+SQLITE_PROFILES = {
+    'default': ['foreign_keys=on'],
+    # for prodserver on SQLite. Trades some durability for faster commits:
+    # after a power loss (but not a crash of the server process),
+    # the last few commits may be lost, but the DB is not corrupted.
+    'performance': [
+        'foreign_keys=on',
+        # commits append to the log instead of rewriting pages in place,
+        # and readers don't block the writer.
+        'journal_mode=WAL',
+        # with WAL, only fsync when the log is checkpointed, rather than on every commit.
+        'synchronous=NORMAL',
+        # 256 MB
+        'mmap_size=268435456',
+        # negative means KiB, so 64 MB
+        'cache_size=-65536',
+        'temp_store=MEMORY',
+    ],
+}
+SQLITE_PROFILE = os.getenv('OTREE_SQLITE_PROFILE') or 'default'
+if SQLITE_PROFILE not in SQLITE_PROFILES:
+    sys.exit(
+        f'OTREE_SQLITE_PROFILE should be one of {list(SQLITE_PROFILES)}, '
+        f'not "{SQLITE_PROFILE}"'
+    )
+
+# number of compiled INSERT/UPDATE statements that SQLAlchemy caches per model.
+# each combination of modified fields is a different UPDATE statement,
+# so models with many fields can use more than SQLAlchemy's default of 100.
+# this applies to any database, so it's separate from OTREE_SQLITE_PROFILE.
+COMPILED_CACHE_SIZE = int(os.getenv('OTREE_COMPILED_CACHE_SIZE', 1000))
+
+
+def set_sqlite_pragmas(dbapi_connection, profile=SQLITE_PROFILE):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PROFILES[profile]:
+        cursor.execute(f'PRAGMA {pragma}')
+    cursor.close()
+
+
+def get_pool_kwargs():
+    """
+    For a DB server like Postgres.
+    Each worker process has its own pool, so the DB's max connections should be at least
+    workers * (pool size + overflow), plus a few for the timeout worker.
+    """
+    return dict(
+        poolclass=sqlalchemy.pool.QueuePool,
+        pool_size=int(os.getenv('OTREE_DB_POOL_SIZE', 5)),
+        max_overflow=int(os.getenv('OTREE_DB_MAX_OVERFLOW', 10)),
+        # checks the connection is alive before using it,
+        # because servers/proxies may close idle connections.
+        pool_pre_ping=os.getenv('OTREE_DB_POOL_PRE_PING', '1') not in ['', '0'],
+        # seconds after which a connection is replaced. -1 means never.
+        pool_recycle=int(os.getenv('OTREE_DB_POOL_RECYCLE', -1)),
+    )
+
+
 def get_engine():
     if IN_MEMORY:
         engine = create_engine(
@@ -231,28 +454,117 @@ def get_engine():
         kwargs = {}
         if DATABASE_URL.startswith('sqlite'):
             kwargs['creator'] = lambda: sqlite_disk_conn
-        engine = create_engine(
-            DATABASE_URL,
-            poolclass=sqlalchemy.pool.StaticPool,
-            **kwargs,
-        )
+            kwargs['poolclass'] = sqlalchemy.pool.StaticPool
+        else:
+            kwargs.update(get_pool_kwargs())
+        engine = create_engine(DATABASE_URL, **kwargs)
     if engine.url.get_backend_name() == 'sqlite':
         # https://stackoverflow.com/questions/2614984/sqlite-sqlalchemy-how-to-enforce-foreign-keys
         from sqlalchemy import event
 
-        event.listen(
-            engine, 'connect', lambda c, _: c.execute('pragma foreign_keys=on')
-        )
+        event.listen(engine, 'connect', lambda c, _: set_sqlite_pragmas(c))
     return engine
 
 
 engine = get_engine()
 
+# SQLite is used through a single shared connection,
+# so requests can't run concurrently in separate transactions.
+GRANULAR_LOCKING = LOCKING_MODE == 'granular' and engine.name != 'sqlite'
+if LOCKING_MODE == 'granular' and not GRANULAR_LOCKING:
+    logger.warning(
+        'OTREE_LOCKING=granular requires a database server such as Postgres. '
+        'Falling back to global locking.'
+    )
+
 DBSession = sessionmaker(bind=engine)
 
+
+def _copy_to_memory(source_conn: sqlite3.Connection) -> sqlite3.Connection:
+    copy_conn = get_mem_conn()
+    source_conn.backup(copy_conn)
+    return copy_conn
+
+
+def copy_sqlite_db():
+    '''
+    For long reads (like data exports) that run in a background thread.
+    With SQLite, all requests share a single connection,
+    so instead we copy the DB into a new in-memory DB (with SQLite's backup API),
+    and return an engine for that copy. The caller should dispose() it when done.
+    Should be called while holding the lock, so that no request is half-done.
+    Note that this duplicates the whole DB in memory for as long as the read runs,
+    so each concurrent export needs as much RAM as the DB itself.
+    '''
+    copy_conn = _copy_to_memory(sqlite_mem_conn if IN_MEMORY else sqlite_disk_conn)
+    return create_engine(
+        'sqlite://',
+        creator=lambda: copy_conn,
+        poolclass=sqlalchemy.pool.StaticPool,
+    )
+
+
+def snapshot_connection():
+    '''
+    Like copy_sqlite_db, but for a DB server. Returns a connection whose transaction
+    is REPEATABLE READ, so all its queries see the DB as of when this was called,
+    rather than what other requests commit in the meantime.
+    The caller should close() it when done. Should be called while holding the lock.
+    '''
+    connection = engine.execution_options(isolation_level='REPEATABLE READ').connect()
+    connection.begin()
+    # Postgres takes the snapshot at the transaction's first query, not at BEGIN.
+    connection.execute(sqlalchemy.text('SELECT 1'))
+    return connection
+
+
+def get_snapshot_bind():
+    '''
+    A bind for db.private_session() that sees the DB as of when this was called,
+    for long reads (like data exports) that other requests shouldn't have to wait for.
+    Should be called while holding the lock. Close it with close_snapshot_bind().
+    '''
+    if engine.name == 'sqlite':
+        return copy_sqlite_db()
+    return snapshot_connection()
+
+
+def close_snapshot_bind(bind):
+    if isinstance(bind, sqlalchemy.engine.Connection):
+        # also ends the snapshot transaction
+        bind.close()
+    else:
+        bind.dispose()
+
 ephemeral_connection = None
 
 
+class QueryCounter:
+    count = 0
+
+
+# a request's code runs in several tasks and threads,
+# which all get a copy of the context, but share the same QueryCounter.
+_query_counter = ContextVar('_query_counter', default=None)
+
+
+@contextmanager
+def count_queries():
+    counter = QueryCounter()
+    token = _query_counter.set(counter)
+    try:
+        yield counter
+    finally:
+        _query_counter.reset(token)
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+def _increment_query_count(conn, cursor, statement, parameters, context, executemany):
+    counter = _query_counter.get()
+    if counter is not None:
+        counter.count += 1
+
+
 class VarsDescriptor:
     def __init__(self, attr):
         self.attr = attr
@@ -323,6 +635,8 @@ def init_orm():
 
     configure_mappers()
     AnyModel.metadata.create_all(engine)
+    if engine.name != 'sqlite':
+        convert_text_pickle_columns()
 
     if (
         IN_MEMORY
@@ -337,6 +651,7 @@ def init_orm():
 
 class AnyModel(DeclarativeBase):
     __abstract__ = True
+    __mapper_args__ = dict(_compiled_cache_size=COMPILED_CACHE_SIZE)
 
     id = Column(st.Integer, primary_key=True)
 
@@ -447,24 +762,21 @@ class RealWorldCurrencyType(BaseCurrencyType):
     MONEY_CLASS = RealWorldCurrency
 
 
+# the recently accessed attributes are only shown in __repr__,
+# which is mostly seen in the locals on the debug error page.
+# in production mode, we skip this bookkeeping, since it runs on every attribute access.
+TRACK_RECENT_ATTRIBUTES = settings.DEBUG
+
+
 class MRU:
+    _ignored = frozenset(['id', 'group', 'subsession', 'session', 'participant'])
+
     def __init__(self):
         self._d = defaultdict(int)
         self._count = 0
 
     def add(self, item):
-        if (
-            item.startswith('_')
-            or item.endswith('_id')
-            or item
-            in [
-                'id',
-                'group',
-                'subsession',
-                'session',
-                'participant',
-            ]
-        ):
+        if item.startswith('_') or item.endswith('_id') or item in self._ignored:
             return
         # make it a bit bigger than we need because we will need to throw out methods
         self._count += 1
@@ -482,6 +794,21 @@ class MRU:
 mru_dict = defaultdict(MRU)
 
 
+# create_session inserts rows without creating ORM objects,
+# so creating_session loads them from the DB instead.
+# they should behave like just-created objects, which are not frozen yet.
+_unfrozen_loads = ContextVar('_unfrozen_loads', default=False)
+
+
+@contextmanager
+def unfrozen_loads():
+    token = _unfrozen_loads.set(True)
+    try:
+        yield
+    finally:
+        _unfrozen_loads.reset(token)
+
+
 class SSPPGModel(AnyModel):
     __abstract__ = True
 
@@ -492,7 +819,7 @@ class SSPPGModel(AnyModel):
         # nonexistent fields can be set in creating_session because the Participant
         # was just created, and init_on_load did not get run yet.
         # but that's OK because anywhere else, users will be told.
-        self._is_frozen = True
+        self._is_frozen = not _unfrozen_loads.get()
 
     NoneType = type(None)
 
@@ -513,20 +840,30 @@ class SSPPGModel(AnyModel):
     _setattr_whitelist = {
         '_is_frozen',
     }
+    # set by freeze_setattr. declared here so that the checks
+    # don't mistake it for a user-defined attribute.
+    _setattr_field_types = None
+
+    @classmethod
+    def freeze_setattr(cls):
+        super().freeze_setattr()
+        # so that __setattr__ doesn't need to look up the column's type
+        cls._setattr_field_types = {
+            f.name: cls._setattr_datatypes.get(type(f.type))
+            for f in cls.__table__.columns
+        }
 
     def __setattr__(self, field_name: str, value):
         """note: this is not yet active in creating_session"""
-        if self._is_frozen and hasattr(self, '_setattr_fields'):
-
-            if field_name in self._setattr_fields:
-                # hasattr() cannot be used inside
-                # a Django model's setattr, as I discovered.
-                field = self.__table__.columns[field_name]
-
-                field_type_name = type(field.type)
+        # object.__getattribute__ skips SPGModel.__getattribute__
+        cls = type(self)
+        if object.__getattribute__(self, '_is_frozen') and hasattr(
+            cls, '_setattr_fields'
+        ):
 
-                if field_type_name in self._setattr_datatypes:
-                    allowed_types = self._setattr_datatypes[field_type_name]
+            if field_name in cls._setattr_fields:
+                allowed_types = cls._setattr_field_types[field_name]
+                if allowed_types is not None:
                     if not isinstance(value, allowed_types):
                         # numpy uses its own data types.
                         # for example:
@@ -551,8 +888,8 @@ class SSPPGModel(AnyModel):
                             )
                             raise TypeError(msg)
             elif (
-                field_name in self._setattr_attributes
-                or field_name in self._setattr_whitelist
+                field_name in cls._setattr_attributes
+                or field_name in cls._setattr_whitelist
             ):
                 pass
             else:
@@ -560,7 +897,8 @@ class SSPPGModel(AnyModel):
                     self.__class__.__name__, field_name
                 ) + self._SETATTR_NO_FIELD_HINT
                 raise AttributeError(msg)
-            mru_dict[type(self)].add(field_name)
+            if TRACK_RECENT_ATTRIBUTES:
+                mru_dict[cls].add(field_name)
             super().__setattr__(field_name, value)
         else:
             # super() is a bit slower but only gets run during __init__
@@ -583,9 +921,12 @@ class SPGModel(SSPPGModel):
         # failure until it is actually accessed. on the error page when we show local vars,
         # we want to show the recently accessed attributes.
         # also, setattr is already defined at the SSPPG level, and we don't want to override it.
-        mru_dict[type(self)].add(attr)
-        res = super().__getattribute__(attr)
-        if res is None and super().__getattribute__('_is_frozen'):
+        if TRACK_RECENT_ATTRIBUTES:
+            mru_dict[type(self)].add(attr)
+        # this is on the hot path, and object.__getattribute__ is faster than super().
+        # none of the base classes override __getattribute__.
+        res = object.__getattribute__(self, attr)
+        if res is None and object.__getattribute__(self, '_is_frozen'):
             object_name = self.__class__.__name__.lower()
             # 2 ways for users to work around this:
             # - set the initial value to something other than None
@@ -609,6 +950,8 @@ class SPGModel(SSPPGModel):
             return None
 
     def _get_repr_attributes(self):
+        if not TRACK_RECENT_ATTRIBUTES:
+            return super()._get_repr_attributes()
         cls = type(self)
         colnames = [f.name for f in cls.__table__.columns]
         items = []
@@ -745,6 +1088,11 @@ def make_get_display_dynamic(name):
 
 
 class VarsDict(Mutable, dict):
+    # the pickled value as it is in the DB, to tell whether it was modified.
+    _db_bytes = None
+    # pickled in before_flush, so that process_bind_param doesn't pickle it again.
+    _flush_bytes = None
+
     @classmethod
     def coerce(cls, key, value):
         if not isinstance(value, VarsDict):
@@ -757,28 +1105,130 @@ class VarsDict(Mutable, dict):
             return value
 
 
+def _dump_vars(value) -> bytes:
+    return pickle.dumps(dict(value), protocol=pickle.HIGHEST_PROTOCOL)
+
+
 class _PickleField(types.TypeDecorator):
-    impl = types.Text
+    """
+    stores the pickled dict as raw bytes.
+    These columns used to be text holding base64. On SQLite, old databases are
+    deleted when oTree is updated (see load_in_memory_db), except with OTREE_CORE_DEV,
+    so we still load base64. On Postgres, see convert_text_pickle_columns.
+    """
+
+    impl = types.LargeBinary
 
     def process_bind_param(self, value, dialect):
         # for some reason this doesn't print the actual VarsError, but rather
         # a really ugly sqlalchemy.exc.StatementError.
         # scan_for_model_instances(value)
-        return binascii.b2a_base64(pickle.dumps(dict(value))).decode('utf-8')
+        return _dump_vars(value)
+
+    def process_result_value(self, value, dialect):
+        return pickle.loads(self._to_bytes(value))
+
+    def _to_bytes(self, value) -> bytes:
+        if isinstance(value, str):
+            return binascii.a2b_base64(value.encode('utf-8'))
+        return bytes(value)
+
+
+class _VarsField(_PickleField):
+    """remembers the bytes loaded from the DB, so we can tell if vars was modified."""
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, VarsDict):
+            data = value._flush_bytes or _dump_vars(value)
+            value._flush_bytes = None
+            value._db_bytes = data
+            return data
+        return _dump_vars(value)
 
     def process_result_value(self, value, dialect):
-        return pickle.loads(binascii.a2b_base64(value.encode('utf-8')))
+        data = self._to_bytes(value)
+        loaded = VarsDict(pickle.loads(data))
+        loaded._db_bytes = data
+        return loaded
+
+
+def convert_text_pickle_columns():
+    """
+    create_all() doesn't change columns of tables that already exist,
+    so a DB created before vars were stored as bytes still has text columns,
+    which Postgres won't write bytes to.
+    """
+    inspector = sqlalchemy.inspect(engine)
+    table_names = set(inspector.get_table_names())
+    for table in AnyModel.metadata.sorted_tables:
+        pickle_columns = [
+            c.name for c in table.columns if isinstance(c.type, _PickleField)
+        ]
+        if not pickle_columns or table.name not in table_names:
+            continue
+        db_types = {c['name']: c['type'] for c in inspector.get_columns(table.name)}
+        for name in pickle_columns:
+            if isinstance(db_types.get(name), st.LargeBinary):
+                continue
+            if engine.name != 'postgresql':
+                logger.warning(
+                    f'Column {table.name}.{name} has an outdated type. '
+                    'Please run "otree resetdb".'
+                )
+                continue
+            logger.info(f'Converting {table.name}.{name} to bytea')
+            with engine.begin() as conn:
+                conn.execute(
+                    f'ALTER TABLE "{table.name}" ALTER COLUMN "{name}" '
+                    f"TYPE bytea USING decode(\"{name}\", 'base64')"
+                )
+
+
+VARS_ACCESSED_KEY = 'otree_vars_accessed'
 
 
 class MixinVars:
-    _vars = Column(VarsDict.as_mutable(_PickleField), default=VarsDict)
+    _vars = Column(VarsDict.as_mutable(_VarsField), default=VarsDict)
 
     @property
     def vars(self):
-        self._vars.changed()
+        # vars can contain nested lists and dicts that are modified in place,
+        # so we can't track changes as they happen.
+        # instead, before_flush compares it with what's in the DB,
+        # so that just reading vars doesn't cause an UPDATE.
+        session = object_session(self)
+        if session is not None:
+            session.info.setdefault(VARS_ACCESSED_KEY, set()).add(self)
         return self._vars
 
 
+# before_flush is not called if nothing else was modified,
+# so this also needs to run before commit.
+@event.listens_for(DBSession, 'before_commit')
+@event.listens_for(DBSession, 'before_flush')
+def _flag_modified_vars(session, *args):
+    for obj in session.info.get(VARS_ACCESSED_KEY, ()):
+        state = sqlalchemy.inspect(obj)
+        # don't trigger a load if it was expired
+        value = state.dict.get('_vars')
+        if value is None or state.detached or state.deleted or obj in session.deleted:
+            continue
+        if value._flush_bytes is not None:
+            # already flagged by before_commit, and nothing could modify it since then.
+            continue
+        data = _dump_vars(value)
+        if data != value._db_bytes:
+            value._flush_bytes = data
+            flag_modified(obj, '_vars')
+
+
+@event.listens_for(DBSession, 'after_commit')
+@event.listens_for(DBSession, 'after_soft_rollback')
+def _forget_accessed_vars(session, *args):
+    session.info.pop(VARS_ACCESSED_KEY, None)
+    session.info.pop(TRANSACTION_CACHE_KEY, None)
+
+
 AUTO_SUBMIT_DEFAULTS = {
     st.Boolean: False,
     st.Integer: 0,
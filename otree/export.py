@@ -4,7 +4,9 @@ import logging
 import numbers
 from collections import OrderedDict
 from collections import defaultdict
+from decimal import Decimal
 from html import escape
+from io import StringIO
 from typing import List
 
 from sqlalchemy.sql.functions import func
@@ -135,6 +137,15 @@ def sanitize_for_csv(value):
     return value.replace('\n', ' ').replace('\r', ' ')
 
 
+def sanitize_typed(value):
+    '''for formats like parquet that have typed columns (see otree.export_formats)'''
+    if isinstance(value, (Currency, RealWorldCurrency)):
+        return Decimal(value)
+    if value is None or isinstance(value, (numbers.Number, str)):
+        return value
+    return str(value)
+
+
 def tweak_player_values_dict(player: dict, group_id_in_subsession=None):
     '''because these are actually properties, the DB field starts with _.'''
     player['payoff'] = player['_payoff']
@@ -183,7 +194,13 @@ def _get_best_app_order(sessions):
     return list(most_common_app_sequence) + apps_not_in_popular_sequence
 
 
-def get_rows_for_wide_csv(session_code):
+def get_rows_for_wide_csv(session_code=None, sanitize=sanitize_for_csv):
+    """
+    Yields the rows one session at a time, so that memory usage doesn't grow
+    with the number of sessions in the DB.
+    Between rows, the generator doesn't hold on to any ORM objects or open cursors,
+    so it can be advanced in separate transactions (see views.export).
+    """
     if session_code:
         sessions = [Session.objects_get(code=session_code)]
     else:
@@ -191,42 +208,39 @@ def get_rows_for_wide_csv(session_code):
     session_fields = get_fields_for_csv(Session)
     participant_fields = get_fields_for_csv(Participant)
 
-    session_ids = [session.id for session in sessions]
-    pps = (
-        Participant.objects_filter(Participant.session_id.in_(session_ids))
-        .order_by(Participant.id)
-        .all()
-    )
-    session_cache = {row.id: row for row in sessions}
-
     session_config_fields = {'name'}
     for session in sessions:
         for field_name in SessionConfig(session.config).editable_fields():
             session_config_fields.add(field_name)
     session_config_fields = list(session_config_fields)
 
-    if not pps:
+    pp_query = dbq(Participant.id)
+    if session_code:
+        pp_query = pp_query.filter(Participant.session_id == sessions[0].id)
+    if not pp_query.first():
         # 1 empty row
-        return [[]]
-
-    header_row = [f'participant.{fname}' for fname in participant_fields]
-    header_row += [f'participant.{fname}' for fname in settings.PARTICIPANT_FIELDS]
-    header_row += [f'session.{fname}' for fname in session_fields]
-    header_row += [f'session.config.{fname}' for fname in session_config_fields]
-    header_row += [f'session.{fname}' for fname in settings.SESSION_FIELDS]
-    rows = [header_row]
-
-    for pp in pps:
-        session = session_cache[pp.session_id]
-        row = [getattr(pp, fname) for fname in participant_fields]
-        row += [pp.vars.get(fname, None) for fname in settings.PARTICIPANT_FIELDS]
-        row += [getattr(session, fname) for fname in session_fields]
-        row += [session.config.get(fname) for fname in session_config_fields]
-        row += [session.vars.get(fname, None) for fname in settings.SESSION_FIELDS]
-        rows.append(row)
+        yield []
+        return
 
     order_of_apps = _get_best_app_order(sessions)
 
+    # the values of the session columns, so that we don't need to keep the
+    # Session objects around
+    session_infos = []
+    for session in sessions:
+        values = [getattr(session, fname) for fname in session_fields]
+        values += [session.config.get(fname) for fname in session_config_fields]
+        values += [session.vars.get(fname, None) for fname in settings.SESSION_FIELDS]
+        session_infos.append(
+            dict(
+                id=session.id,
+                code=session.code,
+                num_participants=session.num_participants,
+                values=values,
+            )
+        )
+    del sessions
+
     rounds_per_app = OrderedDict()
     for app_name in order_of_apps:
         try:
@@ -246,16 +260,55 @@ def get_rows_for_wide_csv(session_code):
 
         if highest_round_number is not None:
             rounds_per_app[app_name] = highest_round_number
+
+    header_row = [f'participant.{fname}' for fname in participant_fields]
+    header_row += [f'participant.{fname}' for fname in settings.PARTICIPANT_FIELDS]
+    header_row += [f'session.{fname}' for fname in session_fields]
+    header_row += [f'session.config.{fname}' for fname in session_config_fields]
+    header_row += [f'session.{fname}' for fname in settings.SESSION_FIELDS]
     for app_name in rounds_per_app:
         for round_number in range(1, rounds_per_app[app_name] + 1):
-            new_rows = get_rows_for_wide_csv_round(app_name, round_number, sessions)
-            for i in range(len(rows)):
-                rows[i].extend(new_rows[i])
+            header_row += get_header_for_wide_csv_round(app_name, round_number)
+    yield header_row
+
+    for session in session_infos:
+        pps = Participant.values_dicts(session_id=session['id'], order_by='id')
+        rows = []
+        for pp in pps:
+            row = [pp[fname] for fname in participant_fields]
+            row += [
+                pp['_vars'].get(fname, None) for fname in settings.PARTICIPANT_FIELDS
+            ]
+            row += session['values']
+            rows.append(row)
+        for app_name in rounds_per_app:
+            app_rows = get_rows_for_wide_csv_app(
+                app_name, rounds_per_app[app_name], session
+            )
+            for row, app_row in zip(rows, app_rows):
+                row.extend(app_row)
+        for row in rows:
+            yield [sanitize(v) for v in row]
 
-    return [[sanitize_for_csv(v) for v in row] for row in rows]
 
+def get_header_for_wide_csv_round(app_name, round_number):
+    models_module = otree.common.get_models_module(app_name)
+    header_row = []
+    for model_name, Model in [
+        ('player', models_module.Player),
+        ('group', models_module.Group),
+        ('subsession', models_module.Subsession),
+    ]:
+        for fname in get_fields_for_csv(Model):
+            header_row.append(f'{app_name}.{round_number}.{model_name}.{fname}')
+    return header_row
 
-def get_rows_for_wide_csv_round(app_name, round_number, sessions: List[Session]):
+
+def get_rows_for_wide_csv_app(app_name, num_rounds, session: dict):
+    """
+    returns a row for each participant in the session,
+    containing the columns for all rounds of the app.
+    """
 
     models_module = otree.common.get_models_module(app_name)
     Player: BasePlayer = models_module.Player
@@ -265,58 +318,51 @@ def get_rows_for_wide_csv_round(app_name, round_number, sessions: List[Session])
     gfields = get_fields_for_csv(Group)
     sfields = get_fields_for_csv(Subsession)
 
-    rows = []
-    group_cache = {
-        row['id']: row for row in Group.values_dicts(round_number=round_number)
+    subsessions = {
+        row['round_number']: row
+        for row in Subsession.values_dicts(session_id=session['id'])
     }
+    groups = {row['id']: row for row in Group.values_dicts(session_id=session['id'])}
+    players_by_round = defaultdict(list)
+    for player in Player.values_dicts(session_id=session['id'], order_by='id'):
+        players_by_round[player['round_number']].append(player)
+
+    num_participants = session['num_participants']
+    rows = [[] for _ in range(num_participants)]
+    empty_row = [None for _ in range(len(pfields) + len(gfields) + len(sfields))]
+
+    for round_number in range(1, num_rounds + 1):
+        subsession = subsessions.get(round_number)
+        if not subsession:
+            for row in rows:
+                row.extend(empty_row)
+            continue
+        players = players_by_round[round_number]
+        if len(players) != num_participants:
+            msg = (
+                f"Session {session['code']} has {num_participants} participants, "
+                f"but round {round_number} of app '{app_name}' "
+                f"has {len(players)} players. The number of players in the subsession "
+                "should always match the number of players in the session. "
+                "Please report this issue and then reset the database."
+            )
+            raise AssertionError(msg)
 
-    header_row = []
-    for model_name, fields in [
-        ('player', pfields),
-        ('group', gfields),
-        ('subsession', sfields),
-    ]:
-        for fname in fields:
-            header_row.append(f'{app_name}.{round_number}.{model_name}.{fname}')
-    rows.append(header_row)
-    empty_row = ['' for _ in range(len(header_row))]
+        for row, player in zip(rows, players):
+            group = groups[player['group_id']]
+            tweak_player_values_dict(player)
 
-    for session in sessions:
-        subsessions = Subsession.values_dicts(
-            session_id=session.id, round_number=round_number
-        )
-        if not subsessions:
-            subsession_rows = [empty_row for _ in range(session.num_participants)]
-        else:
-            [subsession] = subsessions
-            players = Player.values_dicts(subsession_id=subsession['id'], order_by='id')
-
-            if len(players) != session.num_participants:
-                msg = (
-                    f"Session {session.code} has {session.num_participants} participants, "
-                    f"but round {round_number} of app '{app_name}' "
-                    f"has {len(players)} players. The number of players in the subsession "
-                    "should always match the number of players in the session. "
-                    "Please report this issue and then reset the database."
-                )
-                raise AssertionError(msg)
-
-            subsession_rows = []
-
-            for player in players:
-                group = group_cache[player['group_id']]
-                tweak_player_values_dict(player)
-
-                row = [player[fname] for fname in pfields]
-                row += [group[fname] for fname in gfields]
-                row += [subsession[fname] for fname in sfields]
-
-                subsession_rows.append(row)
-        rows.extend(subsession_rows)
+            row.extend(player[fname] for fname in pfields)
+            row.extend(group[fname] for fname in gfields)
+            row.extend(subsession[fname] for fname in sfields)
     return rows
 
 
-def get_rows_for_csv(app_name):
+def get_rows_for_csv(app_name, sanitize=sanitize_for_csv, session_code=None):
+    """
+    Yields the rows one session at a time.
+    Like get_rows_for_wide_csv, it doesn't hold on to ORM objects between rows.
+    """
     # need to use app_name and not app_label because the app might have been
     # removed from SESSION_CONFIGS
     models_module = otree.common.get_models_module(app_name)
@@ -329,43 +375,46 @@ def get_rows_for_csv(app_name):
         for Model in [Player, Group, Subsession, Participant, Session]
     }
 
-    session_ids = values_flat(dbq(Subsession), Subsession.session_id)
-
-    players = Player.values_dicts(order_by='id')
-
-    value_dicts = dict(
-        group={row['id']: row for row in Group.values_dicts()},
-        subsession={row['id']: row for row in Subsession.values_dicts()},
-        # before we used Participant.id.in_(...)
-        # but a user got an error that the "in" clause of the query had too many vars
-        participant={
-            row['id']: row
-            for row in Participant.values_dicts(Participant.session_id.in_(session_ids))
-        },
-        session={
-            row['id']: row for row in Session.values_dicts(Session.id.in_(session_ids))
-        },
+    subsessions = dbq(Subsession)
+    if session_code:
+        subsessions = subsessions.join(Session).filter(Session.code == session_code)
+    session_ids = values_flat(
+        subsessions.distinct().order_by(Subsession.session_id), Subsession.session_id,
     )
 
     model_order = ['participant', 'player', 'group', 'subsession', 'session']
 
     # header row
-    rows = [[f'{m}.{col}' for m in model_order for col in columns_for_models[m]]]
-
-    for player in players:
-        tweak_player_values_dict(player)
-        row = []
-
-        for model_name in model_order:
-            if model_name == 'player':
-                obj = player
-            else:
-                obj = value_dicts[model_name][player[f'{model_name}_id']]
-            for colname in columns_for_models[model_name]:
-                row.append(sanitize_for_csv(obj[colname]))
-        rows.append(row)
+    yield [f'{m}.{col}' for m in model_order for col in columns_for_models[m]]
 
-    return rows
+    for session_id in session_ids:
+        players = Player.values_dicts(session_id=session_id, order_by='id')
+        # before we used Participant.id.in_(...)
+        # but a user got an error that the "in" clause of the query had too many vars
+        value_dicts = dict(
+            group={row['id']: row for row in Group.values_dicts(session_id=session_id)},
+            subsession={
+                row['id']: row for row in Subsession.values_dicts(session_id=session_id)
+            },
+            participant={
+                row['id']: row
+                for row in Participant.values_dicts(session_id=session_id)
+            },
+            session={row['id']: row for row in Session.values_dicts(id=session_id)},
+        )
+
+        for player in players:
+            tweak_player_values_dict(player)
+            row = []
+
+            for model_name in model_order:
+                if model_name == 'player':
+                    obj = player
+                else:
+                    obj = value_dicts[model_name][player[f'{model_name}_id']]
+                for colname in columns_for_models[model_name]:
+                    row.append(sanitize(obj[colname]))
+            yield row
 
 
 def get_rows_for_monitor(participants) -> list:
@@ -434,7 +483,7 @@ def export_app(app_name, fp):
 from sqlalchemy.orm import joinedload
 
 
-def custom_export_app(app_name, fp):
+def get_rows_for_custom_export(app_name, sanitize=sanitize_for_csv):
     models_module = get_models_module(app_name)
     Player = models_module.Player
     qs = list(
@@ -450,11 +499,12 @@ def custom_export_app(app_name, fp):
     for player in qs:
         # need this to query null values
         player._is_frozen = False
-    rows = models_module.custom_export(qs)
-    str_rows = []
-    for row in rows:
-        str_rows.append([sanitize_for_csv(ele) for ele in row])
-    _export_csv(fp, str_rows)
+    for row in models_module.custom_export(qs):
+        yield [sanitize(ele) for ele in row]
+
+
+def custom_export_app(app_name, fp):
+    _export_csv(fp, get_rows_for_custom_export(app_name))
 
 
 def _export_csv(fp, rows):
@@ -462,12 +512,51 @@ def _export_csv(fp, rows):
     writer.writerows(rows)
 
 
-def export_page_times(fp):
+def iter_csv(rows, rows_per_chunk=500, prefix=''):
+    """
+    Yields the CSV as text, in chunks of rows_per_chunk rows.
+    """
+    buf = StringIO()
+    buf.write(prefix)
+    writer = csv.writer(buf)
+    for i, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if i % rows_per_chunk == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    text = buf.getvalue()
+    if text:
+        yield text
+
+
+def get_page_times_chunks():
+    write_page_completion_buffer()
+    yield ','.join(TimeSpentRow.__annotations__.keys()) + '\n'
+    batch_ids = values_flat(dbq(PageTimeBatch).order_by('id'), PageTimeBatch.id)
+    for batch_id in batch_ids:
+        [text] = dbq(PageTimeBatch.text).filter(PageTimeBatch.id == batch_id).one()
+        yield text
+
+
+def get_rows_for_page_times():
+    '''the same data as get_page_times_chunks, but as rows with typed values'''
     write_page_completion_buffer()
-    batches = values_flat(dbq(PageTimeBatch).order_by('id'), PageTimeBatch.text)
-    fp.write(','.join(TimeSpentRow.__annotations__.keys()) + '\n')
-    for batch in batches:
-        fp.write(batch)
+    column_types = list(TimeSpentRow.__annotations__.values())
+    yield list(TimeSpentRow.__annotations__.keys())
+    batch_ids = values_flat(dbq(PageTimeBatch).order_by('id'), PageTimeBatch.id)
+    for batch_id in batch_ids:
+        [text] = dbq(PageTimeBatch.text).filter(PageTimeBatch.id == batch_id).one()
+        for row in csv.reader(StringIO(text)):
+            yield [
+                coltype(value) if value != '' else None
+                for coltype, value in zip(column_types, row)
+            ]
+
+
+def export_page_times(fp):
+    for text in get_page_times_chunks():
+        fp.write(text)
 
 
 BOM = '\ufeff'
@@ -0,0 +1,439 @@
+"""
+Output formats for data export.
+
+The row generators in otree.export yield a header row followed by data rows.
+These functions turn them into chunks of bytes, for streaming to the browser.
+
+- csv, csv.gz, csv.zst: values are converted to text by sanitize_for_csv.
+- parquet: typed columns (currency as decimal, booleans as bool, etc).
+  Requires pyarrow. If it's not installed, we write columns.jsonl instead,
+  which has the same column types but doesn't need any extra packages.
+"""
+import json
+import logging
+import zlib
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy.sql import sqltypes as st
+
+from otree import settings
+from otree.common import get_models_module
+from otree.common2 import TimeSpentRow
+from otree.database import BaseCurrencyType, db, engine
+from otree.export import (
+    get_page_times_chunks,
+    get_rows_for_csv,
+    get_rows_for_custom_export,
+    get_rows_for_page_times,
+    get_rows_for_wide_csv,
+    iter_csv,
+    sanitize_for_csv,
+    sanitize_typed,
+)
+from otree.models.participant import Participant
+from otree.models.session import Session
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ['csv', 'csv.gz', 'csv.zst', 'parquet']
+TYPED_FORMATS = ['parquet', 'columns.jsonl']
+
+MIME_TYPES = {
+    'csv': 'text/csv',
+    'csv.gz': 'application/gzip',
+    'csv.zst': 'application/zstd',
+    'parquet': 'application/vnd.apache.parquet',
+    'columns.jsonl': 'application/x-ndjson',
+}
+
+# column types
+BOOL = 'bool'
+INT = 'int'
+FLOAT = 'float'
+DECIMAL = 'decimal'
+STR = 'str'
+
+CURRENCY_DECIMAL_PLACES = max(
+    settings.POINTS_DECIMAL_PLACES, settings.REAL_WORLD_CURRENCY_DECIMAL_PLACES, 2
+)
+
+
+class ExportFormatError(Exception):
+    pass
+
+
+def resolve_format(fmt: str) -> str:
+    '''the format that will actually be written'''
+    if fmt not in FORMATS:
+        raise ExportFormatError(f'Export format should be one of {FORMATS}, not "{fmt}"')
+    if fmt == 'parquet' and not has_pyarrow():
+        logger.warning(
+            'pyarrow is not installed, so exporting columns.jsonl instead of parquet'
+        )
+        return 'columns.jsonl'
+    return fmt
+
+
+def has_pyarrow():
+    try:
+        import pyarrow  # noqa
+    except ModuleNotFoundError:
+        return False
+    return True
+
+
+def is_typed(fmt):
+    return fmt in TYPED_FORMATS
+
+
+def get_sanitize(fmt):
+    return sanitize_typed if is_typed(fmt) else sanitize_for_csv
+
+
+def iter_wide(fmt, session_code=None, prefix=''):
+    rows = get_rows_for_wide_csv(session_code=session_code, sanitize=get_sanitize(fmt))
+    return iter_export(
+        rows, fmt, column_types_for_header=get_column_types, prefix=prefix
+    )
+
+
+def iter_app(fmt, app_name, prefix=''):
+    rows = get_rows_for_csv(app_name, sanitize=get_sanitize(fmt))
+    return iter_export(
+        rows,
+        fmt,
+        column_types_for_header=lambda header: get_column_types(header, app_name),
+        prefix=prefix,
+    )
+
+
+def iter_custom_export(fmt, app_name, prefix=''):
+    # the columns are defined by the user's code, so they are all strings.
+    rows = get_rows_for_custom_export(app_name, sanitize=get_sanitize(fmt))
+    return iter_export(rows, fmt, prefix=prefix)
+
+
+def iter_page_times(fmt):
+    if fmt == 'csv':
+        return (text.encode('utf8') for text in get_page_times_chunks())
+    if fmt == 'csv.gz':
+        return _iter_compressed(get_page_times_chunks(), zlib.compressobj(wbits=31))
+    if fmt == 'csv.zst':
+        return _iter_compressed(get_page_times_chunks(), get_zstd_compressor())
+    python_types = {int: INT, str: STR}
+    return iter_export(
+        get_rows_for_page_times(),
+        fmt,
+        column_types_for_header=lambda header: [
+            python_types[t] for t in TimeSpentRow.__annotations__.values()
+        ],
+    )
+
+
+def iter_export(rows, fmt, *, column_types_for_header=None, prefix=''):
+    """
+    fmt should already be resolved with resolve_format().
+    column_types_for_header(header) returns a list with the type of each column,
+    or None for columns that should be written as strings.
+    prefix is only used for CSV (e.g. the BOM that Excel needs).
+    """
+    if fmt == 'csv':
+        return (text.encode('utf8') for text in iter_csv(rows, prefix=prefix))
+    if fmt == 'csv.gz':
+        # wbits=31 means gzip format rather than raw zlib
+        compressor = zlib.compressobj(wbits=31)
+        return _iter_compressed(iter_csv(rows, prefix=prefix), compressor)
+    if fmt == 'csv.zst':
+        return _iter_compressed(iter_csv(rows, prefix=prefix), get_zstd_compressor())
+
+    if fmt in TYPED_FORMATS:
+        return _iter_typed(rows, fmt, column_types_for_header)
+    raise ExportFormatError(f'Unknown export format: {fmt}')
+
+
+def _iter_typed(rows, fmt, column_types_for_header):
+    # a generator, so that nothing is queried until the first chunk is requested
+    rows = iter(rows)
+    header = next(rows)
+    types = [STR] * len(header)
+    if column_types_for_header:
+        types = [t or STR for t in column_types_for_header(header)]
+    if fmt == 'parquet':
+        yield from _iter_parquet(header, types, rows)
+    else:
+        yield from _iter_columns_jsonl(header, types, rows)
+
+
+def get_zstd_compressor():
+    try:
+        import zstandard
+    except ModuleNotFoundError:
+        raise ExportFormatError(
+            'To export .csv.zst files, you need to install zstandard ("pip3 install zstandard")'
+        ) from None
+    return zstandard.ZstdCompressor().compressobj()
+
+
+def _iter_compressed(text_chunks, compressor):
+    for text in text_chunks:
+        data = compressor.compress(text.encode('utf8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def get_column_types(header, app_name=None):
+    """
+    The types of the columns that are model fields.
+    Other columns (session config, participant & session fields) are None,
+    meaning they are written as strings.
+    (We can't infer their types from the values, because the file's schema
+    is written with the first chunk, and a later chunk might not fit it.)
+    header is from get_rows_for_wide_csv, or get_rows_for_csv if app_name is given.
+    """
+    if app_name:
+        models_module = get_models_module(app_name)
+    types = []
+    fields = []
+    for column_name in header:
+        parts = column_name.split('.')
+        if app_name:
+            # e.g. player.payoff
+            model_name, field_name = parts
+        elif parts[0] in ['participant', 'session']:
+            # e.g. participant.code, session.config.name
+            model_name, field_name = parts[0], '.'.join(parts[1:])
+        else:
+            # e.g. my_app.1.player.payoff
+            models_module = get_models_module(parts[0])
+            model_name, field_name = parts[2], parts[3]
+        if model_name == 'participant':
+            Model = Participant
+        elif model_name == 'session':
+            Model = Session
+        else:
+            Model = getattr(models_module, model_name.capitalize())
+        if model_name == 'player' and field_name in ['payoff', 'role']:
+            # see tweak_player_values_dict
+            field_name = '_' + field_name
+        types.append(_get_type_of_field(Model, field_name))
+        fields.append((Model, field_name))
+    if engine.name == 'sqlite':
+        _widen_mismatched_columns(header, types, fields)
+    return types
+
+
+# SQL conditions for a value that doesn't fit the column's type (see coerce).
+# only needed for SQLite, which lets you store any value in any column.
+SQLITE_MISMATCH_CONDITIONS = {
+    BOOL: "typeof({c}) NOT IN ('integer', 'null')",
+    INT: (
+        "typeof({c}) NOT IN ('integer', 'null') "
+        "AND NOT (typeof({c}) = 'real' AND {c} = CAST({c} AS INTEGER))"
+    ),
+    FLOAT: "typeof({c}) NOT IN ('integer', 'real', 'null')",
+}
+
+
+def _widen_mismatched_columns(header, types, fields):
+    '''
+    e.g. a float stored in an IntegerField.
+    such columns are written as strings, so that no values are lost.
+    this has to be checked before the schema is written, so we query the whole table
+    rather than waiting to see the values.
+    '''
+    # in the wide format, each round of an app has the same fields
+    fields_by_table = {}
+    for column_type, (Model, field_name) in zip(types, fields):
+        if column_type in SQLITE_MISMATCH_CONDITIONS:
+            table_fields = fields_by_table.setdefault(Model.__table__.name, {})
+            table_fields[field_name] = column_type
+    mismatched_fields = set()
+    for table_name, table_fields in fields_by_table.items():
+        conditions = [
+            SQLITE_MISMATCH_CONDITIONS[column_type].format(c=f'"{name}"')
+            for name, column_type in table_fields.items()
+        ]
+        conditions = [f'max({condition})' for condition in conditions]
+        sql = f'SELECT {", ".join(conditions)} FROM "{table_name}"'
+        mismatches = db._db.execute(sql).fetchone()
+        for name, mismatch in zip(table_fields, mismatches):
+            if mismatch:
+                mismatched_fields.add((table_name, name))
+    for i, (Model, field_name) in enumerate(fields):
+        if (Model.__table__.name, field_name) in mismatched_fields:
+            logger.warning(
+                f'Column {header[i]} has type {types[i]}, but contains values '
+                'of other types, so it will be exported as strings.'
+            )
+            types[i] = STR
+
+
+def _get_type_of_field(Model, field_name):
+    column = Model.__table__.columns.get(field_name)
+    if column is None:
+        return None
+    coltype = column.type
+    if isinstance(coltype, BaseCurrencyType):
+        return DECIMAL
+    if isinstance(coltype, st.Boolean):
+        return BOOL
+    if isinstance(coltype, st.Integer):
+        return INT
+    if isinstance(coltype, st.Float):
+        return FLOAT
+    if isinstance(coltype, st.String):
+        return STR
+    return None
+
+
+def _chunked(rows, rows_per_chunk):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == rows_per_chunk:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def coerce(value, column_type):
+    '''
+    raises ValueError if the value doesn't fit its column.
+    that shouldn't happen, since such columns are written as strings
+    (see _widen_mismatched_columns).
+    '''
+    if value is None:
+        return None
+    if column_type == STR:
+        return value if isinstance(value, str) else str(value)
+    try:
+        if column_type == BOOL:
+            if isinstance(value, (bool, int)):
+                return bool(value)
+        elif column_type == INT:
+            if isinstance(value, (bool, int)) or (
+                isinstance(value, float) and value.is_integer()
+            ):
+                return int(value)
+        elif column_type == FLOAT:
+            if isinstance(value, (int, float, Decimal)):
+                return float(value)
+        elif column_type == DECIMAL:
+            if isinstance(value, (int, float, Decimal)):
+                quantum = Decimal(10) ** -CURRENCY_DECIMAL_PLACES
+                return Decimal(value).quantize(quantum)
+    except InvalidOperation:
+        pass
+    raise ValueError(f'{value!r} is not a valid {column_type}')
+
+
+def _get_columns(header, types, chunk, warned_columns):
+    '''
+    converts a list of rows into a list of columns, with values of the given types.
+    Never raises, because the response has already started.
+    A value that still doesn't fit its column (e.g. a currency amount too big for
+    the decimal type) is written as null,
+    and the column is added to warned_columns, so that we only warn once per column.
+    '''
+    columns = []
+    for values, column_type, name in zip(zip(*chunk), types, header):
+        column = []
+        for value in values:
+            try:
+                column.append(coerce(value, column_type))
+            except ValueError as exc:
+                if name not in warned_columns:
+                    warned_columns.add(name)
+                    logger.warning(
+                        f'Column {name}: {exc}. Such values will be exported as null. '
+                        'Export to CSV to get the original values.'
+                    )
+                column.append(None)
+        columns.append(column)
+    return columns
+
+
+# parquet row groups should be fairly big
+ROWS_PER_COLUMN_CHUNK = 10000
+
+
+class _ChunkSink:
+    """
+    a file-like object that keeps track of its position (parquet needs that),
+    but lets us take out what has been written so far.
+    """
+
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _iter_parquet(header, types, rows):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_types = {
+        BOOL: pa.bool_(),
+        INT: pa.int64(),
+        FLOAT: pa.float64(),
+        DECIMAL: pa.decimal128(38, CURRENCY_DECIMAL_PLACES),
+        STR: pa.string(),
+    }
+    schema = pa.schema(
+        [pa.field(name, arrow_types[t]) for name, t in zip(header, types)]
+    )
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    warned_columns = set()
+    for chunk in _chunked(rows, ROWS_PER_COLUMN_CHUNK):
+        columns = _get_columns(header, types, chunk, warned_columns)
+        arrays = [
+            pa.array(values, type=field.type) for values, field in zip(columns, schema)
+        ]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def _iter_columns_jsonl(header, types, rows):
+    """
+    The first line has the column names and types.
+    Each following line has the values of up to ROWS_PER_COLUMN_CHUNK rows,
+    as a list of columns. Decimals are written as strings, to keep their precision.
+    For example, with pandas:
+        lines = open(path).read().splitlines()
+        names = json.loads(lines[0])['names']
+        df = pd.concat(
+            pd.DataFrame(dict(zip(names, json.loads(line)))) for line in lines[1:]
+        )
+    """
+    yield (json.dumps(dict(names=header, types=types)) + '\n').encode('utf8')
+    warned_columns = set()
+    for chunk in _chunked(rows, ROWS_PER_COLUMN_CHUNK):
+        columns = _get_columns(header, types, chunk, warned_columns)
+        yield (json.dumps(columns, default=str) + '\n').encode('utf8')
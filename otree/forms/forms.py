@@ -19,7 +19,52 @@ from . import widgets
 from ..i18n import core_gettext
 
 
+# these methods make a field depend on the instance,
+# so it can't be in the cached form class.
+DYNAMIC_FIELD_METHOD_SUFFIXES = ['choices', 'min', 'max']
+
+# (ModelClass, field names) -> (form class with the other fields, dynamic field names)
+_form_classes = {}
+
+
 def model_form(ModelClass, obj, only):
+    key = (ModelClass, tuple(only))
+    cached = _form_classes.get(key)
+    if cached is None:
+        target = obj.get_user_defined_target()
+        dynamic_names = [
+            name
+            for name in only
+            if any(
+                hasattr(target, f'{name}_{suffix}')
+                for suffix in DYNAMIC_FIELD_METHOD_SUFFIXES
+            )
+        ]
+        static_names = [name for name in only if name not in dynamic_names]
+        FormClass = make_form_class(ModelClass, obj, static_names, base_class=ModelForm)
+        cached = _form_classes[key] = (FormClass, dynamic_names)
+    FormClass, dynamic_names = cached
+    if dynamic_names:
+        FormClass = make_form_class(ModelClass, obj, dynamic_names, base_class=FormClass)
+    return FormClass
+
+
+def make_form_class(ModelClass, obj, names, base_class):
+    '''same as wtforms_sqlalchemy.orm.model_form, but only looks at the given
+    fields rather than iterating over all properties of the model.'''
+    mapper = ModelClass._sa_class_manager.mapper
+    field_args = get_field_args(ModelClass, obj, names)
+    field_dict = {}
+    for name in names:
+        field = converter.convert(
+            ModelClass, mapper, mapper.get_property(name), field_args[name]
+        )
+        if field is not None:
+            field_dict[name] = field
+    return type(f'{ModelClass.__name__}Form', (base_class,), field_dict)
+
+
+def get_field_args(ModelClass, obj, only):
     field_args = {}
 
     for name in only:
@@ -87,13 +132,7 @@ def model_form(ModelClass, obj, only):
             fa['widget'] = widget
         field_args[name] = fa
 
-    return wtforms_sqlalchemy.orm.model_form(
-        model=ModelClass,
-        base_class=ModelForm,
-        only=only,
-        converter=ModelConverter(),
-        field_args=field_args,
-    )
+    return field_args
 
 
 def get_form(instance, field_names, view, formdata):
@@ -159,6 +198,9 @@ class ModelConverter(wtforms_sqlalchemy.orm.ModelConverterBase):
         ) or fields.CurrencyField(**field_args)
 
 
+converter = ModelConverter()
+
+
 def bool_from_form_value(val):
     # when using test clients, we might get a non-string type
     # javascript uses 'false'
@@ -1,17 +1,158 @@
+"""
+Messages sent with liveSend() are handled in a queue per group,
+by a task that calls the live_method for each message in order.
+So messages within a group are handled in the order they arrive,
+and the websocket can keep receiving messages while the live_method runs.
+With granular locking, live methods run in the threadpool,
+so different groups run at the same time.
+(With the default global lock, groups take turns.)
+Each message's queue depth, time waiting in the queue, and time in the handler
+are logged to 'otree.perf' at DEBUG level.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+from sqlalchemy import bindparam
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import joinedload
+from starlette.concurrency import run_in_threadpool
+
 import otree.common
 from otree.channels import utils as channel_utils
 from otree.models import Participant, BasePlayer, BaseGroup
 from otree.lookup import get_page_lookup
-import logging
-from otree.database import NoResultFound
+from otree.database import GRANULAR_LOCKING, NoResultFound, count_queries, db
 
 logger = logging.getLogger(__name__)
+perf_logger = logging.getLogger('otree.perf')
+
+# so that the queries that run on every message are only compiled once
+bakery = baked.bakery()
+
+
+class LiveDispatcher:
+    def __init__(self):
+        # key -> deque of (time enqueued, coroutine function)
+        self._queues = {}
+
+    def enqueue(self, key, handle):
+        '''handle is a coroutine function that takes no arguments'''
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            asyncio.ensure_future(self._run(key, queue))
+        queue.append((time.time(), handle))
+
+    async def _run(self, key, queue):
+        try:
+            while queue:
+                enqueued_at, handle = queue.popleft()
+                start = time.time()
+                with count_queries() as query_counter:
+                    try:
+                        await handle()
+                    except Exception:
+                        logger.exception('Error in live method')
+                end = time.time()
+                perf_logger.debug(
+                    f'live {key} queue_depth={len(queue)} '
+                    f'wait={int((start - enqueued_at) * 1000)}ms '
+                    f'own_time={int((end - start) * 1000)}ms '
+                    f'queries={query_counter.count}'
+                )
+        finally:
+            # there's no await between the check that the queue is empty and this,
+            # so nothing can be added in between.
+            del self._queues[key]
+
+
+live_dispatcher = LiveDispatcher()
+
+
+def live_queue_key(session_code, page_index, group_id):
+    return ('live', session_code, page_index, group_id)
+
+
+def get_live_connection_info(participant_code, session_code, page_index):
+    """
+    returns (group_id, is_browser_bot) for a participant who connects to a live page,
+    or None if the page doesn't exist anymore (e.g. the session was deleted).
+    """
+    try:
+        lookup = get_page_lookup(session_code, page_index)
+    except (KeyError, NoResultFound):
+        return None
+    Player = otree.common.get_models_module(lookup.app_name).Player
+    return (
+        Player.objects_filter(round_number=lookup.round_number)
+        .join(Participant)
+        .filter(Participant.code == participant_code)
+        .with_entities(Player.group_id, Participant.is_browser_bot)
+        .one_or_none()
+    )
+
+
+class GroupCodesCache:
+    """
+    id_in_group -> participant code, for each group on a live page.
+    The players in a group don't change while they are on the page,
+    so this saves a query on every message.
+    Keyed like the live queue rather than by group alone, because set_players
+    and set_group_matrix can change a group's players on a later wait page,
+    and SQLite can reuse the IDs of groups that were deleted.
+    """
+
+    def __init__(self, max_groups):
+        self.max_groups = max_groups
+        self._groups = OrderedDict()
+        # with granular locking, live methods run in several threads
+        self._lock = threading.Lock()
+
+    def get(self, Player, group, session_code, page_index) -> dict:
+        key = (session_code, page_index, group.id)
+        with self._lock:
+            pcodes = self._groups.get(key)
+            if pcodes is not None:
+                self._groups.move_to_end(key)
+                return pcodes
+        pcodes = {
+            id_in_group: code
+            for id_in_group, code in Player.objects_filter(group=group)
+            .join(Participant)
+            .with_entities(Player.id_in_group, Participant.code)
+        }
+        with self._lock:
+            self._groups[key] = pcodes
+            if len(self._groups) > self.max_groups:
+                self._groups.popitem(last=False)
+        return pcodes
+
+
+group_codes_cache = GroupCodesCache(max_groups=2000)
 
 
 async def live_payload_function(participant_code, page_name, payload):
+    if GRANULAR_LOCKING:
+        # the DB session is private to this group's task, and is inherited by the thread.
+        send_back_args = await run_in_threadpool(
+            _run_live_method, participant_code, page_name, payload
+        )
+    else:
+        send_back_args = _run_live_method(participant_code, page_name, payload)
+    if send_back_args:
+        await _live_send_back(*send_back_args)
+
+
+def _run_live_method(participant_code, page_name, payload):
+    '''returns the args for _live_send_back, or None if there is nothing to send'''
 
+    query = bakery(lambda s: s.query(Participant))
+    query += lambda q: q.filter(Participant.code == bindparam('code'))
     try:
-        participant = Participant.objects_get(code=participant_code)
+        participant = query(db._db).params(code=participant_code).one()
     except NoResultFound:
         logger.warning(f'Participant not found: {participant_code}')
         return
@@ -29,8 +170,17 @@ async def live_payload_function(participant_code, page_name, payload):
         )
         return
 
-    player = models_module.Player.objects_get(
-        round_number=lookup.round_number, participant=participant
+    Player: BasePlayer = models_module.Player
+    # Player is part of the cache key, since each app has its own Player
+    query = bakery(lambda s: s.query(Player).options(joinedload(Player.group)), Player)
+    query += lambda q: q.filter(
+        Player.round_number == bindparam('round_number'),
+        Player.participant_id == bindparam('participant_id'),
+    )
+    player = (
+        query(db._db)
+        .params(round_number=lookup.round_number, participant_id=participant.id)
+        .one()
     )
 
     # it makes sense to check the group first because
@@ -50,13 +200,9 @@ async def live_payload_function(participant_code, page_name, payload):
         msg = f'live method must return a dict'
         raise LiveMethodBadReturnValue(msg)
 
-    Player: BasePlayer = models_module.Player
-    pcodes_dict = {
-        d[0]: d[1]
-        for d in Player.objects_filter(group=group)
-        .join(Participant)
-        .with_entities(Player.id_in_group, Participant.code,)
-    }
+    pcodes_dict = group_codes_cache.get(
+        Player, group, participant._session_code, participant._index_in_pages
+    )
 
     if 0 in retval:
         if len(retval) > 1:
@@ -75,9 +221,7 @@ async def live_payload_function(participant_code, page_name, payload):
         if payload is not None:
             pcode_retval[pcode] = payload
 
-    await _live_send_back(
-        participant._session_code, participant._index_in_pages, pcode_retval
-    )
+    return participant._session_code, participant._index_in_pages, pcode_retval
 
 
 class LiveMethodBadReturnValue(Exception):
@@ -87,11 +231,11 @@ class LiveMethodBadReturnValue(Exception):
 async def _live_send_back(session_code, page_index, pcode_retval):
     '''separate function for easier patching'''
 
+    # don't wait until they're delivered, so the next message in the queue
+    # doesn't wait for slow connections.
     for pcode, retval in pcode_retval.items():
         group_name = channel_utils.live_group(session_code, page_index, pcode)
-        await channel_utils.group_send(
-            group=group_name, data=retval,
-        )
+        channel_utils.group_send_soon(group=group_name, data=retval)
 
 
 def call_live_method_compat(live_method, player, payload):
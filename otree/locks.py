@@ -0,0 +1,396 @@
+"""
+By default, oTree handles one request (or websocket message) at a time,
+by holding a single global lock (lock2) for the whole request.
+This is simple and safe, because all requests share the same DB session.
+
+With OTREE_LOCKING=granular (requires a DB server like Postgres),
+requests only wait for other requests by the same participant,
+so that one participant's slow page doesn't hold up everyone else.
+Each request then gets its own DB session & transaction.
+- Wait pages (including group_by_arrival_time) additionally lock
+  the group or subsession while checking who has arrived, since that's a check-then-act.
+- Live methods lock the group, since they often modify other players in the group.
+  (otree.live also handles each group's messages in order.)
+- Everything else (admin pages, session creation, room links, etc.)
+  waits until no other request is running, so it still behaves as in global mode.
+
+On Postgres, the same locks are also taken as advisory locks,
+so they apply across several worker processes (prodserver --workers).
+"""
+import asyncio
+import hashlib
+import re
+import threading
+from contextlib import asynccontextmanager, contextmanager
+
+import sqlalchemy
+from starlette.concurrency import run_in_threadpool
+
+from otree.database import GRANULAR_LOCKING, db, engine
+
+lock2 = asyncio.Lock()
+
+USE_ADVISORY_LOCKS = GRANULAR_LOCKING and engine.name == 'postgresql'
+
+# None means the request needs the whole server to itself
+EXCLUSIVE = None
+
+# these are just static files, which don't touch the DB.
+UNLOCKED_PATHS = ('/static/', '/favicon.ico')
+
+PARTICIPANT_PATH_PATTERNS = [
+    re.compile(pattern)
+    for pattern in [
+        r'^/p/(?P<code>\w+)/',
+        r'^/InitializeParticipant/(?P<code>\w+)',
+        r'^/OutOfRangeNotification/(?P<code>\w+)',
+    ]
+]
+
+
+def lock_key_for_path(path: str):
+    for pattern in PARTICIPANT_PATH_PATTERNS:
+        match = pattern.match(path)
+        if match:
+            return participant_lock_key(match.group('code'))
+    return EXCLUSIVE
+
+
+def participant_lock_key(participant_code):
+    return ('participant', participant_code)
+
+
+class SharedExclusiveLock:
+    """
+    A readers/writer lock for asyncio.
+    Participant requests hold it in shared mode, so they can run at the same time.
+    An exclusive request waits until all shared holders are done,
+    and new shared requests wait behind it so that it doesn't get starved.
+    """
+
+    def __init__(self):
+        self._num_shared = 0
+        self._is_exclusive = False
+        self._num_exclusive_waiting = 0
+        self._condition = None
+
+    def _get_condition(self):
+        # create it lazily so that it's bound to the running event loop
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    @asynccontextmanager
+    async def shared(self):
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(
+                lambda: not (self._is_exclusive or self._num_exclusive_waiting)
+            )
+            self._num_shared += 1
+        try:
+            yield
+        finally:
+            async with condition:
+                self._num_shared -= 1
+                if self._num_shared == 0:
+                    condition.notify_all()
+
+    @asynccontextmanager
+    async def exclusive(self):
+        condition = self._get_condition()
+        async with condition:
+            self._num_exclusive_waiting += 1
+            try:
+                await condition.wait_for(
+                    lambda: not (self._is_exclusive or self._num_shared)
+                )
+            finally:
+                self._num_exclusive_waiting -= 1
+            self._is_exclusive = True
+        try:
+            yield
+        finally:
+            async with condition:
+                self._is_exclusive = False
+                condition.notify_all()
+
+
+class KeyedLock:
+    """
+    one asyncio lock per key.
+    locks are deleted when nobody holds or waits for them,
+    so this doesn't grow with the number of participants.
+    """
+
+    def __init__(self):
+        # key -> [lock, number of holders + waiters]
+        self._locks = {}
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+
+class KeyedThreadLock:
+    """
+    Same as KeyedLock, but for synchronous code that runs in the threadpool
+    (e.g. wait pages).
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self._mutex = threading.Lock()
+
+    @contextmanager
+    def hold(self, key):
+        with self._mutex:
+            entry = self._locks.get(key)
+            if entry is None:
+                # RLock because skipping a wait page can happen inside another wait page
+                entry = self._locks[key] = [threading.RLock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._mutex:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+
+def advisory_lock_id(key) -> int:
+    # can't use hash() because it differs between processes
+    digest = hashlib.blake2b(repr(key).encode('utf8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+SERVER_LOCK_ID = advisory_lock_id(('server',))
+# held by an exclusive request while it waits for the shared holders of the server lock
+# to finish. new shared requests wait while it's held, so the exclusive request isn't
+# starved by participant requests in other processes.
+EXCLUSIVE_INTENT_LOCK_ID = advisory_lock_id(('exclusive_intent',))
+
+
+class AdvisoryLocks:
+    """
+    Session-level Postgres advisory locks, held on a connection that is reserved
+    for the request. The request's DB session should be bound to that connection.
+    We poll with pg_try_advisory_lock rather than blocking,
+    so that requests waiting for another process don't tie up the threadpool.
+    A failed attempt releases its locks and returns its connection to the pool,
+    so that waiting requests don't use up the pool.
+    """
+
+    @asynccontextmanager
+    async def hold(self, key):
+        if key is EXCLUSIVE:
+            connection = await self._acquire_exclusive()
+        else:
+            lock_id = advisory_lock_id(key)
+            connection = await self._poll(
+                lambda connection: self._try_shared(connection, lock_id)
+            )
+        try:
+            yield connection
+        finally:
+            await run_in_threadpool(self._release, connection)
+
+    async def _acquire_exclusive(self):
+        connection = await self._poll(
+            lambda connection: self._try_lock(
+                connection, 'pg_try_advisory_lock', EXCLUSIVE_INTENT_LOCK_ID
+            )
+        )
+        try:
+            # keep this connection while waiting, because it holds the intent lock.
+            # only one request per process can be here (see SharedExclusiveLock).
+            delay = 0.002
+            while not await run_in_threadpool(
+                self._try_lock, connection, 'pg_try_advisory_lock', SERVER_LOCK_ID
+            ):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.1)
+            await run_in_threadpool(
+                self._unlock, connection, 'pg_advisory_unlock', EXCLUSIVE_INTENT_LOCK_ID
+            )
+        except:
+            await run_in_threadpool(self._release, connection)
+            raise
+        return connection
+
+    async def _poll(self, attempt):
+        delay = 0.002
+        while True:
+            connection = await run_in_threadpool(self._attempt, attempt)
+            if connection:
+                return connection
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+    def _attempt(self, attempt):
+        '''returns the connection if attempt(connection) got the locks, otherwise None'''
+        connection = engine.connect()
+        try:
+            acquired = attempt(connection)
+        except:
+            self._release(connection)
+            raise
+        if acquired:
+            return connection
+        self._release(connection)
+        return None
+
+    def _try_shared(self, connection, lock_id) -> bool:
+        if not self._try_lock(connection, 'pg_try_advisory_lock', lock_id):
+            return False
+        # if an exclusive request is waiting, let it go first
+        if not self._try_lock(
+            connection, 'pg_try_advisory_lock_shared', EXCLUSIVE_INTENT_LOCK_ID
+        ):
+            return False
+        acquired = self._try_lock(
+            connection, 'pg_try_advisory_lock_shared', SERVER_LOCK_ID
+        )
+        self._unlock(
+            connection, 'pg_advisory_unlock_shared', EXCLUSIVE_INTENT_LOCK_ID
+        )
+        return acquired
+
+    def _try_lock(self, connection, function_name, lock_id) -> bool:
+        query = sqlalchemy.text(f'SELECT {function_name}(:lock_id)')
+        return connection.scalar(query, lock_id=lock_id)
+
+    def _unlock(self, connection, function_name, lock_id):
+        query = sqlalchemy.text(f'SELECT {function_name}(:lock_id)')
+        connection.execute(query, lock_id=lock_id)
+
+    def _release(self, connection):
+        # the connection goes back to the pool, so it must not keep any locks.
+        try:
+            connection.execute(sqlalchemy.text('SELECT pg_advisory_unlock_all()'))
+        finally:
+            connection.close()
+
+
+class RequestLocks:
+    """
+    hold() yields a DB connection that the request's session should be bound to,
+    or None if the request can use a connection from the pool as usual.
+    """
+
+    def __init__(
+        self,
+        *,
+        granular: bool,
+        global_lock: asyncio.Lock,
+        advisory_locks: AdvisoryLocks = None,
+    ):
+        self.granular = granular
+        self._global_lock = global_lock
+        self._server_lock = SharedExclusiveLock()
+        self._keyed_lock = KeyedLock()
+        self._advisory_locks = advisory_locks
+
+    @asynccontextmanager
+    async def hold(self, key):
+        if not self.granular:
+            async with self._global_lock:
+                yield None
+        elif key is EXCLUSIVE:
+            async with self._server_lock.exclusive():
+                async with self._hold_across_processes(key) as connection:
+                    yield connection
+        else:
+            # acquire the keyed lock first, so that a participant's queued requests
+            # don't block admin requests while they wait.
+            async with self._keyed_lock.hold(key):
+                async with self._server_lock.shared():
+                    async with self._hold_across_processes(key) as connection:
+                        yield connection
+
+    @asynccontextmanager
+    async def _hold_across_processes(self, key):
+        if self._advisory_locks:
+            async with self._advisory_locks.hold(key) as connection:
+                yield connection
+        else:
+            yield None
+
+
+request_locks = RequestLocks(
+    granular=GRANULAR_LOCKING,
+    global_lock=lock2,
+    advisory_locks=AdvisoryLocks() if USE_ADVISORY_LOCKS else None,
+)
+
+_wait_page_locks = KeyedThreadLock()
+
+
+# keys of the wait page advisory locks that the current thread holds
+_thread_state = threading.local()
+
+
+@contextmanager
+def _hold_advisory_lock(key):
+    """
+    A session-level lock on its own connection, rather than a transaction-level lock,
+    because the code inside the wait page lock can commit (e.g. set_players),
+    which would release a transaction-level lock too early.
+    """
+    held = getattr(_thread_state, 'advisory_keys', None)
+    if held is None:
+        held = _thread_state.advisory_keys = set()
+    if key in held:
+        # skipping a wait page inside the same wait page.
+        # taking it again on another connection would deadlock.
+        yield
+        return
+    lock_id = advisory_lock_id(key)
+    connection = engine.connect()
+    try:
+        connection.execute(
+            sqlalchemy.text('SELECT pg_advisory_lock(:lock_id)'), dict(lock_id=lock_id)
+        )
+        held.add(key)
+        try:
+            yield
+        finally:
+            held.discard(key)
+            connection.execute(
+                sqlalchemy.text('SELECT pg_advisory_unlock(:lock_id)'),
+                dict(lock_id=lock_id),
+            )
+    finally:
+        connection.close()
+
+
+@contextmanager
+def wait_page_lock(key):
+    """
+    The transaction is committed before releasing the lock,
+    so that the next participant who gets the lock sees that this participant arrived
+    (and whether after_all_players_arrive already ran).
+    """
+    if not GRANULAR_LOCKING:
+        yield
+        return
+    with _wait_page_locks.hold(key):
+        if USE_ADVISORY_LOCKS:
+            with _hold_advisory_lock(key):
+                yield
+                db.commit()
+        else:
+            yield
+            db.commit()
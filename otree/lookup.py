@@ -1,6 +1,8 @@
-from collections import namedtuple
-from functools import lru_cache
-from typing import Dict
+import json
+import os
+import threading
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
 
 from otree.common import get_pages_module, get_models_module, get_constants
 from otree.database import dbq
@@ -19,49 +21,184 @@ PageLookup = namedtuple(
 )
 
 
-@lru_cache(maxsize=32)
-def _get_session_lookups(session_code) -> Dict[int, PageLookup]:
-    session = dbq(Session).filter_by(code=session_code).one()
-    pages = {}
-    idx = 1
-    for app_name in session.config['app_sequence']:
-        models = get_models_module(app_name)
-        Subsession = models.Subsession
-        page_sequence = get_pages_module(app_name).page_sequence
-        subsessions = {
-            s[0]: s[1]
-            for s in Subsession.objects_filter(session=session).with_entities(
-                Subsession.round_number, Subsession.id
+class SessionPageIndex:
+    """
+    Maps a participant's _index_in_pages to the app, round and page.
+    Rather than storing an entry for every page of every round,
+    it stores the index of each app's first page, the number of pages per round,
+    and the subsession ID of each round. The rest is arithmetic.
+    It's computed once in create_session and saved in Session._page_index.
+    """
+
+    def __init__(self, session_pk, app_names, pages_per_round, subsession_ids):
+        self.session_pk = session_pk
+        self.app_names = app_names
+        self.pages_per_round = pages_per_round
+        # for each app, a list of subsession IDs, ordered by round number
+        self.subsession_ids = subsession_ids
+        self.start_indexes = []
+        idx = 1
+        for num_pages, ids in zip(pages_per_round, subsession_ids):
+            self.start_indexes.append(idx)
+            idx += num_pages * len(ids)
+        self.num_pages = idx - 1
+        # these are shared by all sessions, so they don't add to the size
+        self.page_sequences = [
+            get_pages_module(app_name).page_sequence for app_name in app_names
+        ]
+        self.names_in_url = [
+            get_constants(app_name).get_normalized('name_in_url')
+            for app_name in app_names
+        ]
+
+    @property
+    def size(self):
+        '''approximate size, for the cache'''
+        return len(self.app_names) + sum(len(ids) for ids in self.subsession_ids)
+
+    @classmethod
+    def build(cls, session_pk, app_sequence, subsession_ids):
+        pages_per_round = [
+            len(get_pages_module(app_name).page_sequence) for app_name in app_sequence
+        ]
+        return cls(session_pk, list(app_sequence), pages_per_round, subsession_ids)
+
+    @classmethod
+    def build_from_db(cls, session: Session):
+        '''for sessions that were created without a saved page index'''
+        subsession_ids = []
+        for app_name in session.config['app_sequence']:
+            Subsession = get_models_module(app_name).Subsession
+            subsession_ids.append(
+                [
+                    id
+                    for [id] in Subsession.objects_filter(session=session)
+                    .order_by('round_number')
+                    .with_entities(Subsession.id)
+                ]
             )
-        }
-
-        Constants = get_constants(app_name)
-        num_rounds = Constants.get_normalized('num_rounds')
-        name_in_url = Constants.get_normalized('name_in_url')
-        for rd in range(1, num_rounds + 1):
-            for PageClass in page_sequence:
-                pages[idx] = PageLookup(
-                    app_name=app_name,
-                    page_class=PageClass,
-                    round_number=rd,
-                    subsession_id=subsessions[rd],
-                    session_pk=session.id,
-                    name_in_url=name_in_url,
-                )
-                idx += 1
-    return pages
+        return cls.build(session.id, session.config['app_sequence'], subsession_ids)
+
+    def to_json(self):
+        return json.dumps(
+            [self.app_names, self.pages_per_round, self.subsession_ids],
+            separators=(',', ':'),
+        )
+
+    @classmethod
+    def from_json(cls, session_pk, data):
+        return cls(session_pk, *json.loads(data))
+
+    def __getitem__(self, idx) -> PageLookup:
+        if not 1 <= idx <= self.num_pages:
+            raise KeyError(idx)
+        app_index = bisect_right(self.start_indexes, idx) - 1
+        offset = idx - self.start_indexes[app_index]
+        round_index, page_index = divmod(offset, self.pages_per_round[app_index])
+        return PageLookup(
+            app_name=self.app_names[app_index],
+            page_class=self.page_sequences[app_index][page_index],
+            round_number=round_index + 1,
+            subsession_id=self.subsession_ids[app_index][round_index],
+            session_pk=self.session_pk,
+            name_in_url=self.names_in_url[app_index],
+        )
+
+    def min_idx_for_app(self, app_name):
+        if app_name in self.app_names:
+            return self.start_indexes[self.app_names.index(app_name)]
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'sessions', 'size', 'max_size'])
+
+
+class PageIndexCache:
+    """
+    LRU cache of SessionPageIndex objects, limited by their total size
+    rather than the number of sessions, since sessions with many rounds
+    are much bigger than others.
+    It's per process, but that's OK even with several worker processes,
+    because a session's page sequence never changes after the session is created.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._indexes = OrderedDict()
+        self._size = 0
+        # with granular locking, requests access the cache from several threads
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_code) -> SessionPageIndex:
+        with self._lock:
+            index = self._indexes.get(session_code)
+            if index is not None:
+                self._indexes.move_to_end(session_code)
+                self.hits += 1
+                return index
+            self.misses += 1
+        index = self._load(session_code)
+        self.put(session_code, index)
+        return index
+
+    def _load(self, session_code) -> SessionPageIndex:
+        session_pk, data = (
+            dbq(Session.id, Session._page_index).filter_by(code=session_code).one()
+        )
+        if data:
+            return SessionPageIndex.from_json(session_pk, data)
+        return SessionPageIndex.build_from_db(
+            dbq(Session).filter_by(code=session_code).one()
+        )
+
+    def put(self, session_code, index: SessionPageIndex):
+        with self._lock:
+            self._discard(session_code)
+            self._indexes[session_code] = index
+            self._size += index.size
+            # always keep the one we just added, even if it's bigger than max_size
+            while self._size > self.max_size and len(self._indexes) > 1:
+                _, evicted = self._indexes.popitem(last=False)
+                self._size -= evicted.size
+
+    def invalidate(self, session_code=None):
+        '''if no session code is given, clear the whole cache'''
+        with self._lock:
+            if session_code is None:
+                self._indexes.clear()
+                self._size = 0
+            else:
+                self._discard(session_code)
+
+    def _discard(self, session_code):
+        index = self._indexes.pop(session_code, None)
+        if index is not None:
+            self._size -= index.size
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(
+            hits=self.hits,
+            misses=self.misses,
+            sessions=len(self._indexes),
+            size=self._size,
+            max_size=self.max_size,
+        )
+
+
+# the size is the total number of apps & rounds of the cached sessions.
+page_index_cache = PageIndexCache(
+    max_size=int(os.getenv('OTREE_PAGE_INDEX_CACHE_SIZE', 100_000))
+)
 
 
 def get_page_lookup(session_code, idx) -> PageLookup:
-    cache = _get_session_lookups(session_code)
-    return cache[idx]
+    return page_index_cache.get(session_code)[idx]
 
 
 def get_min_idx_for_app(session_code, app_name):
     '''for aatp'''
-    for idx, info in _get_session_lookups(session_code).items():
-        if info.app_name == app_name:
-            return idx
+    return page_index_cache.get(session_code).min_idx_for_app(app_name)
 
 
 def url_i_should_be_on(participant_code, session_code, index_in_pages) -> str:
@@ -103,7 +103,7 @@ def execute_from_command_line(*args, **kwargs):
         # skip full setup.
         pass
     else:
-        if cmd in ['devserver_inner', 'bots']:
+        if cmd in ['devserver_inner', 'bots', 'bench']:
             os.environ['OTREE_IN_MEMORY'] = '1'
         setup()
 
@@ -218,6 +218,7 @@ def check_for_sentry():
 MAIN_HELP_TEXT = '''
 Available subcommands:
 
+bench
 browser_bots
 create_session
 devserver
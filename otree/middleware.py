@@ -4,19 +4,19 @@ from starlette.middleware.sessions import SessionMiddleware
 import time
 from starlette.requests import Request
 import logging
-from otree.database import db, NEW_IDMAP_EACH_REQUEST
+from otree.database import db, NEW_IDMAP_EACH_REQUEST, GRANULAR_LOCKING, count_queries
 from otree.common import _SECRET, lock
+from otree.locks import lock2, request_locks, lock_key_for_path, UNLOCKED_PATHS
 import asyncio
 import threading
 
 logger = logging.getLogger('otree.perf')
 
 
-lock2 = asyncio.Lock()
-
-
 class CommitTransactionMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request, call_next):
+        if GRANULAR_LOCKING:
+            return await self.dispatch_granular(request, call_next)
         async with lock2:
             if NEW_IDMAP_EACH_REQUEST:
                 db.new_session()
@@ -34,20 +34,37 @@ class CommitTransactionMiddleware(BaseHTTPMiddleware):
             #     db.close()
             return response
 
+    async def dispatch_granular(self, request, call_next):
+        path = request.url.path
+        if path.startswith(UNLOCKED_PATHS):
+            return await call_next(request)
+        async with request_locks.hold(lock_key_for_path(path)) as connection:
+            # the session is private to this request, and is inherited
+            # by the task that call_next() runs the app in.
+            with db.private_session(bind=connection):
+                response = await call_next(request)
+                if response.status_code >= 500:
+                    db.rollback()
+            return response
+
 
 class PerfMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request, call_next):
         start = time.time()
 
-        response = await call_next(request)
+        with count_queries() as query_counter:
+            response = await call_next(request)
 
+        elapsed = time.time() - start
+        msec = int(elapsed * 1000)
+        queries = query_counter.count
         # heroku has 'X-Request-ID'
         request_id = request.headers.get('X-Request-ID')
         if request_id:
             # only log this info on Heroku
-            elapsed = time.time() - start
-            msec = int(elapsed * 1000)
-            msg = f'own_time={msec}ms request_id={request_id}'
+            msg = f'own_time={msec}ms queries={queries} request_id={request_id}'
             logger.info(msg)
+        else:
+            logger.debug(f'{request.url.path} own_time={msec}ms queries={queries}')
 
         return response
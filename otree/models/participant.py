@@ -182,10 +182,10 @@ class Participant(MixinVars, otree.database.SSPPGModel):
 
     def _update_monitor_table(self):
         from otree import export
+        from otree.channels.monitor import monitor_publisher
 
-        channel_utils.sync_group_send(
-            group=channel_utils.session_monitor_group_name(self._session_code),
-            data=dict(rows=export.get_rows_for_monitor([self])),
+        monitor_publisher.update_rows(
+            self._session_code, lambda: export.get_rows_for_monitor([self])
         )
 
     def _get_page_instance(self):
@@ -220,17 +220,22 @@ class Participant(MixinVars, otree.database.SSPPGModel):
         """
         # don't need to handle more redirects than that.
         for i in range(5):
-            page = self._get_page_instance()
-            if not page:
-                return
-            # it's possible that the slowest user is on a wait page,
-            # especially if their browser is closed.
-            # because they were waiting for another user who then
-            # advanced past the wait page, but they were never
-            # advanced themselves.
-            resp = page.get()
-            if not str(resp.status_code).startswith('3'):
+            if not self._visit_current_page_once():
                 return
 
+    def _visit_current_page_once(self, render=True) -> bool:
+        '''returns True if the page redirected to another page'''
+        page = self._get_page_instance()
+        if not page:
+            return False
+        page._render_response = render
+        # it's possible that the slowest user is on a wait page,
+        # especially if their browser is closed.
+        # because they were waiting for another user who then
+        # advanced past the wait page, but they were never
+        # advanced themselves.
+        resp = page.get()
+        return str(resp.status_code).startswith('3')
+
     def _get_finished(self):
         return self.vars.get('finished', False)
@@ -4,7 +4,7 @@ from sqlalchemy.orm import relationship
 from sqlalchemy.sql import sqltypes as st
 
 from otree.common import in_round, in_rounds
-from otree.database import db, MixinSessionFK, SPGModel, CurrencyType
+from otree.database import MixinSessionFK, SPGModel, CurrencyType
 
 
 class BasePlayer(SPGModel, MixinSessionFK):
@@ -39,10 +39,11 @@ class BasePlayer(SPGModel, MixinSessionFK):
             value = 0
         delta = value - self._payoff
         self._payoff += delta
+        # the participant is in the same DB session,
+        # so it's saved together with the player when the request commits.
+        # (no need to commit here; that would split the request into
+        # many transactions, e.g. when the admin advances many participants at once.)
         self.participant.payoff += delta
-        # should save it because it may not be obvious that modifying
-        # player.payoff also changes a field on a different model
-        db.commit()
 
     @property
     def id_in_subsession(self):
@@ -10,7 +10,7 @@ import otree.common
 import otree.constants
 import otree.database
 from otree import settings
-from otree.channels.utils import auto_advance_group
+from otree.channels.utils import auto_advance_group, sync_group_send_many
 from otree.common import (
     random_chars_8,
     random_chars_join_code,
@@ -89,6 +89,9 @@ class Session(MixinVars, otree.database.SSPPGModel):
 
     num_participants = Column(st.Integer)
 
+    # see otree.lookup.SessionPageIndex
+    _page_index = Column(st.Text, nullable=True)
+
     # better to use int because it's portable and no ambiguity
     # about timezone. when you do dt.timestamp() it might give
     # the wrong result if it's in the wrong timezone.
@@ -204,23 +207,44 @@ class Session(MixinVars, otree.database.SSPPGModel):
             p for p in participants if p._index_in_pages == last_place_page_index
         ][: otree.constants.ADVANCE_SLOWEST_BATCH_SIZE]
 
+        from otree.views.abstract import load_current_players
+
         if last_place_page_index == 0:
             for p in last_place_participants:
                 p.initialize(None)
-                p._visit_current_page()
         else:
+            load_current_players(last_place_participants)
             for p in last_place_participants:
                 p._submit_current_page()
-                # need to do this to update the monitor table, set any timeouts, etc.
-                p._visit_current_page()
-
-                # 2020-12-20: this is needed.
-                # do the auto-advancing here,
-                # rather than in increment_index_in_pages,
-                # because it's only needed here.
-                otree.channels.utils.sync_group_send(
-                    group=auto_advance_group(p.code), data={'auto_advanced': True}
-                )
+
+        # need to do this to update the monitor table, set any timeouts, etc.
+        # rather than following each participant's redirects to the end,
+        # all participants visit their current page, then the ones who were redirected
+        # visit the next page, and so on.
+        # so the players each time can be loaded together.
+        # the next page's players are loaded too, because passing a wait page
+        # sets the attributes of the pages after it.
+        # don't need to handle more than 5 redirects.
+        to_visit = last_place_participants
+        for i in range(5):
+            load_current_players(to_visit, pages_ahead=1)
+            to_visit = [
+                p for p in to_visit if p._visit_current_page_once(render=False)
+            ]
+            if not to_visit:
+                break
+
+        if last_place_page_index != 0:
+            # 2020-12-20: this is needed.
+            # do the auto-advancing here,
+            # rather than in increment_index_in_pages,
+            # because it's only needed here.
+            sync_group_send_many(
+                [
+                    (auto_advance_group(p.code), {'auto_advanced': True})
+                    for p in last_place_participants
+                ]
+            )
 
     def get_room(self):
         from otree.room import ROOM_DICT
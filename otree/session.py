@@ -1,10 +1,9 @@
-from collections import defaultdict
 from decimal import Decimal
 from functools import reduce
 from typing import List, Dict
 from otree import settings
 
-from otree.database import db, dbq
+from otree.database import db, dbq, unfrozen_loads
 from otree import common
 from otree.common import (
     get_models_module,
@@ -15,6 +14,7 @@ from otree.common import (
 )
 from otree.currency import RealWorldCurrency
 from otree.models import Participant, Session
+from otree.lookup import SessionPageIndex, page_index_cache
 from otree.constants import BaseConstants, get_roles, get_role
 
 
@@ -292,35 +292,28 @@ def create_session(
     db.commit()
 
     try:
+        # rows are inserted in bulk, without creating ORM objects,
+        # because that is much faster for big sessions with many rounds.
+        # the objects are loaded when creating_session needs them.
         session_code = session.code
-        participants = [
-            Participant(
-                id_in_session=id_in_session,
-                session=session,
-                _session_code=session_code,
-            )
-            for id_in_session in list(range(1, num_participants + 1))
-        ]
-
-        db.add_all(participants)
-        db.commit()
-
-        # participant_values = (
-        #     db.query(Participant)
-        #     .filter(Session.id == session.id)
-        #     .order_by('id')
-        #     .with_entities(Participant.id, Participant.code)
-        # ).all()
-
-        participant_values = (
-            db.query(Participant)
-            .join(Session)
-            .filter(Session.id == session.id)
-            .order_by(Participant.id)
-            .with_entities(Participant.id, Participant.code)
-        ).all()
+        participant_ids = db.reserve_ids(Participant, num_participants)
+        db.bulk_insert(
+            Participant,
+            [
+                dict(
+                    id=participant_id,
+                    id_in_session=id_in_session,
+                    session_id=session.id,
+                    _session_code=session_code,
+                )
+                for id_in_session, participant_id in enumerate(
+                    participant_ids, start=1
+                )
+            ],
+        )
 
         num_pages = 0
+        subsession_ids = []
 
         for app_name in session_config['app_sequence']:
 
@@ -338,20 +331,17 @@ def create_session(
             Player = models_module.Player
             Constants = get_constants(app_name)
 
-            subsessions = [
-                Subsession(round_number=round_number, session=session)
-                for round_number in round_numbers
-            ]
-
-            db.add_all(subsessions)
-            db.commit()
-
-            subsessions = (
-                dbq(Subsession)
-                .filter_by(session=session)
-                .order_by('round_number')
-                .with_entities('id', 'round_number')
+            subsessions = list(
+                zip(db.reserve_ids(Subsession, num_rounds), round_numbers)
+            )
+            db.bulk_insert(
+                Subsession,
+                [
+                    dict(id=ss_id, round_number=ss_rd, session_id=session.id)
+                    for ss_id, ss_rd in subsessions
+                ],
             )
+            subsession_ids.append([ss_id for ss_id, _ in subsessions])
 
             ppg = Constants.get_normalized('players_per_group')
             if ppg is None or Subsession._has_group_by_arrival_time():
@@ -359,44 +349,32 @@ def create_session(
 
             num_groups_per_round = int(num_participants / ppg)
 
+            group_ids = iter(
+                db.reserve_ids(Group, num_rounds * num_groups_per_round)
+            )
             groups_to_create = []
+            players_to_create = []
+            roles = get_roles(Constants)
             for ss_id, ss_rd in subsessions:
+                participant_index = 0
                 for id_in_subsession in range(1, num_groups_per_round + 1):
+                    group_id = next(group_ids)
                     groups_to_create.append(
-                        Group(
-                            session=session,
+                        dict(
+                            id=group_id,
+                            session_id=session.id,
                             subsession_id=ss_id,
                             round_number=ss_rd,
                             id_in_subsession=id_in_subsession,
                         )
                     )
-
-            db.add_all(groups_to_create)
-
-            groups = (
-                dbq(Group).filter_by(session=session).order_by('id_in_subsession')
-            ).all()
-
-            groups_lookup = defaultdict(list)
-
-            for group in groups:
-
-                groups_lookup[group.subsession_id].append(group.id)
-
-            players_to_create = []
-
-            for ss_id, ss_rd in subsessions:
-                roles = get_roles(Constants)
-                participant_index = 0
-                for group_id in groups_lookup[ss_id]:
                     for id_in_group in range(1, ppg + 1):
-                        participant = participant_values[participant_index]
                         players_to_create.append(
-                            Player(
-                                session=session,
+                            dict(
+                                session_id=session.id,
                                 subsession_id=ss_id,
                                 round_number=ss_rd,
-                                participant_id=participant[0],
+                                participant_id=participant_ids[participant_index],
                                 group_id=group_id,
                                 id_in_group=id_in_group,
                                 _role=get_role(roles, id_in_group),
@@ -404,18 +382,28 @@ def create_session(
                         )
                         participant_index += 1
 
-            # Create players
-            db.add_all(players_to_create)
+            db.bulk_insert(Group, groups_to_create)
+            db.bulk_insert(Player, players_to_create)
 
         dbq(Participant).filter_by(session=session).update(
             {Participant._max_page_index: num_pages}
         )
-
-        for subsession in session.get_subsessions():
-            target = subsession.get_user_defined_target()
-            func = getattr(target, 'creating_session', None)
-            if func:
-                func(subsession)
+        page_index = SessionPageIndex.build(
+            session.id, session_config['app_sequence'], subsession_ids
+        )
+        session._page_index = page_index.to_json()
+        page_index_cache.put(session_code, page_index)
+
+        with unfrozen_loads():
+            # hold references to the participants, so that player.participant
+            # in creating_session finds them in the identity map
+            # rather than querying each one.
+            participants = session.get_participants()
+            for subsession in session.get_subsessions():
+                target = subsession.get_user_defined_target()
+                func = getattr(target, 'creating_session', None)
+                if func:
+                    func(subsession)
 
         session._set_admin_report_app_names()
 
@@ -431,6 +419,7 @@ def create_session(
         # another way would be to look into nested transactions,
         # but this seems simpler.
         db.delete(session)
+        page_index_cache.invalidate(session_code)
         raise
 
 
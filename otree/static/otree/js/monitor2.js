@@ -8,6 +8,9 @@ function initWebSocket(socketUrl, $tbody, visitedParticipants, $msgRefreshed) {
             updateNotes($tbody[0], data.ids, data.note);
         } else {
             let updatedIds = refreshTable(data.rows, $tbody, visitedParticipants);
+            if (data.diffs) {
+                updatedIds = updatedIds.concat(applyDiffs(data.diffs, $tbody[0]));
+            }
             let msg = recentlyActiveParticipantsMsg(updatedIds);
             // we shouldn't write an empty msg, because that would cause
             // the div to shrink
@@ -68,6 +71,20 @@ function updateNotes(tbody, ids, note) {
     }
 }
 
+function applyDiffs(diffs, tbody) {
+    // diffs only have the changed fields, so they can only update existing rows.
+    let updatedParticipants = [];
+    for (let diff of diffs) {
+        const {id_in_session, ...row} = diff;
+        let index = visitedParticipants.indexOf(id_in_session);
+        if (index >= 0 && updateNthRow(tbody, index, row)) {
+            updatedParticipants.push(id_in_session);
+        }
+    }
+    $(".timeago").timeago();
+    return updatedParticipants;
+}
+
 function updateNthRow(tbody, n, row) {
     let didUpdate = false;
     let nthBodyRow = tbody.querySelector(getNthBodyRowSelector(n));
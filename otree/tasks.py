@@ -1,131 +1,331 @@
+import asyncio
+import heapq
 import json
+from collections import deque
 from logging import getLogger
 import time
-from time import sleep
-from urllib import request, parse
-from urllib.error import URLError
-from urllib.parse import urljoin
-from otree.database import db, session_scope
-import otree.constants
-from otree.models_concrete import TaskQueueMessage
 
-print_function = print
+from sqlalchemy import event
+from starlette.concurrency import run_in_threadpool
+
+from otree.database import DBSession, db, session_scope
+import otree.channels.utils as channel_utils
+import otree.common
+from otree.locks import request_locks, participant_lock_key, EXCLUSIVE
+from otree.models_concrete import TaskQueueMessage
 
 
 logger = getLogger(__name__)
 
 
-def post(url, data: dict):
-    '''
-    make the request over the network rather than in-process,
-    to avoid race conditions. everything must be handled by the main
-    server instance.
-    '''
-    data = parse.urlencode(data).encode()
-    req = request.Request(url, data=data)  # this will make the method "POST"
-    resp = request.urlopen(req)
+class Scheduler:
+    """
+    Calls callback(due_times) on the event loop when scheduled times
+    (epoch seconds) are reached, with all the times that are due.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self._heap = []
+        self._scheduled = set()
+        self._loop = None
+        self._timer = None
+
+    def start(self):
+        self._loop = asyncio.get_event_loop()
+
+    def schedule(self, epoch_time):
+        '''can be called from any thread'''
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._push, epoch_time)
+
+    def _push(self, epoch_time):
+        if epoch_time in self._scheduled:
+            return
+        self._scheduled.add(epoch_time)
+        heapq.heappush(self._heap, epoch_time)
+        if self._heap[0] == epoch_time:
+            self._set_timer()
+
+    def _set_timer(self):
+        if self._timer:
+            self._timer.cancel()
+        delay = max(self._heap[0] - time.time(), 0)
+        self._timer = self._loop.call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        now = time.time()
+        due_times = []
+        while self._heap and self._heap[0] <= now:
+            epoch_time = heapq.heappop(self._heap)
+            self._scheduled.discard(epoch_time)
+            due_times.append(epoch_time)
+        if self._heap:
+            # the loop's clock may be slightly ahead of time.time(),
+            # in which case nothing is due yet and we just re-arm.
+            self._set_timer()
+        if due_times:
+            self.callback(due_times)
 
 
-def get(url):
-    try:
-        request.urlopen(url)
-    # some users were reporting URLError but not clear what URL it was
-    except URLError as exc:
-        raise Exception(f'Error occurred when opening {url}: {repr(exc)}') from None
+class TimeoutWorker:
+    """
+    Enforces page timeouts even if the user closes their browser.
+    Tasks are stored in TaskQueueMessage, so that they survive a server restart,
+    and run in-process on the server's event loop as soon as they are due.
+    All tasks that are due at the same time are run as a batch.
+    """
 
+    # picks up tasks that the scheduler doesn't know about,
+    # e.g. if they were enqueued by a worker process that has since exited.
+    SWEEP_INTERVAL = 30
+    LATE_WARNING_SECONDS = 2
 
-class Worker:
-    def __init__(self, port):
-        self.base_url = f'http://127.0.0.1:{port}'
-        # delete all old stuff
+    def __init__(self):
+        self.scheduler = Scheduler(self._on_due)
+        # how many seconds late recent tasks ran
+        self.lateness = deque(maxlen=1000)
 
-        TaskQueueMessage.objects_filter(
-            TaskQueueMessage.epoch_time < time.time() - 60
-        ).delete()
+    async def start(self):
+        if not otree.common.USE_TIMEOUT_WORKER:
+            return
+        self.scheduler.start()
+        epoch_times = await run_in_threadpool(self._load_pending)
+        for epoch_time in epoch_times:
+            self.scheduler.schedule(epoch_time)
+        asyncio.ensure_future(self._sweep())
 
-    def listen(self):
-        print_function('timeoutworker is listening for messages through DB')
+    def schedule(self, epoch_time):
+        self.scheduler.schedule(epoch_time)
 
+    def _load_pending(self):
+        with session_scope():
+            # these were due while the server was down, so they are stale
+            TaskQueueMessage.objects_filter(
+                TaskQueueMessage.epoch_time < time.time() - 60
+            ).delete()
+            return {task.epoch_time for task in TaskQueueMessage.objects_filter()}
+
+    async def _sweep(self):
         while True:
-            # without the session_scope, resetdb doesn't work because it seems to require
-            # all connections to be closed, even in other processes.
-            with session_scope():
-                for task in TaskQueueMessage.objects_filter(
-                    TaskQueueMessage.epoch_time <= time.time()
-                ).order_by('epoch_time'):
-                    try:
-                        getattr(self, task.method)(**task.kwargs())
-                    except Exception as exc:
-                        # don't raise, because then this would crash.
-                        # logger.exception() will record the full traceback
-                        logger.exception(repr(exc))
-                    db.delete(task)
-            sleep(3)
-
-    def submit_expired_url(self, participant_code, page_index):
-        from otree.models.participant import Participant
-
-        # if the participant exists in the DB,
-        # and they did not advance past the page yet
-
-        # To reduce redundant server traffic, it's OK not to advance the page if the user already got to the next page
-        # themselves, or via "advance slowest participants".
-        # however, we must make sure that the user succeeded in loading the next page fully.
-        # if the user made this page's POST but closed their browser before
-        # the redirect to the next page's GET, then if the next page has a timeout,
-        # it will not get scheduled, and then the auto-timeout chain would be broken.
-        # so, instead of filtering by _index_in_pages (which is set in POST),
-        # we filter by _current_form_page_url (which is set in GET,
-        # AFTER the next page's timeout is scheduled.)
-
-        pp = Participant.objects_filter(
-            code=participant_code, _index_in_pages=page_index
-        ).first()
-        if pp:
-            path = pp._url_i_should_be_on()
-            logger.info(f'Auto-submitting timed out page: {path}')
-            post(
-                urljoin(self.base_url, path),
-                data={otree.constants.timeout_happened: True},
+            await asyncio.sleep(self.SWEEP_INTERVAL)
+            await self.run_due_tasks()
+
+    def _on_due(self, due_times):
+        asyncio.ensure_future(self.run_due_tasks())
+
+    async def run_due_tasks(self):
+        now = time.time()
+        if request_locks.granular:
+            # each participant's job only waits for that participant's lock
+            jobs = await run_in_threadpool(self._claim_due_jobs, now)
+            await asyncio.gather(*[self._run_job_with_lock(*job) for job in jobs])
+        else:
+            async with request_locks.hold(EXCLUSIVE):
+                await run_in_threadpool(self._claim_and_run_due_jobs, now)
+
+    def _claim_due_jobs(self, now):
+        '''
+        returns (task_id, lock_key, func, kwargs) for each job that is due.
+        The task is only deleted in the same transaction as its job (see _run_job),
+        so that if the server crashes in between, the job still runs after a restart.
+        '''
+        jobs = []
+        lateness = []
+        with session_scope():
+            for task in TaskQueueMessage.objects_filter(
+                TaskQueueMessage.epoch_time <= now
+            ).order_by('epoch_time'):
+                try:
+                    task_jobs = get_jobs(task.method, **task.kwargs())
+                except Exception as exc:
+                    # e.g. a task with kwargs from an older oTree version.
+                    # delete it, so that it doesn't fail again on every sweep.
+                    logger.exception(repr(exc))
+                    task_jobs = []
+                if len(task_jobs) == 1:
+                    lateness.append(now - task.epoch_time)
+                    jobs.append((task.id, *task_jobs[0]))
+                    continue
+                # with several worker processes, another one may have split it already.
+                if not TaskQueueMessage.objects_filter(id=task.id).delete():
+                    continue
+                lateness.append(now - task.epoch_time)
+                # split it into a task per job, so that each job can delete its own task.
+                subtasks = [
+                    TaskQueueMessage.objects_create(
+                        method=func.__name__,
+                        epoch_time=task.epoch_time,
+                        kwargs_json=json.dumps(kwargs),
+                    )
+                    for lock_key, func, kwargs in task_jobs
+                ]
+                db._db.flush()
+                jobs.extend(
+                    (subtask.id, *job) for subtask, job in zip(subtasks, task_jobs)
+                )
+        if lateness:
+            self._record_lateness(lateness)
+        return jobs
+
+    def _record_lateness(self, lateness):
+        self.lateness.extend(lateness)
+        max_lateness = max(lateness)
+        if max_lateness > self.LATE_WARNING_SECONDS:
+            logger.warning(
+                f'{len(lateness)} timeout tasks ran up to {max_lateness:.1f}s late'
             )
 
-    def ensure_pages_visited(self, participant_pks, page_index):
-        """This is necessary when a wait page is followed by a timeout page.
-        We can't guarantee the user's browser will properly continue to poll
-        the wait page and get redirected, so after a grace period we load the page
-        automatically, to kick off the expiration timer of the timeout page.
-        """
-
-        from otree.models.participant import Participant
-
-        # we used to filter by _index_in_pages, but that is not reliable,
-        # because of the race condition described above.
-        unvisited_participants = Participant.objects_filter(
-            Participant.id.in_(participant_pks),
-            # the +1 is just a buffer for any edge cases
-            # (as we saw with advance_slowest)
-            Participant._index_in_pages <= page_index + 1,
+    def _claim_and_run_due_jobs(self, now):
+        for task_id, lock_key, func, kwargs in self._claim_due_jobs(now):
+            try:
+                with session_scope():
+                    self._run_job(task_id, func, kwargs)
+            except Exception as exc:
+                # don't raise, so that the other jobs still run.
+                # logger.exception() will record the full traceback
+                logger.exception(repr(exc))
+                self._delete_task(task_id)
+
+    async def _run_job_with_lock(self, task_id, lock_key, func, kwargs):
+        try:
+            async with request_locks.hold(lock_key) as connection:
+                with session_scope(bind=connection):
+                    await run_in_threadpool(self._run_job, task_id, func, kwargs)
+        except Exception as exc:
+            logger.exception(repr(exc))
+            await run_in_threadpool(self._delete_task, task_id)
+
+    def _run_job(self, task_id, func, kwargs):
+        # with several worker processes, another one may have run it already
+        # (e.g. if both picked it up in a sweep).
+        if TaskQueueMessage.objects_filter(id=task_id).delete():
+            func(**kwargs)
+
+    def _delete_task(self, task_id):
+        '''after the job failed, so that it isn't retried on every sweep'''
+        with session_scope():
+            TaskQueueMessage.objects_filter(id=task_id).delete()
+
+
+timeout_worker = TimeoutWorker()
+
+
+def get_jobs(method, **kwargs):
+    """
+    a task can affect several participants, so it's split into jobs that
+    each lock a single participant.
+    """
+    if method == 'submit_expired_url':
+        participant_code = kwargs['participant_code']
+        return [(participant_lock_key(participant_code), submit_expired_page, kwargs)]
+    if method == 'ensure_page_visited':
+        # one participant's part of ensure_pages_visited (see _claim_due_jobs)
+        participant_code = kwargs['participant_code']
+        return [(participant_lock_key(participant_code), ensure_page_visited, kwargs)]
+    if method == 'ensure_pages_visited':
+        participant_codes = kwargs.get('participant_codes')
+        if participant_codes is None:
+            # queued by an older oTree version
+            from otree.models.participant import Participant
+
+            participant_codes = [
+                pp.code
+                for pp in Participant.objects_filter(
+                    Participant.id.in_(kwargs['participant_pks'])
+                )
+            ]
+        return [
+            (
+                participant_lock_key(participant_code),
+                ensure_page_visited,
+                dict(participant_code=participant_code, page_index=kwargs['page_index']),
+            )
+            for participant_code in participant_codes
+        ]
+    logger.warning(f'Unknown task method: {method}')
+    return []
+
+
+def submit_expired_page(participant_code, page_index):
+    from otree.models.participant import Participant
+
+    # if the participant exists in the DB,
+    # and they did not advance past the page yet
+
+    # To reduce redundant server traffic, it's OK not to advance the page if the user already got to the next page
+    # themselves, or via "advance slowest participants".
+    # however, we must make sure that the user succeeded in loading the next page fully.
+    # if the user made this page's POST but closed their browser before
+    # the redirect to the next page's GET, then if the next page has a timeout,
+    # it will not get scheduled, and then the auto-timeout chain would be broken.
+    # so, instead of filtering by _index_in_pages (which is set in POST),
+    # we filter by _current_form_page_url (which is set in GET,
+    # AFTER the next page's timeout is scheduled.)
+    pp = Participant.objects_filter(
+        code=participant_code, _index_in_pages=page_index
+    ).first()
+    if pp:
+        logger.info(f'Auto-submitting timed out page: {pp._url_i_should_be_on()}')
+        pp._submit_current_page()
+        # load the next page, like the browser would after the POST's redirect.
+        # this schedules the next page's timeout, so that the chain continues
+        # even if the browser is closed.
+        pp._visit_current_page()
+        # in case the browser is still open but its timer didn't submit the page
+        channel_utils.sync_group_send(
+            group=channel_utils.auto_advance_group(participant_code),
+            data={'auto_advanced': True},
         )
-        for pp in unvisited_participants:
 
-            # if the wait page is the first page,
-            # then _current_form_page_url could be null.
-            # in this case, use the start_url() instead,
-            # because that will redirect to the current wait page.
-            # (alternatively we could define _current_page_url or
-            # current_wait_page_url)
-            path = pp._url_i_should_be_on()
-            logger.info(f'Auto-submitting timed out page: {path}')
 
-            get(urljoin(self.base_url, path))
+def ensure_page_visited(participant_code, page_index):
+    """This is necessary when a wait page is followed by a timeout page.
+    We can't guarantee the user's browser will properly continue to poll
+    the wait page and get redirected, so after a grace period we load the page
+    automatically, to kick off the expiration timer of the timeout page.
+    """
+
+    from otree.models.participant import Participant
+
+    # we used to filter by _index_in_pages, but that is not reliable,
+    # because of the race condition described above.
+    pp = Participant.objects_filter(
+        Participant.code == participant_code,
+        # the +1 is just a buffer for any edge cases
+        # (as we saw with advance_slowest)
+        Participant._index_in_pages <= page_index + 1,
+    ).first()
+    if pp:
+        # if the wait page is the first page,
+        # _visit_current_page follows the redirect to the current wait page.
+        logger.info(f'Auto-visiting page: {pp._url_i_should_be_on()}')
+        pp._visit_current_page()
+
+
+PENDING_TIMEOUTS_KEY = 'otree_pending_timeouts'
 
 
 def _db_enqueue(method, delay, kwargs):
+    epoch_time = delay + round(time.time())
     TaskQueueMessage.objects_create(
-        method=method,
-        epoch_time=delay + round(time.time()),
-        kwargs_json=json.dumps(kwargs),
+        method=method, epoch_time=epoch_time, kwargs_json=json.dumps(kwargs),
     )
+    # schedule it only once the row is committed,
+    # otherwise the worker might run before it can see the task.
+    db._db.info.setdefault(PENDING_TIMEOUTS_KEY, set()).add(epoch_time)
+
+
+@event.listens_for(DBSession, 'after_commit')
+def _schedule_pending_timeouts(session):
+    for epoch_time in session.info.pop(PENDING_TIMEOUTS_KEY, ()):
+        timeout_worker.schedule(epoch_time)
+
+
+@event.listens_for(DBSession, 'after_soft_rollback')
+def _forget_pending_timeouts(session, previous_transaction):
+    session.info.pop(PENDING_TIMEOUTS_KEY, None)
 
 
 def ensure_pages_visited(delay, **kwargs):
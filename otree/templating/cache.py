@@ -0,0 +1,70 @@
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'entries', 'size', 'max_size'])
+
+
+class RenderCache:
+    """
+    LRU cache of rendered template output, used by the {% cache %} tag
+    and by pages that set cache_output_by.
+    It's limited by the total length of the cached strings.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._outputs = OrderedDict()
+        self._size = 0
+        # pages are rendered in a thread pool
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        '''returns None if the key is not in the cache'''
+        with self._lock:
+            output = self._outputs.get(key)
+            if output is None:
+                self.misses += 1
+            else:
+                self._outputs.move_to_end(key)
+                self.hits += 1
+            return output
+
+    def put(self, key, output: str):
+        if len(output) > self.max_size:
+            return
+        with self._lock:
+            self._discard(key)
+            self._outputs[key] = output
+            self._size += len(output)
+            while self._size > self.max_size:
+                _, evicted = self._outputs.popitem(last=False)
+                self._size -= len(evicted)
+
+    def invalidate(self):
+        with self._lock:
+            self._outputs.clear()
+            self._size = 0
+
+    def _discard(self, key):
+        output = self._outputs.pop(key, None)
+        if output is not None:
+            self._size -= len(output)
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(
+            hits=self.hits,
+            misses=self.misses,
+            entries=len(self._outputs),
+            size=self._size,
+            max_size=self.max_size,
+        )
+
+
+# the size is the total number of characters.
+# setting it to 0 turns off caching.
+render_cache = RenderCache(
+    max_size=int(os.getenv('OTREE_TEMPLATE_CACHE_SIZE', 20_000_000))
+)
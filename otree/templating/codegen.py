@@ -0,0 +1,428 @@
+import types
+
+from . import errors
+from . import nodes
+from .context import DataStack
+
+
+# Compiles a template's node tree into a Python function that renders it.
+#
+# The function gives the same output as calling .render() on the root node, but avoids the
+# per-node method calls, and resolves dotted variables with lookup paths that are split up
+# in advance. The Context object is still used for the data stack, so that nodes that aren't
+# compiled (e.g. formfield, include, chat) can be rendered by calling their .render() method.
+#
+# Blocks are resolved when the function is compiled, using the block registry of the template
+# being rendered, just like BlockNode.wrender does at render time.
+
+
+class _Missing:
+    pass
+
+
+MISSING = _Missing()
+METHOD_TYPES = (types.MethodType, types.BuiltinMethodType)
+
+# Names that would resolve to an attribute of the DataStack itself rather than a variable,
+# because Context.resolve checks hasattr() first.
+DATASTACK_ATTRS = frozenset(dir(DataStack()))
+
+
+# A dotted variable name, split into words ahead of time.
+class LookupPath:
+    __slots__ = ['varstring', 'first', 'rest', 'words', 'token', 'is_generic']
+
+    def __init__(self, varstring, token):
+        self.varstring = varstring
+        self.token = token
+        self.words = varstring.split('.')
+        self.first = self.words[0]
+        self.rest = []
+        for word in self.words[1:]:
+            try:
+                int_word = int(word)
+            except ValueError:
+                int_word = None
+            self.rest.append((word, int_word))
+        self.is_generic = self.first in DATASTACK_ATTRS
+
+
+# Same lookup logic as Context.resolve.
+def resolve(context, path: LookupPath):
+    if path.is_generic:
+        return context.resolve(path.varstring, path.token)
+    first = path.first
+    for d in reversed(context.data.stack):
+        if first in d:
+            result = d[first]
+            break
+    else:
+        # gives the same result or error as the usual lookup
+        return context.resolve(path.varstring, path.token)
+    for i, (word, int_word) in enumerate(path.rest):
+        value = getattr(result, word, MISSING)
+        if value is MISSING:
+            try:
+                value = result[word]
+            except:
+                try:
+                    if int_word is None:
+                        raise ValueError(word)
+                    value = result[int_word]
+                except:
+                    varstring = '.'.join(path.words[: i + 2])
+                    msg = f"Cannot resolve the variable '{varstring}'"
+                    raise errors.UndefinedVariable(msg, path.token) from None
+        result = value
+    return result
+
+
+# Same as the function call in Expression._resolve_variable.
+def call(expr: nodes.Expression, obj):
+    try:
+        return obj(*expr.func_args)
+    except Exception as err:
+        msg = f"Error calling function '{expr.varstring}' "
+        msg += f"in template '{expr.token.template_id}', line {expr.token.line_number}."
+        raise errors.TemplateRenderingError(msg, expr.token) from err
+
+
+def autocall(expr: nodes.Expression, obj):
+    if isinstance(obj, METHOD_TYPES):
+        return call(expr, obj)
+    return obj
+
+
+# Same error as Node.render.
+def rendering_error(node, err):
+    token = node.token
+    tagname = f"'{token.keyword}'" if token.type == "INSTRUCTION" else token.type
+    msg = f"Error while rendering the {tagname} tag: "
+    msg += f"{err.__class__.__name__}: {err}"
+    return errors.TemplateRenderingError(msg, token)
+
+
+# Same error as IfNode.eval_condition.
+def condition_error(node, err):
+    nodes.logger.exception(str(err))
+    msg = f"Error evaluating the condition in the "
+    msg += f"'{node.tag}' tag"
+    return errors.TemplateRenderingError(msg, node.token)
+
+
+def unpacking_error(node):
+    return errors.TemplateRenderingError(f"Unpacking error", node.token)
+
+
+# Same as BlockNode.render_block.
+def render_block(context, block_funcs):
+    if block_funcs:
+        func = block_funcs.pop()
+        context.push()
+        context['super'] = lambda: render_block(context, block_funcs)
+        output = func(context)
+        context.pop()
+        return output
+    else:
+        return ''
+
+
+HELPERS = dict(
+    _resolve=resolve,
+    _call=call,
+    _autocall=autocall,
+    _rendering_error=rendering_error,
+    _condition_error=condition_error,
+    _unpacking_error=unpacking_error,
+    _render_block=render_block,
+    _localize=nodes.localize,
+    _TemplateError=errors.TemplateError,
+)
+
+# These render the same output every time.
+CONSTANT_NODES = {
+    nodes.LoadShim: '',
+    nodes.BlockComment: '',
+    nodes.OpenVar: '{{',
+    nodes.CloseVar: '}}',
+    nodes.OpenBlock: '{%',
+    nodes.CloseBlock: '%}',
+}
+
+OPERATOR_SYMBOLS = {func: symbol for symbol, func in nodes.IfNode.operators.items()}
+
+
+def contains_block(node):
+    if isinstance(node, nodes.BlockNode):
+        return True
+    return any(contains_block(child) for child in node.children)
+
+
+class CodeGenerator:
+    def __init__(self, template_id, block_registry):
+        self.template_id = template_id
+        self.block_registry = block_registry
+        self.constants = {}
+        self.functions = []
+        self.num_names = 0
+
+    def compile(self, root_node):
+        self.add_function('render', root_node.children)
+        source = '\n\n'.join(self.functions)
+        code = compile(source, f'<template {self.template_id}>', 'exec')
+        namespace = dict(HELPERS, **self.constants)
+        exec(code, namespace)
+        return namespace['render']
+
+    def new_name(self, prefix):
+        self.num_names += 1
+        return f'{prefix}{self.num_names}'
+
+    def add_constant(self, value, prefix='_k'):
+        name = self.new_name(prefix)
+        self.constants[name] = value
+        return name
+
+    def add_function(self, name, children):
+        writer = FunctionWriter(name)
+        self.write_nodes(writer, children)
+        self.functions.append(writer.get_source())
+
+    def write_nodes(self, w, children):
+        for child in children:
+            self.write_node(w, child)
+
+    def write_node(self, w, node):
+        node_class = type(node)
+        if node_class is nodes.TextNode:
+            w.text(node.token.text)
+        elif node_class in CONSTANT_NODES:
+            w.text(CONSTANT_NODES[node_class])
+        elif node_class is nodes.PrintNode:
+            self.write_print(w, node)
+        elif node_class is nodes.IfNode:
+            self.write_if(w, node)
+        elif node_class is nodes.ForNode:
+            self.write_for(w, node)
+        elif node_class is nodes.WithNode:
+            self.write_with(w, node)
+        elif node_class is nodes.BlockNode:
+            self.write_block(w, node)
+        elif node_class.wrender is nodes.Node.wrender:
+            # e.g. ExtendsNode, which just renders the parent template
+            self.write_nodes(w, node.children)
+        else:
+            n = self.add_constant(node, '_n')
+            w.line(f'_a({n}.render(context))')
+
+    def expr(self, expr: nodes.Expression):
+        '''returns Python code that evaluates the expression'''
+        if expr.is_literal:
+            return self.add_constant(expr.literal)
+        x = self.add_constant(expr, '_x')
+        path = self.add_constant(LookupPath(expr.varstring, expr.token), '_p')
+        code = f'_resolve(context, {path})'
+        if expr.is_func_call:
+            code = f'_call({x}, {code})'
+        else:
+            code = f'_autocall({x}, {code})'
+        if expr.filters:
+            code = f'{x}._apply_filters_to_variable({code})'
+        return code
+
+    def open_try(self, w):
+        w.line('try:')
+        w.indent()
+
+    def close_try(self, w, node):
+        '''errors that are not TemplateErrors get wrapped, like in Node.render'''
+        w.dedent()
+        n = self.add_constant(node, '_n')
+        w.line('except _TemplateError:')
+        w.line('    raise')
+        w.line('except Exception as err:')
+        w.line(f'    raise _rendering_error({n}, err) from err')
+
+    def write_print(self, w, node: nodes.PrintNode):
+        if (
+            not node.is_ternary
+            and len(node.exprs) == 1
+            and node.exprs[0].is_literal
+            and isinstance(node.exprs[0].literal, str)
+        ):
+            w.text(node.exprs[0].literal)
+            return
+        v = self.new_name('_v')
+        self.open_try(w)
+        if node.is_ternary:
+            w.line(f'if {self.expr(node.test_expr)}:')
+            w.line(f'    {v} = {self.expr(node.true_branch_expr)}')
+            w.line('else:')
+            w.line(f'    {v} = {self.expr(node.false_branch_expr)}')
+        else:
+            first, *others = node.exprs
+            w.line(f'{v} = {self.expr(first)}')
+            # the first truthy value, or the last value
+            for expr in others:
+                w.line(f'if not {v}:')
+                w.indent()
+                w.line(f'{v} = {self.expr(expr)}')
+            for _ in others:
+                w.dedent()
+        w.line(f'_a(_localize({v}))')
+        self.close_try(w, node)
+
+    def condition(self, cond):
+        lhs = self.expr(cond.lhs)
+        if cond.op is None:
+            code = f'bool({lhs})'
+        else:
+            rhs = self.expr(cond.rhs)
+            code = f'({lhs} {OPERATOR_SYMBOLS[cond.op]} {rhs})'
+        if cond.negated:
+            code = f'(not {code})'
+        return code
+
+    def write_if(self, w, node: nodes.IfNode):
+        t = self.new_name('_t')
+        n = self.add_constant(node, '_n')
+        test = ' or '.join(
+            '(' + ' and '.join(self.condition(cond) for cond in group) + ')'
+            for group in node.condition_groups
+        )
+        w.line('try:')
+        w.line(f'    {t} = {test}')
+        w.line('except Exception as err:')
+        w.line(f'    raise _condition_error({n}, err) from err')
+        w.line(f'if {t}:')
+        w.indent()
+        self.write_nodes(w, node.true_branch.children)
+        w.pass_if_empty()
+        w.dedent()
+        w.line('else:')
+        w.indent()
+        if isinstance(node.false_branch, nodes.IfNode):
+            # elif
+            self.write_if(w, node.false_branch)
+        else:
+            self.write_nodes(w, node.false_branch.children)
+        w.pass_if_empty()
+        w.dedent()
+
+    def write_for(self, w, node: nodes.ForNode):
+        c = self.new_name('_c')
+        i = self.new_name('_i')
+        item = self.new_name('_item')
+        d = self.new_name('_d')
+        self.open_try(w)
+        w.line(f'{c} = {self.expr(node.expr)}')
+        w.line(f'if {c}:')
+        w.indent()
+        w.line(f'for {i}, {item} in enumerate(list({c})):')
+        w.indent()
+        if len(node.loopvars) > 1:
+            loopvars = self.add_constant(node.loopvars)
+            w.line('try:')
+            w.line(f'    {d} = dict(zip({loopvars}, {item}))')
+            w.line('except Exception as err:')
+            n = self.add_constant(node, '_n')
+            w.line(f'    raise _unpacking_error({n}) from err')
+        else:
+            w.line(f'{d} = {{{node.loopvars[0]!r}: {item}}}')
+        # oTree modified this to be more similar to django
+        w.line(f"{d}['forloop'] = {{'counter0': {i}, 'counter': {i} + 1}}")
+        w.line(f'_stack.append({d})')
+        self.write_nodes(w, node.for_branch.children)
+        w.line('_stack.pop()')
+        w.dedent()
+        w.dedent()
+        w.line('else:')
+        w.indent()
+        self.write_nodes(w, node.empty_branch.children)
+        w.pass_if_empty()
+        w.dedent()
+        self.close_try(w, node)
+
+    def write_with(self, w, node: nodes.WithNode):
+        self.open_try(w)
+        w.line(f'_stack.append({{{node.alias!r}: {self.expr(node.expr)}}})')
+        self.write_nodes(w, node.children)
+        w.line('_stack.pop()')
+        self.close_try(w, node)
+
+    def write_block(self, w, node: nodes.BlockNode):
+        block_list = self.block_registry[node.title]
+        if block_list[0] is not node:
+            return
+        func_names = []
+        for block in block_list:
+            name = self.new_name('_block')
+            self.add_function(name, block.children)
+            func_names.append(name)
+        w.line(f"_a(_render_block(context, [{', '.join(func_names)}]))")
+
+
+# Writes the source code of one function, merging adjacent text into a single append.
+class FunctionWriter:
+    def __init__(self, name):
+        self.lines = [
+            f'def {name}(context):',
+            '    _out = []',
+            '    _a = _out.append',
+            '    _stack = context.data.stack',
+        ]
+        self.depth = 1
+        self.pending_text = []
+        # for each indented block, whether anything was written in it
+        self.block_lengths = []
+
+    def text(self, text):
+        if text:
+            self.pending_text.append(text)
+
+    def flush_text(self):
+        if self.pending_text:
+            text = ''.join(self.pending_text)
+            self.pending_text = []
+            self._write(f'_a({text!r})')
+
+    def line(self, code):
+        self.flush_text()
+        self._write(code)
+
+    def _write(self, code):
+        self.lines.append('    ' * self.depth + code)
+
+    def indent(self):
+        self.flush_text()
+        self.depth += 1
+        self.block_lengths.append(len(self.lines))
+
+    def dedent(self):
+        self.flush_text()
+        self.depth -= 1
+        self.block_lengths.pop()
+
+    def pass_if_empty(self):
+        self.flush_text()
+        if len(self.lines) == self.block_lengths[-1]:
+            self._write('pass')
+
+    def get_source(self):
+        self.flush_text()
+        self.lines.append("    return ''.join(_out)")
+        return '\n'.join(self.lines)
+
+
+def compile_template(template):
+    return CodeGenerator(template.template_id, template.block_registry).compile(
+        template.root_node
+    )
+
+
+# For {% include %}. The included template's blocks would be looked up in the block registry
+# of the template that includes it, so templates with blocks are not compiled.
+def compile_included_template(template):
+    if contains_block(template.root_node):
+        return None
+    return CodeGenerator(template.template_id, {}).compile(template.root_node)
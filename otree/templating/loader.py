@@ -4,6 +4,7 @@ import otree
 from otree import settings
 from starlette.responses import HTMLResponse
 
+from .cache import render_cache
 from .errors import TemplateLoadError
 
 
@@ -47,6 +48,9 @@ class FileReloader(FileLoader):
             cached_mtime, cached_path, cached_template = self.cache[filename]
             if cached_path.exists() and cached_path.stat().st_mtime == cached_mtime:
                 return cached_template
+            # the old output of this template might be in the {% cache %} tag's cache,
+            # or in the cache of a page that uses cache_output_by.
+            render_cache.invalidate()
         template, path = self.load_from_disk(filename, template_type=template_type)
         mtime = path.stat().st_mtime
         self.cache[filename] = (mtime, path, template)
@@ -1,5 +1,7 @@
 import ast
 import collections
+import functools
+import itertools
 import logging
 import operator
 import re
@@ -19,6 +21,7 @@ from . import errors
 from . import filters
 from . import ibis_loader
 from . import utils
+from .cache import render_cache
 
 logger = logging.getLogger(__name__)
 
@@ -213,6 +216,10 @@ class Node:
     def exit_scope(self):
         pass
 
+    def is_constant(self):
+        '''whether the output is the same regardless of the context'''
+        return False
+
     def split_children(self, delimiter_class):
         for index, child in enumerate(self.children):
             if isinstance(child, delimiter_class):
@@ -225,6 +232,58 @@ class TextNode(Node):
     def wrender(self, context):
         return self.token.text
 
+    def is_constant(self):
+        return True
+
+
+# A ConstantNode holds a run of sibling nodes that don't depend on the context,
+# like {% trans %} tags with a literal term. They are rendered the first time,
+# and after that the stored output is reused. See fold_constants().
+class ConstantNode(Node):
+    output = None
+
+    def wrender(self, context):
+        if self.output is None:
+            self.output = super().wrender(context)
+        return self.output
+
+    def is_constant(self):
+        return True
+
+
+def fold_constants(node, _seen=None):
+    """
+    Replaces each run of constant sibling nodes with a ConstantNode,
+    so that e.g. {% trans %} tags are only evaluated once.
+    Runs of plain text are left alone, since they are already as fast as it gets.
+    """
+    seen = _seen if _seen is not None else set()
+    # the parent template of an ExtendsNode was already folded when it was loaded
+    if id(node) in seen or isinstance(node, (ExtendsNode, ConstantNode)):
+        return
+    seen.add(id(node))
+    folded = []
+    run = []
+    for child in node.children + [None]:
+        if child is not None and child.is_constant():
+            run.append(child)
+            continue
+        if any(not isinstance(c, (TextNode, ConstantNode)) for c in run):
+            folded.append(ConstantNode(None, run))
+        else:
+            folded.extend(run)
+        run = []
+        if child is not None:
+            folded.append(child)
+    node.children[:] = folded
+    for child in node.children:
+        fold_constants(child, seen)
+    # e.g. the branches of IfNode and ForNode, which hold the same nodes as
+    # node.children, but without the {% else %} etc. delimiters.
+    for value in vars(node).values():
+        if isinstance(value, Node):
+            fold_constants(value, seen)
+
 
 # A PrintNode evaluates an expression and prints its result. Multiple expressions can be listed
 # separated by 'or' or '||'. The first expression to resolve to a truthy value will be printed.
@@ -271,6 +330,11 @@ class PrintNode(Node):
 
         return localize(content)
 
+    def is_constant(self):
+        if self.is_ternary:
+            return False
+        return all(expr.is_literal for expr in self.exprs)
+
 
 # ForNodes implement `for ... in ...` looping over iterables.
 #
@@ -508,7 +572,7 @@ class BaseIncludeNode(Node):
             context.push()
             for name, expr in self.variables.items():
                 context[name] = expr.eval(context)
-            rendered = template.root_node.render(context)
+            rendered = template.render_included(context)
             context.pop()
             return rendered
         else:
@@ -636,6 +700,36 @@ class WithNode(Node):
         return rendered
 
 
+# Caches the rendered content, keyed by the values of the given expressions.
+# With no expressions, the content is rendered once and then reused.
+#
+#    {% cache <expr> <expr> ... %} ... {% endcache %}
+#
+@register('cache', 'endcache')
+class CacheNode(Node):
+
+    ids = itertools.count()
+
+    def process_token(self, token):
+        self.key_exprs = [Expression(arg, token) for arg in smart_split(token.text)[1:]]
+        # so that the key is unique to this tag
+        self.cache_id = next(self.ids)
+
+    def wrender(self, context):
+        key = (
+            'fragment',
+            self.cache_id,
+            # blocks inside this tag can be overridden by each template that extends this one
+            context.template.template_id,
+            *[expr.eval(context) for expr in self.key_exprs],
+        )
+        output = render_cache.get(key)
+        if output is None:
+            output = ''.join(child.render(context) for child in self.children)
+            render_cache.put(key, output)
+        return output
+
+
 def parse_as_kwarg(arg, expected_name, token) -> Expression:
     prefix = expected_name + '='
     if not arg.startswith(prefix):
@@ -669,8 +763,6 @@ class FormFieldNode(Node):
             self.label_expr = None
 
     def wrender(self, context):
-        from .template import Template
-
         arg0 = self.field_expr.eval(context)
         fld: wtfields.Field
         if isinstance(arg0, str):
@@ -702,8 +794,25 @@ class FormFieldNode(Node):
         if fld.errors:
             classes += ' has-errors'
 
-        return Template(
-            '''
+        return get_formfield_template().render(
+            dict(
+                fld=fld,
+                label=label,
+                classes=classes,
+                errors=fld.errors,
+                is_checkbox=is_checkbox,
+            ),
+            strict_mode=True,
+        )
+
+
+# the same template is used for every formfield, so it's only parsed once.
+@functools.lru_cache()
+def get_formfield_template():
+    from .template import Template
+
+    return Template(
+        '''
 <div class="{{classes}}">
     {% if is_checkbox %}
       {{fld}}
@@ -729,16 +838,7 @@ class FormFieldNode(Node):
         </div>
     {% endif %}
 </div>'''
-        ).render(
-            dict(
-                fld=fld,
-                label=label,
-                classes=classes,
-                errors=fld.errors,
-                is_checkbox=is_checkbox,
-            ),
-            strict_mode=True,
-        )
+    )
 
 
 @register('formfield_errors')
@@ -769,13 +869,20 @@ class FieldErrorsNode(Node):
 @register('formfields')
 class FormFields(Node):
     def wrender(self, context):
-        from .template import Template
-
         form = context['form']
         field_names = [f.name for f in form]
-        return Template(
-            '''{% for name in field_names %}{% formfield name %}{% endfor %}'''
-        ).render(field_names=field_names, form=form, strict_mode=True)
+        return get_formfields_template().render(
+            field_names=field_names, form=form, strict_mode=True
+        )
+
+
+@functools.lru_cache()
+def get_formfields_template():
+    from .template import Template
+
+    return Template(
+        '''{% for name in field_names %}{% formfield name %}{% endfor %}'''
+    )
 
 
 @register('load')
@@ -783,6 +890,9 @@ class LoadShim(Node):
     def wrender(self, context):
         return ''
 
+    def is_constant(self):
+        return True
+
 
 @register('comment', 'endcomment')
 class BlockComment(Node):
@@ -797,30 +907,45 @@ class BlockComment(Node):
     def wrender(self, context):
         return ''
 
+    def is_constant(self):
+        return True
+
 
 @register('ibis_tag_lvar')
 class OpenVar(Node):
     def wrender(self, context):
         return '{{'
 
+    def is_constant(self):
+        return True
+
 
 @register('ibis_tag_rvar')
 class CloseVar(Node):
     def wrender(self, context):
         return '}}'
 
+    def is_constant(self):
+        return True
+
 
 @register('ibis_tag_lblock')
 class OpenBlock(Node):
     def wrender(self, context):
         return '{%'
 
+    def is_constant(self):
+        return True
+
 
 @register('ibis_tag_rblock')
 class CloseBlock(Node):
     def wrender(self, context):
         return '%}'
 
+    def is_constant(self):
+        return True
+
 
 @register('next_button')
 class NextButton(Node):
@@ -833,6 +958,9 @@ class NextButton(Node):
         </p>
         '''
 
+    def is_constant(self):
+        return True
+
 
 @register('csrf_token')
 class CsrfToken(Node):
@@ -886,6 +1014,8 @@ class StaticNode(Node):
 
         self.path_expr = Expression(path, token)
 
+    # not constant, even with a literal path,
+    # because the URL has a fingerprint that changes when the file is edited.
     def wrender(self, context):
         path = self.path_expr.eval(context)
         return url_of_static_file(path)
@@ -961,3 +1091,6 @@ class TransNode(Node):
 
     def wrender(self, context):
         return gettext(self.term_literal.eval(context))
+
+    def is_constant(self):
+        return self.term_literal.is_literal
@@ -1,13 +1,23 @@
+import os
+
 from . import compiler
 from . import context
 from . import nodes
 
+# render templates with Python code generated by codegen.py,
+# rather than by walking the node tree.
+COMPILE_TEMPLATES = bool(os.getenv('OTREE_COMPILE_TEMPLATES'))
+
 
 class Template:
     def __init__(
         self, template_string, template_id="UNIDENTIFIED", template_type: str = ''
     ):
         is_page_template = template_type in ['Page', 'WaitPage']
+        self.template_id = template_id
+        # compiled on first render
+        self._render_function = None
+        self._include_function = None
 
         self.root_node = compiler.compile(
             template_string, template_id, is_page_template=is_page_template
@@ -26,6 +36,7 @@ class Template:
             )
             self.root_node.children.insert(0, nodes.ExtendsNode(token=token))
 
+        nodes.fold_constants(self.root_node)
         self.block_registry = self._register_blocks(self.root_node, {})
 
     def __str__(self):
@@ -33,7 +44,27 @@ class Template:
 
     def render(self, *pargs, **kwargs):
         data_dict = pargs[0] if pargs else kwargs
-        return self.root_node.render(context.Context(data_dict, self))
+        ctx = context.Context(data_dict, self)
+        if COMPILE_TEMPLATES:
+            if self._render_function is None:
+                from .codegen import compile_template
+
+                self._render_function = compile_template(self)
+            return self._render_function(ctx)
+        return self.root_node.render(ctx)
+
+    def render_included(self, ctx):
+        """for {% include %}, which renders with the context of the including template"""
+        if COMPILE_TEMPLATES:
+            if self._include_function is None:
+                from .codegen import compile_included_template
+
+                # if it can't be compiled, we fall back to rendering the node tree
+                self._include_function = (
+                    compile_included_template(self) or self.root_node.render
+                )
+            return self._include_function(ctx)
+        return self.root_node.render(ctx)
 
     def _register_blocks(self, node, registry):
         if isinstance(node, nodes.BlockNode):
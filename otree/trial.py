@@ -1,52 +1,159 @@
+"""
+Trials are sent to the page over a websocket, one message per trial.
+To keep the latency of each message low, the participant's upcoming trials
+are loaded once (when the page loads) into a TrialCursor,
+so that later messages don't need to query the participant, player or trials again.
+
+With trial_response_fields, responses are written in batches
+(every WRITE_BATCH_SIZE responses, or WRITE_DELAY seconds after the first one),
+and before the page is submitted.
+With several worker processes, responses are written right away,
+since the page may be submitted to a different process.
+With evaluate_trial, the trial is modified through the ORM as usual,
+since evaluate_trial can modify anything.
+"""
+import asyncio
+import logging
+from collections import deque
+
 import otree.common
 from otree.channels import utils as channel_utils
-from otree.models import Participant
+from otree.channels.layers import get_backend_name
+from otree.database import NoResultFound, db, session_scope
+from otree.locks import participant_lock_key, request_locks
 from otree.lookup import get_page_lookup
-import logging
-from otree.database import NoResultFound
+from otree.models import Participant
 
 logger = logging.getLogger(__name__)
 
+WRITE_BATCH_SIZE = 20
+# seconds
+WRITE_DELAY = 0.5
+BATCH_WRITES = get_backend_name() == 'memory'
+
+
+class TrialCursor:
+    def __init__(self, *, PageClass, player_id, page_index):
+        self.PageClass = PageClass
+        self.Trial = PageClass.trial_model
+        self.player_id = player_id
+        self.page_index = page_index
+        # trial_id -> dict of response fields not yet written to the DB
+        self.pending = {}
+        self.flush_scheduled = False
+        self.reload()
+
+    def reload(self):
+        Trial = self.Trial
+        trials = Trial.objects_filter(player_id=self.player_id).all()
+        self.total = len(trials)
+        upcoming = sorted(
+            [t for t in trials if t.queue_position is not None],
+            key=lambda t: t.queue_position,
+        )
+        fields = self.PageClass.trial_stimulus_fields
+        self.upcoming = deque(encode_trial(t, fields) for t in upcoming)
 
-async def trial_payload_function(participant_code, page_name, msg):
+    def current(self):
+        if self.upcoming:
+            return self.upcoming[0]
+
+    def progress(self):
+        remaining = len(self.upcoming)
+        return dict(
+            total=self.total, remaining=remaining, completed=self.total - remaining
+        )
+
+    def flush(self):
+        if self.pending:
+            rows = [
+                dict(values, id=trial_id) for trial_id, values in self.pending.items()
+            ]
+            self.pending = {}
+            db.bulk_update(self.Trial, rows)
 
-    print('in trial_payload_function', msg)
+
+# participant_code -> TrialCursor
+_cursors = {}
+
+
+def flush_responses(participant_code):
+    '''so that the DB has all trial responses, e.g. before the page is submitted'''
+    cursor = _cursors.get(participant_code)
+    if cursor:
+        cursor.flush()
+
+
+def forget_cursor(participant_code):
+    cursor = _cursors.pop(participant_code, None)
+    if cursor:
+        cursor.flush()
+
+
+def load_cursor(participant_code):
     try:
         participant = Participant.objects_get(code=participant_code)
     except NoResultFound:
         logger.warning(f'Participant not found: {participant_code}')
         return
+    page_index = participant._index_in_pages
+    lookup = get_page_lookup(participant._session_code, page_index)
+    models_module = otree.common.get_models_module(lookup.app_name)
+    [player_id] = (
+        db.query(models_module.Player.id)
+        .filter_by(round_number=lookup.round_number, participant=participant)
+        .one()
+    )
+    cursor = TrialCursor(
+        PageClass=lookup.page_class, player_id=player_id, page_index=page_index
+    )
+    _cursors[participant_code] = cursor
+    return cursor
+
+
+async def _flush_later(participant_code):
+    await asyncio.sleep(WRITE_DELAY)
+    async with request_locks.hold(participant_lock_key(participant_code)) as connection:
+        with session_scope(bind=connection):
+            cursor = _cursors.get(participant_code)
+            if cursor:
+                cursor.flush_scheduled = False
+                cursor.flush()
+
+
+async def trial_payload_function(participant_code, page_name, msg):
+    msg_type = msg['type']
+    cursor = _cursors.get(participant_code)
+    if (
+        msg_type == 'load'
+        or cursor is None
+        or cursor.PageClass.__name__ != page_name
+    ):
+        forget_cursor(participant_code)
+        cursor = load_cursor(participant_code)
+        if not cursor:
+            return
 
     def send_error():
         """need to put it in a function, otherwise we get a warning
         that the coroutine wasn't awaited."""
-        return _send_back(
-            participant_code,
-            participant._index_in_pages,
-            dict(type='error'),
-        )
+        return _send_back(participant_code, cursor.page_index, dict(type='error'))
 
-    lookup = get_page_lookup(participant._session_code, participant._index_in_pages)
-    app_name = lookup.app_name
-    models_module = otree.common.get_models_module(app_name)
-    PageClass = lookup.page_class
+    PageClass = cursor.PageClass
     if page_name != PageClass.__name__:
         logger.warning(
             f'Ignoring message from {participant_code} because '
             f'they are on page {PageClass.__name__}, not {page_name}.'
         )
+        _cursors.pop(participant_code)
         await send_error()
+        return
 
-    player = models_module.Player.objects_get(
-        round_number=lookup.round_number, participant=participant
-    )
-    Trial = PageClass.trial_model
-    trial = get_current_trial(Trial, player)
-    msg_type = msg['type']
+    trial = cursor.current()
     is_page_load = msg_type == 'load'
     resp = dict(is_page_load=is_page_load, type=msg_type)
     if trial and msg_type == 'response':
-        if trial.id != msg['trial_id']:
+        if trial['id'] != msg['trial_id']:
             await send_error()
             msg = (
                 "Trials: server and client are out of sync. "
@@ -56,8 +163,10 @@ async def trial_payload_function(participant_code, page_name, msg):
         response: dict = msg['response']
         if hasattr(PageClass, 'evaluate_trial'):
             try:
-                feedback = PageClass.evaluate_trial(trial, response)
+                feedback = _evaluate_trial(cursor, response)
             except Exception:
+                # the cursor may be out of date now
+                _cursors.pop(participant_code, None)
                 await send_error()
                 raise
         else:
@@ -80,29 +189,43 @@ async def trial_payload_function(participant_code, page_name, msg):
                     f"but are not in trial_response_fields: {client_only}"
                 )
                 raise Exception(msg)
-            try:
-                # need to do it this way rather than having an overridable evaluate_trial,
-                # because it's a static method, so has no access to trial_response_fields.
-                for attr in PageClass.trial_response_fields:
-                    setattr(trial, attr, response[attr])
-            except Exception:
-                await send_error()
-                raise
-            trial.queue_position = None
+            # need to do it this way rather than having an overridable evaluate_trial,
+            # because it's a static method, so has no access to trial_response_fields.
+            values = {attr: response[attr] for attr in PageClass.trial_response_fields}
+            values.update(queue_position=None)
+            cursor.upcoming.popleft()
+            cursor.pending[trial['id']] = values
+            if (
+                not BATCH_WRITES
+                or len(cursor.pending) >= WRITE_BATCH_SIZE
+                or not cursor.upcoming
+            ):
+                cursor.flush()
+            elif not cursor.flush_scheduled:
+                cursor.flush_scheduled = True
+                asyncio.ensure_future(_flush_later(participant_code))
             feedback = {}
         resp.update(feedback=feedback)
-        trial = get_current_trial(Trial, player)
-    if trial:
-        resp.update(trial=encode_trial(trial, PageClass.trial_stimulus_fields))
-    else:
-        resp.update(trial=None)
-    resp.update(progress=get_progress(Trial, player))
-    # print('resp', resp)
-    await _send_back(
-        participant.code,
-        participant._index_in_pages,
-        resp,
+        trial = cursor.current()
+    resp.update(trial=trial, progress=cursor.progress())
+    await _send_back(participant_code, cursor.page_index, resp)
+
+
+def _evaluate_trial(cursor, response):
+    Trial = cursor.Trial
+    trial = db.get(Trial, cursor.current()['id'])
+    feedback = cursor.PageClass.evaluate_trial(trial, response)
+    session = db._db
+    other_trials_changed = any(
+        isinstance(obj, Trial) and obj is not trial
+        for obj in list(session.new) + list(session.dirty)
     )
+    if trial.queue_position is None and not other_trials_changed:
+        cursor.upcoming.popleft()
+    else:
+        # evaluate_trial requeued the trial or modified other trials
+        cursor.reload()
+    return feedback
 
 
 def encode_trial(trial, fields):
@@ -111,14 +234,6 @@ def encode_trial(trial, fields):
     return {attr: getattr(trial, attr) for attr in fields}
 
 
-def get_progress(Trial, player) -> dict:
-    trials = Trial.objects_filter(player=player)
-    total = trials.count()
-    remaining = trials.filter(Trial.queue_position != None).count()
-
-    return dict(total=total, remaining=remaining, completed=total - remaining)
-
-
 def get_current_trial(Trial, player):
     return (
         Trial.objects_filter(Trial.queue_position != None, player=player)
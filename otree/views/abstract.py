@@ -2,6 +2,7 @@ import inspect
 import logging
 import time
 import typing
+from collections import defaultdict
 from html import escape
 from pathlib import Path
 from typing import List
@@ -13,18 +14,22 @@ from starlette.datastructures import FormData as StarletteFormData
 from starlette.requests import Request
 from starlette.responses import RedirectResponse, HTMLResponse
 from starlette.types import Receive, Scope, Send
+from sqlalchemy.orm import joinedload
 
 # this is an expensive import
 import otree.bots.browser as browser_bots
 import otree.channels.utils as channel_utils
+from otree.channels.monitor import monitor_publisher
 import otree.common
 import otree.common2
 import otree.constants
 from otree.currency import json_dumps
 import otree.forms
+import otree.locks
 import otree.models
 import otree.tasks
 import otree.views.cbv
+import otree.wait_page_arrivals as wait_page_arrivals
 from otree import settings
 from otree.bots.bot import bot_prettify_post_data
 from otree.common import (
@@ -47,7 +52,8 @@ from otree.models_concrete import (
     CompletedGBATWaitPage,
 )
 import otree.trial
-from otree.templating import render
+from otree.templating import render, ibis_loader
+from otree.templating.cache import render_cache
 
 logger = logging.getLogger(__name__)
 
@@ -65,6 +71,41 @@ BOT_COMPLETE_HTML_MESSAGE = '''
 '''
 
 
+def _players_query(PlayerClass, *args, **kwargs):
+    '''loads the group, subsession and session in the same query.'''
+    return PlayerClass.objects_filter(*args, **kwargs).options(
+        joinedload(PlayerClass.group),
+        joinedload(PlayerClass.subsession),
+        joinedload(PlayerClass.session),
+    )
+
+
+def load_current_players(participants, pages_ahead=0):
+    """
+    loads the player for each participant's current page
+    (and the next pages_ahead pages),
+    in 1 query per app and round rather than 1 per participant.
+    they are put in the cache that set_attributes checks.
+    """
+    participants_by_round = defaultdict(set)
+    for pp in participants:
+        first_index = max(pp._index_in_pages, 1)
+        last_index = min(pp._index_in_pages + pages_ahead, pp._max_page_index)
+        for page_index in range(first_index, last_index + 1):
+            lookup = get_page_lookup(pp._session_code, page_index)
+            participants_by_round[lookup.app_name, lookup.round_number].add(pp.id)
+    cache = db.transaction_cache()
+    for (app_name, round_number), participant_ids in participants_by_round.items():
+        PlayerClass = otree.common.get_models_module(app_name).Player
+        players = _players_query(
+            PlayerClass,
+            PlayerClass.participant_id.in_(participant_ids),
+            round_number=round_number,
+        )
+        for player in players:
+            cache[PlayerClass, player.participant_id, round_number] = player
+
+
 class FormPageOrInGameWaitPage:
     request: Request
 
@@ -219,6 +260,11 @@ class FormPageOrInGameWaitPage:
 
     _template_type = None
 
+    # False when the page is visited on the participant's behalf
+    # (e.g. when the admin advances the slowest participants),
+    # so nobody sees the response.
+    _render_response = True
+
     def vars_for_template(self):
         return {}
 
@@ -265,11 +311,11 @@ class FormPageOrInGameWaitPage:
     def subsession(self) -> BaseSubsession:
         '''so that it doesn't rely on player'''
         # this goes through idmap cache, so no perf hit
-        return self.SubsessionClass.objects_get(id=self._subsession_pk)
+        return db.get(self.SubsessionClass, self._subsession_pk)
 
     @property
     def session(self) -> Session:
-        return Session.objects_get(id=self._session_pk)
+        return db.get(Session, self._session_pk)
 
     def set_attributes(self, participant):
 
@@ -284,9 +330,7 @@ class FormPageOrInGameWaitPage:
         self.PlayerClass = getattr(models_module, 'Player')
         self.GroupClass = getattr(models_module, 'Group')
         self.SubsessionClass = getattr(models_module, 'Subsession')
-        self.player = self.PlayerClass.objects_get(
-            participant=participant, round_number=lookup.round_number
-        )
+        self.player = self._get_player(participant, lookup.round_number)
         self._subsession_pk = lookup.subsession_id
         self.round_number = lookup.round_number
         self._session_pk = lookup.session_pk
@@ -304,6 +348,21 @@ class FormPageOrInGameWaitPage:
         participant._last_request_timestamp = int(time.time())
         participant._round_number = lookup.round_number
 
+    def _get_player(self, participant, round_number):
+        """
+        memoized because when a page is submitted, set_attributes is called
+        for each page until one is displayed, and they are usually in the same round.
+        """
+        PlayerClass = self.PlayerClass
+        cache = db.transaction_cache()
+        key = (PlayerClass, participant.id, round_number)
+        player = cache.get(key)
+        if player is None:
+            player = cache[key] = _players_query(
+                PlayerClass, participant=participant, round_number=round_number
+            ).one()
+        return player
+
     def set_attributes_waitpage_clone(self, *, original_view: 'WaitPage'):
         '''put it here so it can be compared with set_attributes...
         but this is really just a method on wait pages'''
@@ -366,13 +425,14 @@ class FormPageOrInGameWaitPage:
                     # so there is no need to mark as complete.
                     continue
 
-                # save the participant, because tally_unvisited
-                # queries index_in_pages directly from the DB
-                db.commit()
+                with otree.locks.wait_page_lock(page._wait_page_lock_key()):
+                    # save the participant, because tally_unvisited
+                    # queries index_in_pages directly from the DB
+                    db.commit()
 
-                is_last, someone_waiting = page._tally_unvisited()
-                if is_last and someone_waiting:
-                    page._run_aapa_and_notify(page._group_or_subsession)
+                    is_last, someone_waiting = page._tally_unvisited()
+                    if is_last and someone_waiting:
+                        page._run_aapa_and_notify(page._group_or_subsession)
 
     def is_displayed(self):
         return True
@@ -443,6 +503,11 @@ class FormPageOrInGameWaitPage:
 class Page(FormPageOrInGameWaitPage):
     form_model = None
     form_fields = []
+    # names of template variables (e.g. from vars_for_template).
+    # if set, the page's HTML is rendered once for each combination of their values,
+    # and then reused. so, the page's content should depend only on these variables.
+    # (js_vars and the participant's websocket URLs are filled in for each participant.)
+    cache_output_by = None
 
     _template_type = 'Page'
 
@@ -503,16 +568,78 @@ class Page(FormPageOrInGameWaitPage):
 
         self._update_monitor_table()
 
+        if not self._render_response and not self.participant.is_browser_bot:
+            # the page will be rendered when the participant's browser loads it,
+            # but the timeout should start now.
+            self.remaining_timeout_seconds()
+            return HTMLResponse('')
+
         # 2020-07-10: maybe we should call vars_for_template before instantiating the form
         # so that you can set initial value for a field in vars_for_template?
         # No, i don't want to commit to that.
         form = self.get_form_or_mockform()
 
         context = self.get_context_data(form=form)
-        response = self.render_to_response(context)
+        if self._can_cache_output():
+            response = self.render_to_response_cached(context)
+        else:
+            response = self.render_to_response(context)
         self.browser_bot_stuff(response)
         return response
 
+    # these are rendered with a placeholder, which is then replaced for each participant
+    _participant_specific_urls = ['socket_url', 'live_url']
+    _js_vars_placeholder = '__otree_js_vars__'
+
+    def _can_cache_output(self):
+        # in debug mode, the page shows the participant's data.
+        # with forms, trials and timers, the content depends on the participant.
+        return (
+            self.cache_output_by is not None
+            and not self.is_debug
+            and not self.has_form()
+            and not self.has_trial()
+            and self.remaining_timeout_seconds() is None
+        )
+
+    def render_to_response_cached(self, context):
+        key = ['page', get_dotted_name(type(self)), self.get_template_name()]
+        for name in self.cache_output_by:
+            if name not in context:
+                raise Exception(
+                    f'{type(self).__name__}.cache_output_by contains "{name}", '
+                    'which is not a template variable'
+                )
+            key.append(context[name])
+        key = tuple(key)
+        try:
+            html = render_cache.get(key)
+        except TypeError:
+            raise TypeError(
+                f'{type(self).__name__}.cache_output_by: '
+                'the template variables must have values like numbers or strings'
+            ) from None
+        urls = {name: getattr(self, name)() for name in self._participant_specific_urls}
+        # js_vars usually differs between participants, e.g. the player's own data.
+        js_vars = context['js_vars']
+        if html is None:
+            for name in urls:
+                setattr(self, name, lambda name=name: f'__otree_{name}__')
+            context['js_vars'] = self._js_vars_placeholder
+            try:
+                html = ibis_loader.load(
+                    self.get_template_name(), template_type=self._template_type
+                ).render(context, strict_mode=True)
+            finally:
+                for name in urls:
+                    delattr(self, name)
+                context['js_vars'] = js_vars
+            render_cache.put(key, html)
+        for name, url in urls.items():
+            html = html.replace(f'__otree_{name}__', url)
+        html = html.replace(self._js_vars_placeholder, js_vars)
+        return HTMLResponse(html)
+
     def get_form_or_mockform(self):
         if self.has_form():
             obj = self.get_object()
@@ -572,6 +699,9 @@ class Page(FormPageOrInGameWaitPage):
         return response
 
     def must_complete_trials(self):
+        if self.has_trial():
+            # responses may not have been written to the DB yet
+            otree.trial.flush_responses(self.participant.code)
         if self.timeout_happened:
             return False
         if self.has_trial():
@@ -861,9 +991,14 @@ class GenericWaitPageMixin:
         '''built-in wait pages should not be overridable'''
         return 'otree/WaitPage.html'
 
+    # see FormPageOrInGameWaitPage._render_response
+    _render_response = True
+
     def _get_wait_page(self):
         self.participant.is_on_wait_page = True
         self._update_monitor_table()
+        if not self._render_response:
+            return HTMLResponse('')
         response = render(self.get_template_name(), self.get_context_data())
         response.headers[
             otree.constants.wait_page_http_header
@@ -931,14 +1066,38 @@ class WaitPage(FormPageOrInGameWaitPage, GenericWaitPageMixin):
     def get(self):
         # necessary because queries are made directly from DB
 
-        if self.wait_for_all_groups == True:
-            resp = self.inner_dispatch_subsession()
-        elif self.group_by_arrival_time:
-            resp = self.inner_dispatch_gbat()
-        else:
-            resp = self.inner_dispatch_group()
+        with otree.locks.wait_page_lock(self._wait_page_lock_key()):
+            if self.wait_for_all_groups == True:
+                resp = self.inner_dispatch_subsession()
+            elif self.group_by_arrival_time:
+                resp = self.inner_dispatch_gbat()
+            else:
+                resp = self.inner_dispatch_group()
         return resp
 
+    def _wait_page_lock_key(self):
+        # GBAT forms groups out of the whole subsession
+        if self.wait_for_all_groups or self.group_by_arrival_time:
+            return ('wait_page', self._session_pk, self._index_in_pages)
+        return (
+            'wait_page',
+            self._session_pk,
+            self._index_in_pages,
+            self.player.group_id,
+        )
+
+    def _is_completed(self, CompletedModel, **kwargs):
+        '''
+        memoized for the transaction, because when the admin advances the slowest
+        participants, they all check the same wait page.
+        _mark_completed_and_notify updates it.
+        '''
+        cache = db.transaction_cache()
+        key = (CompletedModel, frozenset(kwargs.items()))
+        if key not in cache:
+            cache[key] = CompletedModel.objects_exists(**kwargs)
+        return cache[key]
+
     def _run_aapa_and_notify(self, group_or_subsession):
         '''
         group_or_subsession is passed explicitly, because in the case of GBAT it might
@@ -973,7 +1132,8 @@ class WaitPage(FormPageOrInGameWaitPage, GenericWaitPageMixin):
 
     def inner_dispatch_group(self):
         ## EARLY EXITS
-        if CompletedGroupWaitPage.objects_exists(
+        if self._is_completed(
+            CompletedGroupWaitPage,
             page_index=self._index_in_pages,
             group_id=self.player.group_id,
             session_id=self._session_pk,
@@ -989,8 +1149,10 @@ class WaitPage(FormPageOrInGameWaitPage, GenericWaitPageMixin):
 
     def inner_dispatch_subsession(self):
 
-        if CompletedSubsessionWaitPage.objects_exists(
-            page_index=self._index_in_pages, session=self.session
+        if self._is_completed(
+            CompletedSubsessionWaitPage,
+            page_index=self._index_in_pages,
+            session_id=self._session_pk,
         ):
             return self._response_when_ready()
 
@@ -1003,10 +1165,11 @@ class WaitPage(FormPageOrInGameWaitPage, GenericWaitPageMixin):
         return self._response_when_ready()
 
     def inner_dispatch_gbat(self):
-        if CompletedGBATWaitPage.objects_exists(
+        if self._is_completed(
+            CompletedGBATWaitPage,
             page_index=self._index_in_pages,
             id_in_subsession=self.group.id_in_subsession,
-            session=self.session,
+            session_id=self._session_pk,
         ):
             return self._response_when_ready()
 
@@ -1067,6 +1230,19 @@ class WaitPage(FormPageOrInGameWaitPage, GenericWaitPageMixin):
             .with_entities(Participant)
         )
 
+    def _list_participants_for_this_waitpage(self, group_or_subsession):
+        '''memoized, because _tally_unvisited and _mark_completed_and_notify both need them'''
+        if self._participants_for_this_waitpage is None:
+            self._participants_for_this_waitpage = {}
+        key = group_or_subsession.id
+        if key not in self._participants_for_this_waitpage:
+            self._participants_for_this_waitpage[key] = list(
+                self._get_participants_for_this_waitpage(group_or_subsession)
+            )
+        return self._participants_for_this_waitpage[key]
+
+    _participants_for_this_waitpage = None
+
     # this is needed because on wait pages, self.player doesn't exist.
     # usually oTree finds the group by doing self.player.group.
     _group_for_wp_clone = None
@@ -1103,21 +1279,29 @@ class WaitPage(FormPageOrInGameWaitPage, GenericWaitPageMixin):
         base_kwargs = dict(page_index=self._index_in_pages, session_id=self._session_pk)
         Player = self.PlayerClass
 
+        if not self.group_by_arrival_time:
+            # everyone has arrived, so it's not needed anymore
+            wait_page_arrivals.registry.discard(
+                self.participant._session_code,
+                self._index_in_pages,
+                self._arrivals_scope(group or self.subsession),
+            )
         if self.wait_for_all_groups:
-            CompletedSubsessionWaitPage.objects_create(**base_kwargs)
+            CompletedModel = CompletedSubsessionWaitPage
+            completed_kwargs = base_kwargs
         elif self.group_by_arrival_time:
-            db.add(
-                CompletedGBATWaitPage(
-                    **base_kwargs, id_in_subsession=group.id_in_subsession
-                )
-            )
+            CompletedModel = CompletedGBATWaitPage
+            completed_kwargs = dict(base_kwargs, id_in_subsession=group.id_in_subsession)
         else:
-            db.add(CompletedGroupWaitPage(**base_kwargs, group_id=group.id))
+            CompletedModel = CompletedGroupWaitPage
+            completed_kwargs = dict(base_kwargs, group_id=group.id)
+        db.add(CompletedModel(**completed_kwargs))
+        db.transaction_cache()[CompletedModel, frozenset(completed_kwargs.items())] = True
 
-        participants = self._get_participants_for_this_waitpage(
+        participants = self._list_participants_for_this_waitpage(
             group or self.subsession
         )
-        self._mark_page_completions(list(participants))
+        self._mark_page_completions(participants)
         for pp in participants:
             pp._last_page_timestamp = int(time.time())
 
@@ -1128,7 +1312,7 @@ class WaitPage(FormPageOrInGameWaitPage, GenericWaitPageMixin):
             # but this is not reliable because next page might be skipped anyway,
             # and we don't know what page will actually be shown next to the user.
             otree.tasks.ensure_pages_visited(
-                participant_pks=[pp.id for pp in participants],
+                participant_codes=[pp.code for pp in participants],
                 delay=10,
                 page_index=self._index_in_pages,
             )
@@ -1178,11 +1362,46 @@ class WaitPage(FormPageOrInGameWaitPage, GenericWaitPageMixin):
                 group_id=self.player.group_id,
             )
 
+    def _arrivals_scope(self, group_or_subsession):
+        if self.wait_for_all_groups:
+            return ('subsession', group_or_subsession.id)
+        return ('group', group_or_subsession.id)
+
     def _tally_unvisited(self):
+        group_or_subsession = self._group_or_subsession
+        participants = self._get_participants_for_this_waitpage(group_or_subsession)
 
-        participants = self._get_participants_for_this_waitpage(
-            self._group_or_subsession
+        if wait_page_arrivals.ENABLED:
+            num_unvisited, someone_waiting = wait_page_arrivals.registry.tally(
+                session_code=self.participant._session_code,
+                page_index=self._index_in_pages,
+                scope=self._arrivals_scope(group_or_subsession),
+                participants_query=participants,
+            )
+            # only then does _update_monitor_notes do anything,
+            # so we don't need to load the participants otherwise.
+            if num_unvisited <= 3:
+                self._update_monitor_notes(
+                    self._list_participants_for_this_waitpage(group_or_subsession)
+                )
+            return (num_unvisited == 0, someone_waiting)
+
+        participants = self._list_participants_for_this_waitpage(group_or_subsession)
+        unvisited = self._update_monitor_notes(participants)
+
+        # is_last is not technically true. maybe someone else also is waiting for this page
+        # just behind you. but it doesn't matter; you can still advance the waitpage.
+        is_last = not bool(unvisited)
+        someone_waiting = any(
+            [
+                p._index_in_pages == self._index_in_pages and p.is_on_wait_page
+                for p in participants
+            ]
         )
+        return (is_last, someone_waiting)
+
+    def _update_monitor_notes(self, participants) -> list:
+        """returns the participants who haven't visited the page yet"""
         session_code = self.participant._session_code
 
         visited = []
@@ -1201,29 +1420,23 @@ class WaitPage(FormPageOrInGameWaitPage, GenericWaitPageMixin):
                 for p in visited:
                     p._monitor_note = note
 
-            channel_utils.sync_group_send(
-                group=channel_utils.session_monitor_group_name(session_code),
-                data=dict(
-                    ids=[p.id_in_session for p in visited],
-                    note=note,
-                    type='update_notes',
-                ),
+            monitor_publisher.update_notes(
+                session_code, ids=[p.id_in_session for p in visited], note=note
             )
-
-        # is_last is not technically true. maybe someone else also is waiting for this page
-        # just behind you. but it doesn't matter; you can still advance the waitpage.
-        is_last = not bool(unvisited)
-        someone_waiting = any(
-            [
-                p._index_in_pages == self._index_in_pages and p.is_on_wait_page
-                for p in participants
-            ]
-        )
-        return (is_last, someone_waiting)
+        return unvisited
 
     def is_displayed(self):
         return True
 
+    def _get_wait_page(self):
+        if not self.group_by_arrival_time:
+            wait_page_arrivals.record_waiting(
+                self.participant,
+                self._index_in_pages,
+                self._arrivals_scope(self._group_or_subsession),
+            )
+        return super()._get_wait_page()
+
     def _response_when_ready(self):
         '''
         Before calling this function, the following must be satisfied:
@@ -2,18 +2,22 @@ from io import StringIO
 import csv
 import datetime
 
-from starlette.responses import Response
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response, StreamingResponse
 from starlette.endpoints import HTTPEndpoint
 from . import cbv
 
 import otree.common
 import otree.models
 import otree.export
+from otree import export_formats
+from otree.export_formats import ExportFormatError
 from otree.export import BOM, get_installed_apps_with_data
+from otree.locks import request_locks, EXCLUSIVE
 from otree.models.participant import Participant
 from otree.models.session import Session
 from otree.models_concrete import ChatMessage
-from otree.database import dbq
+from otree.database import close_snapshot_bind, db, dbq, get_snapshot_bind
 
 
 class Export(cbv.AdminView):
@@ -50,6 +54,65 @@ def get_csv_http_response(buffer: StringIO, filename_prefix) -> Response:
     return response
 
 
+async def iter_in_transactions(chunks):
+    """
+    Advance the generator one chunk at a time.
+    So, the download starts right away, memory usage stays flat,
+    and other requests can run in between chunks of a long export.
+    The lock is only held while we get a snapshot of the DB,
+    and all chunks are read from that snapshot,
+    so that the file is consistent even if data is modified during the download.
+    """
+    async with request_locks.hold(EXCLUSIVE):
+        bind = await run_in_threadpool(get_snapshot_bind)
+    try:
+        while True:
+            chunk = await run_in_threadpool(_next_chunk, chunks, bind)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        await run_in_threadpool(close_snapshot_bind, bind)
+
+
+def _next_chunk(chunks, bind):
+    with db.private_session(bind=bind):
+        return next(chunks, None)
+
+
+def get_streaming_response(chunks, filename_prefix, fmt='csv') -> StreamingResponse:
+    response = StreamingResponse(
+        iter_in_transactions(chunks), media_type=export_formats.MIME_TYPES[fmt]
+    )
+    date = datetime.date.today().isoformat()
+    response.headers[
+        'Content-Disposition'
+    ] = f'attachment; filename="{filename_prefix}-{date}.{fmt}"'
+    return response
+
+
+def get_format(request):
+    """?format=csv.gz etc. raises ExportFormatError if it's not valid"""
+    return export_formats.resolve_format(request.query_params.get('format', 'csv'))
+
+
+def is_missing_token(request):
+    # we can't use AUTH_LEVEL to guard this, since it should ideally
+    # be available in demo mode. (so that the UI can be consistent,
+    # and it's also a good feature to demo oTree)
+    return request.query_params.get('token') != otree.common.DATA_EXPORT_HASH
+
+
+MISSING_TOKEN_RESPONSE = dict(
+    status_code=400, content="Missing or incorrect auth token"
+)
+
+
+def get_bom(request):
+    # Excel requires BOM; otherwise non-english characters are garbled
+    return BOM if request.query_params.get('excel') else ''
+
+
 class ExportSessionWide(HTTPEndpoint):
     '''used by data page'''
 
@@ -57,17 +120,60 @@ class ExportSessionWide(HTTPEndpoint):
 
     def get(self, request):
         code = request.path_params['code']
-        # we can't use AUTH_LEVEL to guard this, since it should ideally
-        # be available in demo mode. (so that the UI can be consistent,
-        # and it's also a good feature to demo oTree)
-        if request.query_params.get('token') != otree.common.DATA_EXPORT_HASH:
-            return Response(status_code=400, content="Missing or incorrect auth token")
-        buf = StringIO()
-        if bool(request.query_params.get('excel')):
-            # BOM
-            buf.write(BOM)
-        otree.export.export_wide(buf, session_code=code)
-        return get_csv_http_response(buf, 'all_apps_wide')
+        if is_missing_token(request):
+            return Response(**MISSING_TOKEN_RESPONSE)
+        db.get_or_404(Session, code=code)
+        try:
+            fmt = get_format(request)
+            chunks = export_formats.iter_wide(
+                fmt, session_code=code, prefix=get_bom(request)
+            )
+        except ExportFormatError as exc:
+            return Response(status_code=400, content=str(exc))
+        return get_streaming_response(chunks, 'all_apps_wide', fmt)
+
+
+class ExportWide(HTTPEndpoint):
+    '''all sessions, in wide format. for downloading large amounts of data.'''
+
+    url_pattern = '/ExportWide'
+
+    def get(self, request):
+        if is_missing_token(request):
+            return Response(**MISSING_TOKEN_RESPONSE)
+        try:
+            fmt = get_format(request)
+            chunks = export_formats.iter_wide(fmt, prefix=get_bom(request))
+        except ExportFormatError as exc:
+            return Response(status_code=400, content=str(exc))
+        return get_streaming_response(chunks, 'all_apps_wide', fmt)
+
+
+class ExportApp(HTTPEndpoint):
+
+    url_pattern = '/ExportApp/{app_name}'
+
+    def get(self, request):
+        app_name = request.path_params['app_name']
+        if is_missing_token(request):
+            return Response(**MISSING_TOKEN_RESPONSE)
+        if app_name not in get_installed_apps_with_data():
+            return Response(status_code=404, content=f'No data for app {app_name}')
+        try:
+            fmt = get_format(request)
+            prefix = get_bom(request)
+            if request.query_params.get('custom'):
+                # custom_export gets all the Player objects at once,
+                # so it can't be split into separate transactions.
+                # instead, we generate the whole file in this request's transaction.
+                chunks = iter(
+                    list(export_formats.iter_custom_export(fmt, app_name, prefix))
+                )
+            else:
+                chunks = export_formats.iter_app(fmt, app_name, prefix)
+        except ExportFormatError as exc:
+            return Response(status_code=400, content=str(exc))
+        return get_streaming_response(chunks, app_name, fmt)
 
 
 class ExportPageTimes(HTTPEndpoint):
@@ -75,10 +181,12 @@ class ExportPageTimes(HTTPEndpoint):
     url_pattern = '/ExportPageTimes'
 
     def get(self, request):
-        buf = StringIO()
-        otree.export.export_page_times(buf)
-        response = get_csv_http_response(buf, 'PageTimes')
-        return response
+        try:
+            fmt = get_format(request)
+            chunks = export_formats.iter_page_times(fmt)
+        except ExportFormatError as exc:
+            return Response(status_code=400, content=str(exc))
+        return get_streaming_response(chunks, 'PageTimes', fmt)
 
 
 class ExportChat(HTTPEndpoint):
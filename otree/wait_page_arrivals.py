@@ -0,0 +1,160 @@
+"""
+Keeps track of which participants have arrived at each wait page,
+so that a wait page can tell whether everyone has arrived without loading
+all the participants in the group or subsession on every request.
+
+Each entry is loaded from the DB the first time it's needed
+(so after a restart, it's reconciled with the DB), and then kept up to date:
+- when a participant's _index_in_pages changes (tracked with a SQLAlchemy event)
+- when a participant is shown the wait page
+These changes are only applied when the transaction commits,
+so the counts match what other requests see in the DB.
+Within the transaction that made them (e.g. when the admin advances several
+participants in one request), they are applied on top of the committed counts.
+
+With several worker processes, each process only sees its own changes,
+so the counts are not used, and wait pages query the DB instead.
+"""
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from otree.channels.layers import get_backend_name
+from otree.database import DBSession
+from otree.models.participant import Participant
+
+ENABLED = get_backend_name() == 'memory'
+
+PENDING_KEY = 'otree_wait_page_arrivals'
+
+
+class Arrivals:
+    def __init__(self, page_index, rows):
+        self.page_index = page_index
+        self.members = set()
+        self.arrived = set()
+        # participants who are being shown the wait page
+        self.waiting = set()
+        for id, index_in_pages, is_on_wait_page in rows:
+            self.members.add(id)
+            if index_in_pages >= page_index:
+                self.arrived.add(id)
+            if index_in_pages == page_index and is_on_wait_page:
+                self.waiting.add(id)
+
+    def copy(self):
+        arrivals = Arrivals(self.page_index, [])
+        arrivals.members = self.members
+        arrivals.arrived = set(self.arrived)
+        arrivals.waiting = set(self.waiting)
+        return arrivals
+
+    def set_index(self, participant_id, new_index):
+        if new_index >= self.page_index:
+            self.arrived.add(participant_id)
+        else:
+            self.arrived.discard(participant_id)
+        if new_index != self.page_index:
+            self.waiting.discard(participant_id)
+
+
+class ArrivalRegistry:
+    def __init__(self):
+        # {session_code: {page_index: {scope: Arrivals}}}
+        # scope is ('group', group_id) or ('subsession', subsession_id)
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def tally(self, session_code, page_index, scope, participants_query):
+        """
+        returns (num_unvisited, someone_waiting).
+        participants_query is only run if the entry is not loaded yet.
+        """
+        with self._lock:
+            entries = self._sessions.setdefault(session_code, {}).setdefault(
+                page_index, {}
+            )
+            arrivals = entries.get(scope)
+            if arrivals is None:
+                # hold the lock while querying, so that a commit can't be applied
+                # in between the query and adding the entry.
+                rows = participants_query.with_entities(
+                    Participant.id,
+                    Participant._index_in_pages,
+                    Participant.is_on_wait_page,
+                )
+                arrivals = entries[scope] = Arrivals(page_index, rows)
+            pending = participants_query.session.info.get(PENDING_KEY)
+            if pending:
+                arrivals = arrivals.copy()
+                for change_session_code, participant_id, new_index, waiting_scope in pending:
+                    if (
+                        change_session_code != session_code
+                        or participant_id not in arrivals.members
+                    ):
+                        continue
+                    if not waiting_scope:
+                        arrivals.set_index(participant_id, new_index)
+                    elif waiting_scope == scope and new_index == page_index:
+                        arrivals.waiting.add(participant_id)
+            num_unvisited = len(arrivals.members) - len(arrivals.arrived)
+            return num_unvisited, bool(arrivals.waiting)
+
+    def discard(self, session_code, page_index=None, scope=None):
+        '''if page_index is None, discard the whole session'''
+        with self._lock:
+            if page_index is None:
+                self._sessions.pop(session_code, None)
+            else:
+                self._sessions.get(session_code, {}).get(page_index, {}).pop(
+                    scope, None
+                )
+
+    def apply(self, changes):
+        with self._lock:
+            for session_code, participant_id, new_index, waiting_scope in changes:
+                pages = self._sessions.get(session_code)
+                if not pages:
+                    continue
+                if waiting_scope:
+                    arrivals = pages.get(new_index, {}).get(waiting_scope)
+                    if arrivals and participant_id in arrivals.members:
+                        arrivals.waiting.add(participant_id)
+                    continue
+                for page_index, entries in pages.items():
+                    for arrivals in entries.values():
+                        if participant_id in arrivals.members:
+                            arrivals.set_index(participant_id, new_index)
+
+
+registry = ArrivalRegistry()
+
+
+def _add_pending(session, change):
+    session.info.setdefault(PENDING_KEY, []).append(change)
+
+
+def record_waiting(participant: Participant, page_index, scope):
+    session = object_session(participant)
+    if ENABLED and session:
+        _add_pending(session, (participant._session_code, participant.id, page_index, scope))
+
+
+@event.listens_for(Participant._index_in_pages, 'set', active_history=True)
+def _on_index_in_pages_set(participant, value, oldvalue, initiator):
+    session = object_session(participant)
+    if ENABLED and session and participant.id is not None and value != oldvalue:
+        _add_pending(session, (participant._session_code, participant.id, value, None))
+
+
+@event.listens_for(DBSession, 'after_commit')
+def _on_commit(session):
+    changes = session.info.pop(PENDING_KEY, None)
+    if changes:
+        registry.apply(changes)
+
+
+@event.listens_for(DBSession, 'after_soft_rollback')
+def _on_rollback(session, previous_transaction):
+    session.info.pop(PENDING_KEY, None)